@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+from app.config import AUTH_TOKEN, get_env_value
+from app.metrics import ACCOUNT_REQUESTS_TOTAL, ACCOUNT_STATE
+
+
+class Account:
+    def __init__(self, index, value):
+        self.index = index
+        self.value = value
+        self.in_flight = 0
+        self.total_requests = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0
+
+
+# AUTHORIZATION 账号调度：启动时解析一次，每次选择在途请求最少的健康账号；
+# 被限流或连续失败的账号自动进入冷却期
+class AccountScheduler:
+    def __init__(self, tokens, cooldown_seconds=60, failure_threshold=3):
+        values = [token.strip() for token in (tokens or '').split(',') if token.strip()]
+        self.accounts = [Account(index, value) for index, value in enumerate(values)]
+        self.by_value = {account.value: account for account in self.accounts}
+        self.cooldown_seconds = cooldown_seconds
+        self.failure_threshold = failure_threshold
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.accounts:
+            raise ValueError("No tokens provided.")
+        now = time.monotonic()
+        with self._lock:
+            healthy = [account for account in self.accounts if account.cooldown_until <= now]
+            if healthy:
+                # 在途最少优先，相同时选累计请求最少的，保证账号间轮转
+                account = min(healthy, key=lambda a: (a.in_flight, a.total_requests))
+            else:
+                # 全部冷却中时选最早结束冷却的账号
+                account = min(self.accounts, key=lambda a: a.cooldown_until)
+            account.in_flight += 1
+            account.total_requests += 1
+        ACCOUNT_REQUESTS_TOTAL.inc(str(account.index))
+        logging.info("Using account #%d", account.index)
+        return account.value
+
+    def release(self, value):
+        with self._lock:
+            account = self.by_value.get(value)
+            if account is not None and account.in_flight > 0:
+                account.in_flight -= 1
+
+    def report_success(self, value):
+        with self._lock:
+            account = self.by_value.get(value)
+            if account is not None:
+                account.consecutive_failures = 0
+
+    def report_failure(self, value, rate_limited=False):
+        with self._lock:
+            account = self.by_value.get(value)
+            if account is None:
+                return
+            account.consecutive_failures += 1
+            if rate_limited or account.consecutive_failures >= self.failure_threshold:
+                account.cooldown_until = time.monotonic() + self.cooldown_seconds
+                account.consecutive_failures = 0
+                logging.warning("Account #%d cooling down for %d seconds (rate limited: %s)",
+                                account.index, self.cooldown_seconds, rate_limited)
+
+    def cooldown_remaining(self):
+        # 所有账号都在冷却时返回距最早恢复的秒数，否则为 0
+        now = time.monotonic()
+        with self._lock:
+            if not self.accounts:
+                return 0
+            return max(min(account.cooldown_until for account in self.accounts) - now, 0)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return [(account.index, account.in_flight, account.total_requests, account.cooldown_until > now)
+                    for account in self.accounts]
+
+
+account_scheduler = AccountScheduler(
+    AUTH_TOKEN,
+    cooldown_seconds=int(get_env_value('ACCOUNT_COOLDOWN_SECONDS', 60)),
+    failure_threshold=int(get_env_value('ACCOUNT_FAILURE_THRESHOLD', 3)),
+)
+
+
+def account_state_metrics():
+    values = {}
+    for index, in_flight, total_requests, cooling_down in account_scheduler.snapshot():
+        values[(str(index), 'in_flight')] = in_flight
+        values[(str(index), 'cooling_down')] = int(cooling_down)
+    return values
+
+
+ACCOUNT_STATE.set_function(account_state_metrics)
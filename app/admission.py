@@ -0,0 +1,215 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+from app.accounts import account_scheduler
+from app.config import get_env_value
+from app.metrics import ADMISSION_QUEUE_SECONDS, ADMISSION_REJECTED_TOTAL, ADMISSION_STATE
+from app.token import token_provider
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server is busy ({reason}), please retry later")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_priorities(value):
+    # API_KEY_PRIORITIES=key1:0,key2:5，数值越小优先级越高
+    priorities = {}
+    for item in (value or '').split(','):
+        key, _, priority = item.strip().rpartition(':')
+        if key:
+            priorities[key] = int(priority)
+    return priorities
+
+
+def get_api_key(headers):
+    authorization = headers.get('Authorization') or ''
+    if authorization.lower().startswith('bearer '):
+        return authorization[7:].strip()
+    return headers.get('X-Api-Key') or authorization
+
+
+def upstream_capacity(retry_after):
+    # gtoken 池为空或所有账号都在冷却时直接拒绝，不让请求在后面排队等到超时
+    if len(token_provider) == 0:
+        return 'gtoken_exhausted', retry_after
+    cooldown = account_scheduler.cooldown_remaining()
+    if cooldown > 0:
+        return 'accounts_exhausted', cooldown
+    return None
+
+
+class _Waiter:
+    def __init__(self, priority, event):
+        self.priority = priority
+        self.event = event
+        self.granted = False
+        self.rejected = None
+
+
+# 补全接口的准入控制：最多 max_concurrent 个请求同时处理，超出的请求按 API key 优先级在有界队列中等待，
+# 队列已满时挤掉优先级最低的等待者；无法在 queue_timeout 秒内开始处理的请求快速返回 429
+class AdmissionController:
+    def __init__(self, max_concurrent, max_queue, queue_timeout, retry_after, priorities, default_priority,
+                 capacity_check=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.priorities = priorities
+        self.default_priority = default_priority
+        self.capacity_check = capacity_check
+        self.in_flight = 0
+        self._queue = []
+        self._queued = 0
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def priority_of(self, api_key):
+        return self.priorities.get(api_key, self.default_priority)
+
+    def _reject(self, reason, retry_after=None):
+        ADMISSION_REJECTED_TOTAL.inc(reason)
+        return AdmissionRejected(reason, math.ceil(retry_after if retry_after is not None else self.retry_after))
+
+    def _check_capacity(self):
+        if self.capacity_check is not None:
+            exhausted = self.capacity_check(self.retry_after)
+            if exhausted is not None:
+                raise self._reject(*exhausted)
+
+    def _enqueue(self, waiter):
+        # 调用方持有锁。返回被挤出队列的等待者（若有）；新请求自身无法入队时抛出 AdmissionRejected
+        evicted = None
+        if self._queued >= self.max_queue:
+            worst = max((entry for entry in self._queue if entry[2].rejected is None and not entry[2].granted),
+                        default=None)
+            if worst is None or worst[0] <= waiter.priority:
+                raise self._reject('queue_full')
+            evicted = worst[2]
+            evicted.rejected = self._reject('evicted')
+            self._queued -= 1
+        heapq.heappush(self._queue, (waiter.priority, next(self._sequence), waiter))
+        self._queued += 1
+        return evicted
+
+    def _abandon(self, waiter, reason):
+        # 调用方持有锁。等待者离开队列，堆中的条目在出队时跳过
+        waiter.rejected = self._reject(reason)
+        self._queued -= 1
+
+    def _next_waiter(self):
+        # 调用方持有锁。跳过已超时或被挤出的等待者
+        while self._queue:
+            _, _, waiter = heapq.heappop(self._queue)
+            if waiter.rejected is None and not waiter.granted:
+                self._queued -= 1
+                return waiter
+        return None
+
+    def acquire(self, api_key=None):
+        self._check_capacity()
+        waiter = _Waiter(self.priority_of(api_key), threading.Event())
+        with self._lock:
+            if self.in_flight < self.max_concurrent and self._queued == 0:
+                self.in_flight += 1
+                return
+            evicted = self._enqueue(waiter)
+        if evicted is not None:
+            evicted.event.set()
+
+        started_at = time.perf_counter()
+        waiter.event.wait(self.queue_timeout)
+        ADMISSION_QUEUE_SECONDS.observe(time.perf_counter() - started_at)
+        with self._lock:
+            if waiter.granted:
+                return
+            if waiter.rejected is None:
+                self._abandon(waiter, 'queue_timeout')
+        raise waiter.rejected
+
+    def release(self):
+        with self._lock:
+            waiter = self._next_waiter()
+            if waiter is None:
+                self.in_flight -= 1
+                return
+            # 名额直接转交给优先级最高的等待者，in_flight 不变
+            waiter.granted = True
+        waiter.event.set()
+
+    def state(self):
+        with self._lock:
+            return self.in_flight, self._queued
+
+
+# AdmissionController 的协程版本，供 ASGI 模式使用（同一事件循环内无需加锁）
+class AsyncAdmissionController(AdmissionController):
+    async def acquire(self, api_key=None):
+        # 容量检查会读取 token 池大小，多 worker 模式下是对 sidecar 的阻塞调用，放到默认线程池中执行
+        await asyncio.get_running_loop().run_in_executor(None, self._check_capacity)
+        if self.in_flight < self.max_concurrent and self._queued == 0:
+            self.in_flight += 1
+            return
+        waiter = _Waiter(self.priority_of(api_key), asyncio.Event())
+        evicted = self._enqueue(waiter)
+        if evicted is not None:
+            evicted.event.set()
+
+        started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter.event.wait(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # 客户端断开导致请求被取消：已经转交的名额要归还，否则让出队列位置
+            if waiter.granted:
+                self.release()
+            elif waiter.rejected is None:
+                self._abandon(waiter, 'cancelled')
+            raise
+        finally:
+            ADMISSION_QUEUE_SECONDS.observe(time.perf_counter() - started_at)
+        if waiter.granted:
+            return
+        if waiter.rejected is None:
+            self._abandon(waiter, 'queue_timeout')
+        raise waiter.rejected
+
+    def release(self):
+        waiter = self._next_waiter()
+        if waiter is None:
+            self.in_flight -= 1
+            return
+        waiter.granted = True
+        waiter.event.set()
+
+    def state(self):
+        return self.in_flight, self._queued
+
+
+def create_admission_controller(controller_class):
+    controller = controller_class(
+        max_concurrent=int(get_env_value('ADMISSION_MAX_CONCURRENT', 64)),
+        max_queue=int(get_env_value('ADMISSION_MAX_QUEUE', 128)),
+        queue_timeout=float(get_env_value('ADMISSION_QUEUE_TIMEOUT', 10)),
+        retry_after=float(get_env_value('ADMISSION_RETRY_AFTER', 2)),
+        priorities=parse_priorities(get_env_value('API_KEY_PRIORITIES', '')),
+        default_priority=int(get_env_value('API_KEY_DEFAULT_PRIORITY', 10)),
+        capacity_check=upstream_capacity,
+    )
+    logging.info("Admission control: %d concurrent, %d queued", controller.max_concurrent, controller.max_queue)
+
+    def admission_state_metrics():
+        in_flight, queued = controller.state()
+        return {('in_flight',): in_flight, ('queued',): queued}
+
+    ADMISSION_STATE.set_function(admission_state_metrics)
+    return controller
@@ -0,0 +1,493 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+
+import httpx
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+from app.accounts import account_scheduler
+from app.admission import AdmissionRejected, AsyncAdmissionController, create_admission_controller, get_api_key
+from app.config import IGNORED_MODEL_NAMES, IMAGE_MODEL_NAMES, configure_logging, get_env_value, proxy_pool
+from app.deadline import CHANNEL_TIMEOUTS, CHAT_TIMEOUTS, Deadline, UpstreamTimeout, timed_out
+from app.hedge import AsyncHedgedCall
+from app.image_hosts import IMAGE_HOST, LOCAL_IMAGE_DIR
+from app.metrics import CHANNEL_CACHE_TOTAL, CHAT_DURATION_SECONDS, CHAT_FIRST_BYTE_SECONDS, CHAT_HEDGES_TOTAL, \
+    CHAT_RETRIES_TOTAL, CHAT_SSE_CHUNKS, GTOKEN_REJECTED_TOTAL, METRICS_ENABLED, PROXY_REQUESTS_TOTAL, \
+    UPSTREAM_CHANNEL_SECONDS, UPSTREAM_TIMEOUTS_TOTAL, proxy_label, render_metrics
+from app.singleflight import AsyncSingleFlight
+from app.sse import PopaiMessageDecoder
+from app.storage import get_cached_channel_id, cache_channel_id
+from app.token import token_provider
+from app.utils import CHAT_SEND_URL, CHAT_CHANNEL_URL, build_chat_headers, build_chat_data, build_channel_headers, \
+    build_channel_data, wrap_stream_chunk, wrap_completion, parse_chat_request, generate_hash, \
+    wrap_error, CHAT_HEDGE_DELAY, CHAT_HEDGE_ENABLED, CHAT_MAX_ATTEMPTS, cache_response, cached_message, \
+    get_request_parameters, lookup_cached_response, map_model_name
+
+configure_logging()
+
+channel_flight = AsyncSingleFlight()
+admission = create_admission_controller(AsyncAdmissionController)
+chat_hedge = AsyncHedgedCall(CHAT_HEDGE_DELAY, CHAT_MAX_ATTEMPTS, on_hedge=CHAT_HEDGES_TOTAL.inc) \
+    if CHAT_HEDGE_ENABLED else None
+
+# 每个代理一个 AsyncClient，复用连接池（ASGI 模式下所有请求共享同一个事件循环）。
+# 流式响应在读完之前一直占用连接，httpx 默认每个连接池只有 100 个连接，需要按并发流数量调大；
+# 连接池满时最多等待 ASGI_POOL_TIMEOUT 秒
+_async_clients = {}
+ASYNC_POOL_LIMITS = httpx.Limits(
+    max_connections=int(get_env_value('ASGI_POOL_MAX_CONNECTIONS', 2000)),
+    max_keepalive_connections=int(get_env_value('ASGI_POOL_MAX_KEEPALIVE', 200)),
+    keepalive_expiry=float(get_env_value('HTTP_POOL_IDLE_TIMEOUT', 300)),
+)
+ASYNC_POOL_TIMEOUT = float(get_env_value('ASGI_POOL_TIMEOUT', 10))
+
+
+def get_async_client(proxies):
+    proxy_url = proxies.get('https') if proxies else None
+    client = _async_clients.get(proxy_url)
+    if client is None:
+        client = httpx.AsyncClient(proxy=proxy_url, trust_env=False, timeout=None, limits=ASYNC_POOL_LIMITS)
+        _async_clients[proxy_url] = client
+    return client
+
+
+async def close_async_clients():
+    for client in _async_clients.values():
+        await client.aclose()
+    _async_clients.clear()
+
+
+async def async_request_with_proxy(url, headers, data, stream, affinity_key=None, timeouts=CHAT_TIMEOUTS,
+                                   deadline=None, avoid_affinity=None):
+    read_timeout = timeouts.read
+    if deadline is not None:
+        deadline.check(timeouts.endpoint)
+        read_timeout = deadline.limit('read', read_timeout)[1]
+    proxies = proxy_pool.get_proxy(affinity_key, avoid_affinity)
+    client = get_async_client(proxies)
+    started_at = time.perf_counter()
+    ok = False
+    try:
+        upstream_request = client.build_request("POST", url, headers=headers, json=data,
+                                              timeout=httpx.Timeout(read_timeout, connect=timeouts.connect,
+                                                                    pool=ASYNC_POOL_TIMEOUT))
+        response = await client.send(upstream_request, stream=stream)
+        ok = True
+        if stream:
+            proxy_pool.release_on_close(response, proxies)
+    except httpx.ProxyError as e:
+        logging.error(f"Proxy error occurred: {e}")
+        raise Exception("Proxy error occurred")
+    except httpx.ConnectTimeout:
+        UPSTREAM_TIMEOUTS_TOTAL.inc(timeouts.endpoint, 'connect')
+        raise
+    except httpx.ReadTimeout:
+        UPSTREAM_TIMEOUTS_TOTAL.inc(timeouts.endpoint, 'read')
+        raise
+    except httpx.PoolTimeout:
+        UPSTREAM_TIMEOUTS_TOTAL.inc(timeouts.endpoint, 'pool')
+        raise
+    finally:
+        if not (ok and stream):
+            proxy_pool.release(proxies)
+        proxy_pool.record(proxies, ok, time.perf_counter() - started_at if ok else None)
+        PROXY_REQUESTS_TOTAL.inc(proxy_label(proxies), 'ok' if ok else 'error')
+    return response
+
+
+async def async_handle_http_response(resp, started_at, timeouts=CHAT_TIMEOUTS, deadline=None):
+    decoder = PopaiMessageDecoder()
+    message_count = 0
+    first_byte = True
+    chunks = resp.aiter_bytes()
+    try:
+        while True:
+            kind, wait = ('first_byte', timeouts.first_byte) if first_byte else ('idle', timeouts.idle)
+            if deadline is not None:
+                deadline.check(timeouts.endpoint)
+                kind, wait = deadline.limit(kind, wait)
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), wait)
+            except StopAsyncIteration:
+                break
+            except (asyncio.TimeoutError, httpx.ReadTimeout) as e:
+                raise timed_out(timeouts.endpoint, kind, deadline.seconds if kind == 'deadline' else wait) from e
+            if first_byte:
+                CHAT_FIRST_BYTE_SECONDS.observe(time.perf_counter() - started_at)
+                first_byte = False
+            for message in decoder.feed(chunk):
+                message_count += 1
+                yield message
+    except UpstreamTimeout:
+        await resp.aclose()
+        raise
+    finally:
+        CHAT_SSE_CHUNKS.observe(message_count)
+        CHAT_DURATION_SECONDS.observe(time.perf_counter() - started_at)
+
+
+async def async_fetch_channel_id(auth_token, model_name, content, template_id, affinity_key=None):
+    headers = build_channel_headers(auth_token)
+    data = build_channel_data(model_name, content, template_id)
+    try:
+        started_at = time.perf_counter()
+        response = await async_request_with_proxy(CHAT_CHANNEL_URL, headers, data, False, affinity_key,
+                                                  CHANNEL_TIMEOUTS)
+        UPSTREAM_CHANNEL_SECONDS.observe(time.perf_counter() - started_at)
+        response.raise_for_status()
+        account_scheduler.report_success(auth_token)
+        return response.json().get('data', {}).get('channelId')
+    except httpx.HTTPStatusError as e:
+        logging.error("fetch_channel_id error: %s", e)
+        account_scheduler.report_failure(auth_token, rate_limited=e.response.status_code == 429)
+        raise Exception(f"Failed to fetch channel_id. Error: {e}") from e
+    except httpx.HTTPError as e:
+        logging.error("fetch_channel_id error: %s", e)
+        raise Exception(f"Failed to fetch channel_id. Error: {e}") from e
+
+
+async def async_get_channel_id(hash_value, token, model_name, content, template_id):
+    # channel 缓存可能是 SQLite 或 Redis，读写都放到线程池中执行，避免阻塞事件循环
+    channel_id = await run_in_threadpool(get_cached_channel_id, hash_value)
+    if channel_id:
+        logging.info("Returning channel id from cache")
+        CHANNEL_CACHE_TOTAL.inc('hit')
+        return channel_id
+    CHANNEL_CACHE_TOTAL.inc('miss')
+    return await channel_flight.do(hash_value, async_fetch_and_cache_channel_id, hash_value, token, model_name,
+                                   content, template_id)
+
+
+async def async_fetch_and_cache_channel_id(hash_value, token, model_name, content, template_id):
+    channel_id = await run_in_threadpool(get_cached_channel_id, hash_value)
+    if channel_id:
+        return channel_id
+    channel_id = await async_fetch_channel_id(token, model_name, content, template_id, affinity_key=hash_value)
+    await run_in_threadpool(cache_channel_id, hash_value, channel_id)
+    return channel_id
+
+
+def async_stream_response(resp, messages, model_name, cache_key=None):
+    async def generate():
+        parts = [] if cache_key else None
+        message_id = None
+        try:
+            async for message in messages:
+                wrapped_chunk = wrap_stream_chunk(message, model_name)
+                if parts is not None:
+                    message_id = message.get("messageId", "")
+                    parts.append(message.get("content", ""))
+                yield f"data: {json.dumps(wrapped_chunk, ensure_ascii=False)}\n\n".encode('utf-8')
+            if parts is not None:
+                cache_response(cache_key, message_id, ''.join(parts))
+        except UpstreamTimeout as e:
+            logging.error("stream_response error: %s", e)
+            yield f"data: {json.dumps(wrap_error(str(e), 'timeout_error', e.kind))}\n\n".encode('utf-8')
+        except httpx.HTTPError as e:
+            # 上游在流中途断开（ReadError、RemoteProtocolError 等），同样以一个错误事件结束流
+            logging.error("stream_response error: %s", e)
+            yield f"data: {json.dumps(wrap_error(str(e)))}\n\n".encode('utf-8')
+        finally:
+            await resp.aclose()
+
+    return StreamingResponse(generate(), media_type='text/event-stream; charset=UTF-8')
+
+
+async def async_stream_2_json(resp, messages, model_name, user_model_name, cache_key=None):
+    parts = []
+    message_id = None
+    try:
+        async for message in messages:
+            message_id = message.get("messageId", "")
+            parts.append(message.get("content", ""))
+    finally:
+        await resp.aclose()
+    if message_id is None:
+        raise Exception("No data available")
+    content = ''.join(parts)
+    cache_response(cache_key, message_id, content)
+    return JSONResponse(wrap_completion(message_id, content, model_name, user_model_name))
+
+
+def async_cached_chat_response(cached, body):
+    _, model_name, _, user_stream = get_request_parameters(body)
+    if not user_stream:
+        message_id, content = cached
+        return JSONResponse(wrap_completion(message_id, content, map_model_name(model_name), model_name))
+
+    async def generate():
+        wrapped_chunk = wrap_stream_chunk(cached_message(cached), map_model_name(model_name))
+        yield f"data: {json.dumps(wrapped_chunk, ensure_ascii=False)}\n\n".encode('utf-8')
+
+    return StreamingResponse(generate(), media_type='text/event-stream; charset=UTF-8')
+
+
+async def _prepend(first_message, messages):
+    yield first_message
+    async for message in messages:
+        yield message
+
+
+async def async_get_token():
+    # 多 worker 模式下 token 来自 sidecar 的 Unix socket（Redis 后端则是网络请求），都是阻塞 I/O
+    return await run_in_threadpool(token_provider.get_token)
+
+
+async def async_open_chat_stream_with_new_token(headers, data, auth_token, affinity_key=None, deadline=None,
+                                                avoid_affinity=None):
+    return await async_open_chat_stream(headers, data, await async_get_token(), auth_token, affinity_key, deadline,
+                                        avoid_affinity)
+
+
+async def async_open_chat_stream(headers, data, gtoken, auth_token, affinity_key=None, deadline=None,
+                                 avoid_affinity=None):
+    if not gtoken:
+        raise Exception("No valid token available.")
+    headers = dict(headers, Gtoken=gtoken)
+    started_at = time.perf_counter()
+    response = await async_request_with_proxy(CHAT_SEND_URL, headers, data, True, affinity_key, CHAT_TIMEOUTS,
+                                              deadline, avoid_affinity)
+    try:
+        if response.status_code == 429:
+            account_scheduler.report_failure(auth_token, rate_limited=True)
+            raise Exception("Popai response error. Account rate limited")
+        error_code = response.headers.get('YJ-X-Content')
+        if error_code:
+            if "60001" in error_code:
+                GTOKEN_REJECTED_TOTAL.inc()
+                await run_in_threadpool(token_provider.remove_token, gtoken)
+            else:
+                account_scheduler.report_failure(auth_token)
+            raise Exception(f"Popai response error. Error: {error_code}")
+
+        messages = async_handle_http_response(response, started_at, CHAT_TIMEOUTS, deadline)
+        try:
+            first_message = await messages.__anext__()
+        except StopAsyncIteration:
+            account_scheduler.report_failure(auth_token)
+            raise Exception("No data available")
+    except BaseException:
+        # 包括对冲落败被取消的尝试
+        await response.aclose()
+        raise
+    account_scheduler.report_success(auth_token)
+    return response, _prepend(first_message, messages)
+
+
+async def async_close_chat_stream(result):
+    response, _ = result
+    await response.aclose()
+
+
+async def async_build_chat_response(response, messages, model_name, user_stream, user_model_name, cache_key=None):
+    if response.headers.get('Content-Type') == 'text/event-stream;charset=UTF-8' and user_stream:
+        return async_stream_response(response, messages, model_name, cache_key)
+    return await async_stream_2_json(response, messages, model_name, user_model_name, cache_key)
+
+
+async def async_send_chat_message(auth_token, channel_id, final_user_content, model_name, user_stream, image_url,
+                                  user_model_name, affinity_key=None, cache_key=None):
+    logging.info("Channel ID: %s", channel_id)
+    logging.info("Model Name: %s", model_name)
+    logging.info("Image URL: %s", image_url)
+    logging.info("User stream: %s", user_stream)
+    headers = build_chat_headers(auth_token)
+    data = build_chat_data(channel_id, final_user_content, model_name, image_url)
+    deadline = Deadline()
+
+    if chat_hedge is not None:
+        def hedged_attempt(index):
+            # 第一个尝试沿用会话绑定的代理；对冲尝试避开它，否则所有尝试都会落在同一个慢代理或故障代理上
+            if index == 0:
+                return async_open_chat_stream_with_new_token(headers, data, auth_token, affinity_key, deadline)
+            return async_open_chat_stream_with_new_token(headers, data, auth_token, deadline=deadline,
+                                                         avoid_affinity=affinity_key)
+
+        try:
+            response, messages = await chat_hedge.run(hedged_attempt, async_close_chat_stream)
+            return await async_build_chat_response(response, messages, model_name, user_stream, user_model_name,
+                                                   cache_key)
+        except Exception as e:
+            logging.error("send_chat_message error: %s", e)
+            return handle_error(e)
+
+    for attempt in range(CHAT_MAX_ATTEMPTS):
+        gtoken = await async_get_token()
+        if not gtoken:
+            return handle_error(Exception("No valid token available."))
+
+        try:
+            response, messages = await async_open_chat_stream(headers, data, gtoken, auth_token, affinity_key,
+                                                              deadline)
+            return await async_build_chat_response(response, messages, model_name, user_stream, user_model_name,
+                                                   cache_key)
+
+        except UpstreamTimeout as e:
+            logging.error("send_chat_message error: %s", e)
+            if e.kind == 'deadline' or attempt == CHAT_MAX_ATTEMPTS - 1:
+                return handle_error(e)
+            CHAT_RETRIES_TOTAL.inc('timeout')
+
+        except httpx.HTTPError as e:
+            logging.error("send_chat_message error: %s", e)
+            if attempt == CHAT_MAX_ATTEMPTS - 1:
+                return handle_error(e)
+            CHAT_RETRIES_TOTAL.inc('request_error')
+
+        except Exception as e:
+            logging.error("send_chat_message error: %s", e)
+            if "60001" in str(e):
+                logging.warning(f"Received 60001 error code on attempt {attempt + 1}. Retrying...")
+                CHAT_RETRIES_TOTAL.inc('60001')
+                continue
+            if attempt == CHAT_MAX_ATTEMPTS - 1:
+                return handle_error(e)
+            CHAT_RETRIES_TOTAL.inc('error')
+    return handle_error(Exception("All attempts to send chat message failed."))
+
+
+def handle_error(e):
+    if isinstance(e, AdmissionRejected):
+        return JSONResponse(wrap_error(str(e), 'rate_limit_error', e.reason), status_code=429,
+                            headers={'Retry-After': str(e.retry_after)})
+    if isinstance(e, UpstreamTimeout):
+        return JSONResponse(wrap_error(str(e), 'timeout_error', e.kind), status_code=504)
+    return JSONResponse(wrap_error(str(e)), status_code=500)
+
+
+async def fetch(request, body):
+    # 缓存命中时直接返回，不经过准入控制，也不占用账号和 gtoken
+    cache_key, cached = lookup_cached_response(body, request.headers)
+    if cached is not None:
+        response = async_cached_chat_response(cached, body)
+        response.headers['X-Cache'] = 'HIT'
+        return response
+    try:
+        await admission.acquire(get_api_key(request.headers))
+    except AdmissionRejected as e:
+        logging.warning("Request rejected: %s", e)
+        return handle_error(e)
+    token = None
+    try:
+        token = account_scheduler.acquire()
+        response = await fetch_with_account(request, body, token, cache_key)
+    except BaseException:
+        release_request(token)
+        raise
+    if cache_key is not None:
+        response.headers['X-Cache'] = 'MISS'
+    if not isinstance(response, StreamingResponse):
+        release_request(token)
+        return response
+    # 流式响应在发送完成后才释放准入名额和账号的在途计数。body 迭代器抛出异常时 Starlette 不会执行
+    # background，所以在迭代器的 finally 中释放；background 只兜底客户端在开始发送前就断开的情况
+    release = release_once(token)
+    response.body_iterator = release_when_done(response.body_iterator, release)
+    response.background = BackgroundTask(release)
+    return response
+
+
+def release_request(token):
+    if token is not None:
+        account_scheduler.release(token)
+    admission.release()
+
+
+def release_once(token):
+    lease = [token]
+
+    def release():
+        try:
+            token = lease.pop()
+        except IndexError:
+            return
+        release_request(token)
+
+    return release
+
+
+async def release_when_done(body_iterator, release):
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        release()
+
+
+async def fetch_with_account(request, body, token, cache_key=None):
+    # process_content 可能会同步上传图片，放到线程池中执行避免阻塞事件循环
+    model_name, model_to_use, template_id, final_user_content, first_argument, image_url, user_stream = \
+        await run_in_threadpool(parse_chat_request, body, request.headers)
+
+    if final_user_content is None:
+        return Response("No user message found", status_code=400)
+
+    hash_value = generate_hash(first_argument, model_to_use, token)
+    channel_id = await async_get_channel_id(hash_value, token, model_to_use, final_user_content, template_id)
+
+    return await async_send_chat_message(token, channel_id, final_user_content, model_to_use, user_stream, image_url,
+                                         model_name, affinity_key=hash_value, cache_key=cache_key)
+
+
+async def onRequest(request):
+    if request.method == "OPTIONS":
+        return Response(status_code=204, headers={'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Headers': '*'})
+    try:
+        return await fetch(request, await request.json())
+    except Exception as e:
+        logging.error("An error occurred with chat : %s", e)
+        return handle_error(e)
+
+
+async def list_models(request):
+    return JSONResponse({
+        "object": "list",
+        "data": [{
+            "id": m,
+            "object": "model",
+            "created": int(datetime.now().timestamp()),
+            "owned_by": "popai"
+        } for m in IGNORED_MODEL_NAMES]
+    })
+
+
+async def metrics(request):
+    if not METRICS_ENABLED:
+        return Response(status_code=404)
+    # 多进程部署时会读取其他 worker 的指标文件并请求 sidecar，放到线程池中执行
+    return PlainTextResponse(await run_in_threadpool(render_metrics), media_type='text/plain; version=0.0.4')
+
+
+async def image(request):
+    try:
+        body = await request.json()
+        body["model"] = IMAGE_MODEL_NAMES[0]
+        return await fetch(request, body)
+    except Exception as e:
+        logging.error("An error occurred with image : %s", e)
+        return handle_error(e)
+
+
+def create_asgi_app():
+    routes = [
+        Route("/v1/chat/completions", onRequest, methods=["GET", "POST", "OPTIONS"]),
+        Route("/v1/models", list_models),
+        Route("/metrics", metrics),
+        Route("/v1/images/generations", image, methods=["POST"]),
+    ]
+    if IMAGE_HOST == 'local':
+        routes.append(Mount("/images", app=StaticFiles(directory=LOCAL_IMAGE_DIR, check_dir=False)))
+    return Starlette(
+        routes=routes,
+        middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+        on_shutdown=[close_async_clients],
+    )
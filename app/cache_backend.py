@@ -0,0 +1,221 @@
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+from app.config import get_env_value
+from app.token import ConsumptionForecaster, USES_PER_TOKEN
+
+# 多副本部署时通过 Redis 共享会话 channel 缓存和 gtoken 池（CACHE_BACKEND=redis）。
+# 与进程内实现保持相同的方法签名：
+#   channel 缓存：get(hash_value) / set(hash_value, channel_id) / flush()
+#   图片 URL 缓存：get(digest) / set(digest, url)
+#   token 池：add_token / get_token / remove_token / count_valid_tokens / remove_invalid_tokens / snapshot
+
+TOKEN_TTL_SECONDS = 3600
+ACQUIRE_BUCKET_SECONDS = 10
+
+_redis_client = None
+_redis_client_lock = threading.Lock()
+
+
+def get_redis_client():
+    global _redis_client
+    with _redis_client_lock:
+        if _redis_client is None:
+            import redis
+            _redis_client = redis.Redis.from_url(get_env_value('REDIS_URL', 'redis://127.0.0.1:6379/0'),
+                                                 decode_responses=True)
+        return _redis_client
+
+
+def get_key_prefix():
+    return get_env_value('REDIS_KEY_PREFIX', 'popai2api:')
+
+
+class RedisChannelStore:
+    def __init__(self, client, ttl, prefix):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = f"{prefix}channel:"
+
+    def get(self, hash_value):
+        return self.client.get(self.prefix + hash_value)
+
+    def set(self, hash_value, channel_id):
+        self.client.set(self.prefix + hash_value, channel_id, ex=self.ttl)
+
+    def flush(self):
+        pass
+
+
+class RedisImageUrlCache:
+    def __init__(self, client, ttl, prefix):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = f"{prefix}image:"
+
+    def get(self, digest):
+        return self.client.get(self.prefix + digest)
+
+    def set(self, digest, url):
+        self.client.set(self.prefix + digest, url, ex=self.ttl)
+
+
+# 新增 token：已存在或曾被删除（用尽、60001 被拒）的 token 不再加入，避免以过期的 use_count 复活
+_ADD_TOKEN_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 or redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'use_count', ARGV[1], 'created_at', ARGV[2])
+redis.call('EXPIREAT', KEYS[1], ARGV[3])
+redis.call('RPUSH', KEYS[3], ARGV[4])
+return 1
+"""
+
+# 轮转取出一个仍有效的 token：列表中只保存 token 值，使用次数与创建时间存放在随 TTL 过期的 hash 中。
+# 被删除或过期的 token 在轮转到时顺带从列表中丢弃；用尽的 token 留下删除标记
+_GET_TOKEN_SCRIPT = """
+local n = redis.call('LLEN', KEYS[1])
+for i = 1, n do
+    local value = redis.call('LPOP', KEYS[1])
+    if not value then
+        return false
+    end
+    local key = ARGV[1] .. value
+    if redis.call('EXISTS', key) == 1 then
+        local count = redis.call('HINCRBY', key, 'use_count', 1)
+        if count < tonumber(ARGV[2]) then
+            redis.call('RPUSH', KEYS[1], value)
+        else
+            redis.call('DEL', key)
+            redis.call('SET', ARGV[3] .. value, 1, 'EX', ARGV[4])
+        end
+        return value
+    end
+end
+return false
+"""
+
+_REMOVE_INVALID_SCRIPT = """
+local values = redis.call('LRANGE', KEYS[1], 0, -1)
+local removed = 0
+for _, value in ipairs(values) do
+    if redis.call('EXISTS', ARGV[1] .. value) == 0 then
+        redis.call('LREM', KEYS[1], 0, value)
+        removed = removed + 1
+    end
+end
+return removed
+"""
+
+# 生成 token 的租约：同一时间只有一个副本启动浏览器生成 token
+_MINTER_LEASE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+if current == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+# 消耗速率按 10 秒分桶记录在 Redis 中，所有副本的请求都计入，由持有租约的副本统一预测
+class SharedConsumptionForecaster(ConsumptionForecaster):
+    def __init__(self, client, prefix, floor, ceiling, horizon, windows=(60, 300, 900)):
+        super().__init__(floor, ceiling, horizon, windows)
+        self.client = client
+        self.prefix = f"{prefix}gtoken:acquired:"
+
+    def record_acquire(self):
+        bucket = int(time.time()) // ACQUIRE_BUCKET_SECONDS
+        key = f"{self.prefix}{bucket}"
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.expire(key, self.windows[-1] + ACQUIRE_BUCKET_SECONDS)
+        pipe.execute()
+
+    def rates(self):
+        current = int(time.time()) // ACQUIRE_BUCKET_SECONDS
+        bucket_count = self.windows[-1] // ACQUIRE_BUCKET_SECONDS
+        keys = [f"{self.prefix}{current - i}" for i in range(bucket_count)]
+        counts = [int(count or 0) for count in self.client.mget(keys)]
+        return {window: sum(counts[:max(window // ACQUIRE_BUCKET_SECONDS, 1)]) / window for window in self.windows}
+
+
+class RedisTokenPool:
+    def __init__(self, client, prefix, min_valid_tokens=50, max_valid_tokens=200, forecast_horizon=300):
+        self.client = client
+        self.queue_key = f"{prefix}gtoken:queue"
+        self.token_prefix = f"{prefix}gtoken:token:"
+        self.removed_prefix = f"{prefix}gtoken:removed:"
+        self.minter_key = f"{prefix}gtoken:minter"
+        self.minter_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.min_valid_tokens = min_valid_tokens
+        self.forecaster = SharedConsumptionForecaster(client, prefix, min_valid_tokens, max_valid_tokens,
+                                                      forecast_horizon)
+        self.refill_event = threading.Event()
+        self._add_token = client.register_script(_ADD_TOKEN_SCRIPT)
+        self._get_token = client.register_script(_GET_TOKEN_SCRIPT)
+        self._remove_invalid = client.register_script(_REMOVE_INVALID_SCRIPT)
+        self._minter_lease = client.register_script(_MINTER_LEASE_SCRIPT)
+
+    def __len__(self):
+        return self.client.llen(self.queue_key)
+
+    def add_token(self, token_value, created_at=None, use_count=0):
+        created_at = created_at or datetime.now()
+        self._add_token(keys=[self.token_prefix + token_value, self.removed_prefix + token_value, self.queue_key],
+                        args=[use_count, created_at.timestamp(), int(created_at.timestamp()) + TOKEN_TTL_SECONDS,
+                              token_value])
+
+    def get_token(self):
+        token_value = self._get_token(keys=[self.queue_key],
+                                      args=[self.token_prefix, USES_PER_TOKEN, self.removed_prefix, TOKEN_TTL_SECONDS])
+        self.forecaster.record_acquire()
+        if token_value is None or len(self) < self.min_valid_tokens:
+            self.refill_event.set()
+        return token_value
+
+    def count_valid_tokens(self):
+        return len(self)
+
+    def remove_invalid_tokens(self):
+        removed = self._remove_invalid(keys=[self.queue_key], args=[self.token_prefix])
+        if removed:
+            logging.info(f"Removed {removed} invalid tokens from shared pool")
+
+    def remove_token(self, token_value):
+        pipe = self.client.pipeline()
+        pipe.delete(self.token_prefix + token_value)
+        pipe.set(self.removed_prefix + token_value, 1, ex=TOKEN_TTL_SECONDS)
+        removed = pipe.execute()[0] > 0
+        if removed:
+            logging.info("one token has been removed.")
+        else:
+            logging.warning(f"Token with value {token_value} was not found.")
+        return removed
+
+    def snapshot(self):
+        values = self.client.lrange(self.queue_key, 0, -1)
+        pipe = self.client.pipeline(transaction=False)
+        for value in values:
+            pipe.hmget(self.token_prefix + value, 'created_at', 'use_count')
+        entries = []
+        for value, (created_at, use_count) in zip(values, pipe.execute()):
+            if created_at is not None:
+                entries.append((value, float(created_at), int(use_count)))
+        return entries
+
+    def try_acquire_minter(self, lease_seconds=60):
+        try:
+            return bool(self._minter_lease(keys=[self.minter_key], args=[self.minter_id, lease_seconds]))
+        except Exception as e:
+            logging.error(f"Failed to acquire minter lease: {e}")
+            return False
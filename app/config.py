@@ -1,6 +1,9 @@
 import os
 import logging
 import random
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -17,6 +20,8 @@ AUTH_TOKEN = get_env_value("AUTHORIZATION")
 G_TOKEN = get_env_value("G_TOKEN")
 HISTORY_MSG_LIMIT = get_env_value("HISTORY_MSG_LIMIT", 0)
 RECAPTCHA_SECRET = get_env_value("RECAPTCHA_SECRET")
+# local: 进程内缓存（默认）；redis: 多副本共享 channel 缓存与 gtoken 池
+CACHE_BACKEND = get_env_value("CACHE_BACKEND", "local").lower()
 POPAI_BASE_URL = "https://www.popai.pro/"
 log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
 
@@ -33,25 +38,176 @@ def _get_proxies_from_env(env_var):
     return [proxy.strip() for proxy in proxies.split(',') if proxy.strip()]
 
 
+# 单个代理的健康状态：延迟 EWMA、错误率 EWMA、在途连接数和熔断状态
+class ProxyState:
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.error_rate = 0.0
+        self.open_connections = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0
+        self.eject_seconds = 0
+        self.probing = False
+
+    def score(self):
+        # 延迟越低、错误率越低、在途连接越少得分越低（越优先）
+        latency = self.latency if self.latency is not None else 0.5
+        return latency * (1 + self.open_connections) / max(1 - self.error_rate, 0.05)
+
+
 class ProxyPool:
     def __init__(self):
         self.http_proxies = _get_proxies_from_env('HTTP_PROXY')
         self.https_proxies = _get_proxies_from_env('HTTPS_PROXY')
+        self.failure_threshold = int(get_env_value('PROXY_FAILURE_THRESHOLD', 3))
+        self.min_eject_seconds = float(get_env_value('PROXY_EJECT_SECONDS', 30))
+        self.max_eject_seconds = float(get_env_value('PROXY_MAX_EJECT_SECONDS', 300))
+        # 上游都是 https，按 https 代理（未配置时按 http 代理）统计健康状态并调度
+        self.states = {url: ProxyState(url) for url in (self.https_proxies or self.http_proxies)}
+        self.affinity = OrderedDict()
+        self.max_affinity_entries = int(get_env_value('PROXY_AFFINITY_MAX_ENTRIES', 10000))
+        self._lock = threading.Lock()
+
+    def _is_admitted(self, state, now):
+        if state.ejected_until == 0:
+            return True
+        # 熔断到期后进入半开状态，只放行一个探测请求，成功后恢复
+        return state.ejected_until <= now and not state.probing
+
+    def _choose(self, avoid=None):
+        now = time.monotonic()
+        states = list(self.states.values())
+        admitted = [state for state in states if self._is_admitted(state, now)]
+        if avoid is not None:
+            # 对冲尝试避开会话绑定的代理，除非没有其他可用代理
+            admitted = [state for state in admitted if state.url != avoid] or admitted
+        if not admitted:
+            # 全部被熔断时退化为最早恢复的代理，避免完全不可用
+            return min(states, key=lambda state: state.ejected_until)
+        # power of two choices：随机取两个，选得分更低的，既偏向快代理又避免所有请求涌向同一个；
+        # 少量请求随机分配，让评分较差的代理也有机会更新统计
+        if len(admitted) > 1 and random.random() < 0.05:
+            state = random.choice(admitted)
+        elif len(admitted) > 1:
+            first, second = random.sample(admitted, 2)
+            state = first if first.score() <= second.score() else second
+        else:
+            state = admitted[0]
+        if state.ejected_until:
+            state.probing = True
+        return state
+
+    def get_proxy(self, affinity_key=None, avoid_affinity=None):
+        if not self.states:
+            return None
+        with self._lock:
+            if affinity_key:
+                state = self._choose_with_affinity(affinity_key)
+            else:
+                state = self._choose(self.affinity.get(avoid_affinity) if avoid_affinity else None)
+            state.open_connections += 1
 
-    def get_random_proxy(self):
-        proxy = {}
-        if self.http_proxies:
+        proxy = {'https': state.url} if self.https_proxies else {'http': state.url}
+        if self.https_proxies and self.http_proxies:
             proxy['http'] = random.choice(self.http_proxies)
-        if self.https_proxies:
-            proxy['https'] = random.choice(self.https_proxies)
-        
+
         # 若只存在一个键，使用其值填充另一个
-        if 'http' in proxy or 'https' in proxy:
-            proxy.setdefault('http', proxy.get('https'))
-            proxy.setdefault('https', proxy.get('http'))
-    
+        proxy.setdefault('http', proxy.get('https'))
+        proxy.setdefault('https', proxy.get('http'))
+
         # logging.info("proxy URL %s", proxy)
 
-        return proxy if proxy else None
+        return proxy
+
+    def _choose_with_affinity(self, affinity_key):
+        # 同一会话 channel 固定走同一个代理（从而复用同一个连接池 Session）；
+        # 该代理被熔断时改选其他代理并重新绑定
+        url = self.affinity.get(affinity_key)
+        state = self.states.get(url)
+        if state is None or state.ejected_until:
+            state = self._choose()
+            self.affinity[affinity_key] = state.url
+        self.affinity.move_to_end(affinity_key)
+        while len(self.affinity) > self.max_affinity_entries:
+            self.affinity.popitem(last=False)
+        return state
+
+    def _state_for(self, proxies):
+        if not proxies:
+            return None
+        return self.states.get(proxies.get('https') if self.https_proxies else proxies.get('http'))
+
+    def release(self, proxies):
+        with self._lock:
+            state = self._state_for(proxies)
+            if state is not None and state.open_connections > 0:
+                state.open_connections -= 1
+
+    def release_on_close(self, response, proxies):
+        # 流式响应在读完之前一直占用代理连接，在途连接数在 close()/aclose() 时才归还（只归还一次）
+        lease = [proxies]
+
+        def release():
+            try:
+                proxies = lease.pop()
+            except IndexError:
+                return
+            self.release(proxies)
+
+        close = response.close
+
+        def close_and_release():
+            try:
+                return close()
+            finally:
+                release()
+
+        response.close = close_and_release
+        aclose = getattr(response, 'aclose', None)
+        if aclose is not None:
+            async def aclose_and_release():
+                try:
+                    return await aclose()
+                finally:
+                    release()
+
+            response.aclose = aclose_and_release
+
+    def record(self, proxies, ok, latency=None):
+        with self._lock:
+            state = self._state_for(proxies)
+            if state is None:
+                return
+            state.error_rate = 0.9 * state.error_rate + (0.0 if ok else 0.1)
+            if latency is not None:
+                state.latency = latency if state.latency is None else 0.8 * state.latency + 0.2 * latency
+            if ok:
+                if state.ejected_until:
+                    logging.info("Proxy %s re-admitted", _mask_proxy(state.url))
+                state.consecutive_failures = 0
+                state.ejected_until = 0
+                state.eject_seconds = 0
+                state.probing = False
+                return
+            state.consecutive_failures += 1
+            if state.probing or state.consecutive_failures >= self.failure_threshold:
+                # 熔断：探测失败时按指数退避延长熔断时间
+                state.eject_seconds = min(max(state.eject_seconds * 2, self.min_eject_seconds), self.max_eject_seconds)
+                state.ejected_until = time.monotonic() + state.eject_seconds
+                state.probing = False
+                logging.warning("Proxy %s ejected for %.0f seconds", _mask_proxy(state.url), state.eject_seconds)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return [(state.url, state.latency, state.error_rate, state.open_connections,
+                     state.ejected_until > now) for state in self.states.values()]
+
+
+def _mask_proxy(url):
+    # 日志中不输出代理账号密码
+    return url.rsplit('@', 1)[-1]
+
 
-proxy_pool = ProxyPool()
\ No newline at end of file
+proxy_pool = ProxyPool()
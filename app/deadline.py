@@ -0,0 +1,81 @@
+import time
+
+from app.config import get_env_value
+from app.metrics import UPSTREAM_TIMEOUTS_TOTAL
+
+UPSTREAM_CONNECT_TIMEOUT = float(get_env_value('UPSTREAM_CONNECT_TIMEOUT', 10))
+UPSTREAM_READ_TIMEOUT = float(get_env_value('UPSTREAM_READ_TIMEOUT', 60))
+
+
+# 单个上游接口的超时配置：
+#   connect     建立连接（含代理握手）
+#   read        等待响应头以及非流式响应的每次读取
+#   first_byte  流式响应头之后等待第一块数据
+#   idle        流式响应两块数据之间允许的最长间隔
+# 每一项都可以用 <PREFIX>_CONNECT_TIMEOUT 等环境变量单独覆盖，未设置时使用 UPSTREAM_* 的全局值
+class EndpointTimeouts:
+    def __init__(self, endpoint, connect, read, first_byte, idle):
+        self.endpoint = endpoint
+        self.connect = connect
+        self.read = read
+        self.first_byte = first_byte
+        self.idle = idle
+
+    @property
+    def requests_timeout(self):
+        return self.connect, self.read
+
+
+def load_endpoint_timeouts(endpoint, prefix):
+    read = float(get_env_value(f'{prefix}_READ_TIMEOUT', UPSTREAM_READ_TIMEOUT))
+    return EndpointTimeouts(
+        endpoint,
+        connect=float(get_env_value(f'{prefix}_CONNECT_TIMEOUT', UPSTREAM_CONNECT_TIMEOUT)),
+        read=read,
+        first_byte=float(get_env_value(f'{prefix}_FIRST_BYTE_TIMEOUT', read)),
+        idle=float(get_env_value(f'{prefix}_IDLE_TIMEOUT', read)),
+    )
+
+
+CHAT_TIMEOUTS = load_endpoint_timeouts('chat_send', 'CHAT')
+CHANNEL_TIMEOUTS = load_endpoint_timeouts('get_channel', 'CHANNEL')
+IMAGE_UPLOAD_TIMEOUTS = load_endpoint_timeouts('image_upload', 'IMAGE_UPLOAD')
+
+# 一次补全（含重试、对冲和整个流式输出）的总时长上限
+COMPLETION_DEADLINE = float(get_env_value('COMPLETION_DEADLINE', 300))
+
+
+class UpstreamTimeout(Exception):
+    def __init__(self, endpoint, kind, seconds):
+        super().__init__(f"Upstream {endpoint} timed out ({kind}) after {seconds:g} seconds")
+        self.endpoint = endpoint
+        self.kind = kind
+        self.seconds = seconds
+
+
+class Deadline:
+    def __init__(self, seconds=COMPLETION_DEADLINE):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, endpoint):
+        if self.expired():
+            raise timed_out(endpoint, 'deadline', self.seconds)
+
+    def limit(self, kind, seconds):
+        # 取单次等待上限与剩余总时长中较小的一个，返回 (超时类型, 秒数)
+        remaining = self.remaining()
+        if remaining < seconds:
+            return 'deadline', max(remaining, 0)
+        return kind, seconds
+
+
+def timed_out(endpoint, kind, seconds):
+    UPSTREAM_TIMEOUTS_TOTAL.inc(endpoint, kind)
+    return UpstreamTimeout(endpoint, kind, seconds)
@@ -0,0 +1,123 @@
+import asyncio
+import queue
+import threading
+
+
+# 对冲请求：当前尝试在 delay 秒内没有结果时再并行发起一个尝试，某个尝试失败时立即发起下一个，
+# 最多 max_attempts 个。取最先成功的结果，其余尝试的结果交给 discard 关闭
+class HedgedCall:
+    def __init__(self, executor, delay, max_attempts, on_hedge=None):
+        self.executor = executor
+        self.delay = delay
+        self.max_attempts = max_attempts
+        self.on_hedge = on_hedge
+
+    def run(self, attempt, discard):
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {'done': False}
+
+        def target(index):
+            try:
+                result = attempt(index)
+            except Exception as e:
+                results.put((False, e))
+                return
+            with lock:
+                finished = state['done']
+                if not finished:
+                    results.put((True, result))
+            # 已经有赢家时，晚到的结果直接丢弃
+            if finished:
+                discard(result)
+
+        launched = 0
+        pending = 0
+
+        def launch(trigger=None):
+            nonlocal launched, pending
+            if trigger is not None:
+                self._hedged(trigger)
+            self.executor.submit(target, launched)
+            launched += 1
+            pending += 1
+
+        launch()
+        last_error = None
+        while pending:
+            try:
+                ok, value = results.get(timeout=self.delay if launched < self.max_attempts else None)
+            except queue.Empty:
+                launch('delay')
+                continue
+            pending -= 1
+            if ok:
+                with lock:
+                    state['done'] = True
+                # 标记完成前已经入队的结果同样需要丢弃
+                while True:
+                    try:
+                        other_ok, other = results.get_nowait()
+                    except queue.Empty:
+                        break
+                    if other_ok:
+                        discard(other)
+                return value
+            last_error = value
+            if launched < self.max_attempts:
+                launch('error')
+        raise last_error
+
+    def _hedged(self, trigger):
+        if self.on_hedge is not None:
+            self.on_hedge(trigger)
+
+
+# HedgedCall 的协程版本，供 ASGI 模式使用：落败的尝试直接取消
+class AsyncHedgedCall:
+    def __init__(self, delay, max_attempts, on_hedge=None):
+        self.delay = delay
+        self.max_attempts = max_attempts
+        self.on_hedge = on_hedge
+
+    async def run(self, attempt, discard):
+        tasks = set()
+        launched = 0
+
+        def launch(trigger=None):
+            nonlocal launched
+            if trigger is not None:
+                self._hedged(trigger)
+            tasks.add(asyncio.ensure_future(attempt(launched)))
+            launched += 1
+
+        launch()
+        last_error = None
+        winner = None
+        try:
+            while tasks and winner is None:
+                done, _ = await asyncio.wait(tasks, timeout=self.delay if launched < self.max_attempts else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch('delay')
+                    continue
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        await discard(task.result())
+                if winner is None and launched < self.max_attempts:
+                    launch('error')
+        finally:
+            for task in tasks:
+                task.cancel()
+        if winner is None:
+            raise last_error
+        return winner.result()
+
+    def _hedged(self, trigger):
+        if self.on_hedge is not None:
+            self.on_hedge(trigger)
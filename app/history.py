@@ -0,0 +1,170 @@
+import threading
+from collections import OrderedDict
+
+from app.config import get_env_value
+from app.metrics import PROMPT_TOKENS
+
+SUMMARY_HEADER = "Earlier conversation (abridged):\n"
+
+
+def estimate_tokens(text):
+    # 本地近似，按字符类别计数：ASCII 约 4 个字符一个 token，西里尔、希腊等 2 字节 UTF-8 字符约 2 个字符一个 token，
+    # 中日韩等 3 字节字符约 1 个字符一个 token，emoji 等 4 字节字符约 2 个 token。
+    # 纯 ASCII 字符串的判断是 O(1) 的；含非 ASCII 字符时用三次 C 层编码解出各类字符数，不逐字符遍历
+    if text.isascii():
+        return len(text) // 4 + 1
+    length = len(text)
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    four_byte = len(text.encode('utf-16-le')) // 2 - length
+    rest = length - ascii_chars - four_byte
+    three_byte = len(text.encode('utf-8')) - ascii_chars - 4 * four_byte - 2 * rest
+    two_byte = rest - three_byte
+    return (ascii_chars + 2 * two_byte) // 4 + three_byte + 2 * four_byte + 1
+
+
+def truncate_to_tokens(text, tokens):
+    # 截取估算不超过 tokens 的最长前缀，末尾加省略号；每个字符至少 1/4 个 token，只需在前 4 * tokens 个字符里二分
+    if estimate_tokens(text) <= tokens:
+        return text
+    low, high = 0, min(len(text), 4 * tokens)
+    while low < high:
+        middle = (low + high + 1) // 2
+        # 省略号本身算 1 个 token
+        if estimate_tokens(text[:middle]) < tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + '…' if low else ''
+
+
+# 按 token 预算压缩历史：保留第一条用户消息（含 system 设定）和最后一条用户消息，
+# 两者合计超出预算时截断第一条消息；最后一条是当前的问题，始终完整保留，它单独超出预算时 prompt 也会超出。
+# 其余预算从最近的轮次往前填充；放不下的较早轮次可以折叠为摘要（每轮截取开头一段），
+# 摘要按会话缓存并增量追加，长会话每轮只需处理新折叠的消息
+class HistoryCompactor:
+    def __init__(self, budget, content_of, include_assistant=False, summary_budget=0, summary_turn_chars=200,
+                 cache_entries=10000):
+        self.budget = budget
+        self.content_of = content_of
+        self.include_assistant = include_assistant
+        self.summary_budget = summary_budget
+        self.summary_turn_chars = summary_turn_chars
+        self.cache_entries = cache_entries
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _turn(self, message):
+        role = message.get('role')
+        if role == 'user':
+            return self.content_of(message.get('content'))
+        if role == 'assistant' and self.include_assistant:
+            content = self.content_of(message.get('content'))
+            return f"Assistant: {content}" if content else None
+        return None
+
+    def build(self, messages, first_index, first_user_message, conversation_key):
+        last_index = len(messages) - 1
+        while last_index > first_index and not (messages[last_index].get('role') == 'user'
+                                                 and self.content_of(messages[last_index].get('content'))):
+            last_index -= 1
+        final_content = self.content_of(messages[last_index].get('content')) if last_index > first_index \
+            else first_user_message
+        if last_index == first_index:
+            PROMPT_TOKENS.observe(estimate_tokens(final_content))
+            return final_content
+
+        final_tokens = estimate_tokens(final_content)
+        used = estimate_tokens(first_user_message) + final_tokens
+        if used > self.budget:
+            # 固定部分超出预算：丢弃中间轮次，第一条消息截断到剩余预算（开头的 system 设定优先保留）
+            first = truncate_to_tokens(first_user_message, self.budget - final_tokens)
+            if not first:
+                PROMPT_TOKENS.observe(final_tokens)
+                return final_content
+            PROMPT_TOKENS.observe(estimate_tokens(first) + final_tokens)
+            return first + '\n' + final_content
+        # 固定部分之外放不下摘要预留的预算时不生成摘要
+        with_summary = self.summary_budget and used + self.summary_budget <= self.budget
+        remaining = self.budget - used - (self.summary_budget if with_summary else 0)
+        recent = []
+        folded_end = first_index + 1
+        for index in range(last_index - 1, first_index, -1):
+            content = self._turn(messages[index])
+            if not content:
+                continue
+            tokens = estimate_tokens(content)
+            if tokens > remaining:
+                folded_end = index + 1
+                break
+            remaining -= tokens
+            used += tokens
+            recent.append(content)
+
+        parts = [first_user_message, ' \n']
+        if with_summary and folded_end > first_index + 1:
+            summary = self._summary(messages, first_index + 1, folded_end, conversation_key)
+            if summary:
+                parts.append(summary)
+                parts.append(' \n')
+                used += estimate_tokens(summary)
+        for content in reversed(recent):
+            parts.append(content)
+            parts.append(' \n')
+        parts[-1] = '\n'
+        parts.append(final_content)
+        PROMPT_TOKENS.observe(used)
+        return ''.join(parts)
+
+    def _summary_line(self, message):
+        content = self.content_of(message.get('content'))
+        if not content or message.get('role') not in ('user', 'assistant'):
+            return None
+        if len(content) > self.summary_turn_chars:
+            content = content[:self.summary_turn_chars] + '…'
+        return f"{'User' if message.get('role') == 'user' else 'Assistant'}: {content}"
+
+    def _summary(self, messages, start, end, conversation_key):
+        with self._lock:
+            cached = self._summaries.get(conversation_key)
+        lines = None
+        if cached is not None:
+            cached_end, cached_lines, cached_last = cached
+            # 缓存覆盖到 cached_end 之前的消息；客户端修改过历史时重新生成
+            if start < cached_end <= end and self._summary_line(messages[cached_end - 1]) == cached_last:
+                lines = list(cached_lines)
+                start = cached_end
+        if lines is None:
+            lines = []
+        for index in range(start, end):
+            line = self._summary_line(messages[index])
+            if line:
+                lines.append(line)
+        # 摘要本身（含标题）也受预算限制，只保留最近的部分
+        total = estimate_tokens(SUMMARY_HEADER)
+        keep = len(lines)
+        while keep > 0 and total + estimate_tokens(lines[keep - 1]) <= self.summary_budget:
+            keep -= 1
+            total += estimate_tokens(lines[keep])
+        lines = lines[keep:]
+        with self._lock:
+            self._summaries[conversation_key] = (end, lines, self._summary_line(messages[end - 1]))
+            self._summaries.move_to_end(conversation_key)
+            while len(self._summaries) > self.cache_entries:
+                self._summaries.popitem(last=False)
+        if not lines:
+            return None
+        return SUMMARY_HEADER + '\n'.join(lines)
+
+
+def create_history_compactor(content_of):
+    budget = int(get_env_value('HISTORY_TOKEN_BUDGET', 0))
+    if budget <= 0:
+        return None
+    return HistoryCompactor(
+        budget,
+        content_of,
+        include_assistant=get_env_value('HISTORY_INCLUDE_ASSISTANT', 'false').lower() == 'true',
+        summary_budget=int(get_env_value('HISTORY_SUMMARY_TOKENS', 0)),
+        summary_turn_chars=int(get_env_value('HISTORY_SUMMARY_TURN_CHARS', 200)),
+        cache_entries=int(get_env_value('HISTORY_SUMMARY_CACHE_ENTRIES', 10000)),
+    )
@@ -0,0 +1,153 @@
+import io
+import logging
+import os
+
+import requests
+
+from app.config import get_env_value
+from app.metrics import IMAGE_UPLOAD_BYTES_TOTAL
+
+# 图片托管后端，统一接口：upload(digest, image_type, image_data) -> 公网可访问的 URL。
+# IMAGE_HOST 选择后端：telegraph（默认）/ local / s3
+
+IMAGE_MIME_TYPES = {'jpeg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif', 'webp': 'image/webp',
+                    'bmp': 'image/bmp'}
+
+
+class TelegraphImageHost:
+    def __init__(self, upload_url, post):
+        # upload_url 可以指向本地的模拟服务，离线压测上传链路
+        self.upload_url = upload_url
+        self.base_url = upload_url.rsplit('/', 1)[0]
+        self.post = post
+
+    def upload(self, digest, image_type, image_data):
+        try:
+            files = {'file': (f'image.{image_type}', image_data, IMAGE_MIME_TYPES[image_type])}
+            response = self.post(self.upload_url, files=files)
+            response.raise_for_status()
+            json_response = response.json()
+            if isinstance(json_response, list) and 'src' in json_response[0]:
+                return self.base_url + json_response[0]['src']
+            else:
+                raise ValueError(f"Unexpected response format: {json_response}")
+
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to upload image. Error: {e}")
+        except Exception as e:
+            raise Exception(f"Failed to upload image. An error occurred: {e}")
+
+
+# 写入本地目录，由本服务的 /images/<name> 路由对外提供；IMAGE_PUBLIC_BASE_URL 需要是 popai 能访问到的地址
+class LocalImageHost:
+    def __init__(self, directory, public_base_url):
+        self.directory = directory
+        self.public_base_url = public_base_url.rstrip('/')
+        os.makedirs(directory, exist_ok=True)
+
+    def upload(self, digest, image_type, image_data):
+        name = f"{digest}.{image_type}"
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(image_data)
+            os.replace(tmp_path, path)
+        return f"{self.public_base_url}/{name}"
+
+
+# S3 兼容对象存储（AWS S3 / MinIO / R2 等），凭证使用 boto3 的标准环境变量
+class S3ImageHost:
+    def __init__(self, bucket, public_base_url, prefix='', endpoint_url=None):
+        import boto3
+        self.client = boto3.client('s3', endpoint_url=endpoint_url or None)
+        self.bucket = bucket
+        self.public_base_url = public_base_url.rstrip('/')
+        self.prefix = prefix
+
+    def upload(self, digest, image_type, image_data):
+        key = f"{self.prefix}{digest}.{image_type}"
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=image_data,
+                                   ContentType=IMAGE_MIME_TYPES[image_type])
+        except Exception as e:
+            raise Exception(f"Failed to upload image. An error occurred: {e}")
+        return f"{self.public_base_url}/{key}"
+
+
+# 上传前按需缩小并重新压缩：超过 threshold 字节的图片把长边缩到 max_dimension 以内，
+# 不透明图片转为 JPEG，带透明通道的保持 PNG。依赖 Pillow，未安装时原样上传
+class ImageDownscaler:
+    def __init__(self, threshold, max_dimension, jpeg_quality):
+        self.threshold = threshold
+        self.max_dimension = max_dimension
+        self.jpeg_quality = jpeg_quality
+        try:
+            from PIL import Image
+            self.image_module = Image
+        except ImportError:
+            self.image_module = None
+            if threshold:
+                logging.warning("Pillow is not installed, images are uploaded without downscaling")
+
+    def process(self, image_type, image_data):
+        # GIF 可能是动图，不处理
+        if not self.threshold or self.image_module is None or len(image_data) <= self.threshold \
+                or image_type == 'gif':
+            return image_type, image_data
+        try:
+            with self.image_module.open(io.BytesIO(image_data)) as image:
+                image.thumbnail((self.max_dimension, self.max_dimension))
+                output = io.BytesIO()
+                if 'A' in image.getbands() or 'transparency' in image.info:
+                    image.save(output, format='PNG', optimize=True)
+                    new_type = 'png'
+                else:
+                    image.convert('RGB').save(output, format='JPEG', quality=self.jpeg_quality, optimize=True)
+                    new_type = 'jpeg'
+        except Exception as e:
+            logging.warning(f"Failed to downscale image, uploading original: {e}")
+            return image_type, image_data
+        if output.tell() >= len(image_data):
+            return image_type, image_data
+        return new_type, output.getvalue()
+
+
+class ProcessingImageHost:
+    def __init__(self, host, downscaler):
+        self.host = host
+        self.downscaler = downscaler
+
+    def upload(self, digest, image_type, image_data):
+        IMAGE_UPLOAD_BYTES_TOTAL.inc('original', amount=len(image_data))
+        image_type, image_data = self.downscaler.process(image_type, image_data)
+        IMAGE_UPLOAD_BYTES_TOTAL.inc('uploaded', amount=len(image_data))
+        return self.host.upload(digest, image_type, image_data)
+
+
+IMAGE_HOST = get_env_value('IMAGE_HOST', 'telegraph').lower()
+LOCAL_IMAGE_DIR = get_env_value('IMAGE_LOCAL_DIR', 'images')
+
+
+def create_image_host(post):
+    backend = IMAGE_HOST
+    if backend == 'local':
+        host = LocalImageHost(LOCAL_IMAGE_DIR,
+                              get_env_value('IMAGE_PUBLIC_BASE_URL', 'http://127.0.0.1:3000/images'))
+    elif backend == 's3':
+        # 缺少必填配置时启动即报错，而不是在导入阶段抛出难以理解的异常或在第一次上传时才失败
+        missing = [key for key in ('IMAGE_S3_BUCKET', 'IMAGE_PUBLIC_BASE_URL') if not get_env_value(key)]
+        if missing:
+            raise ValueError(f"IMAGE_HOST=s3 requires {' and '.join(missing)} to be set")
+        host = S3ImageHost(get_env_value('IMAGE_S3_BUCKET'), get_env_value('IMAGE_PUBLIC_BASE_URL'),
+                           prefix=get_env_value('IMAGE_S3_PREFIX', ''),
+                           endpoint_url=get_env_value('IMAGE_S3_ENDPOINT_URL'))
+    else:
+        host = TelegraphImageHost(get_env_value('IMAGE_TELEGRAPH_UPLOAD_URL', 'https://telegra.ph/upload'), post)
+    downscaler = ImageDownscaler(
+        threshold=int(get_env_value('IMAGE_DOWNSCALE_THRESHOLD', 0)),
+        max_dimension=int(get_env_value('IMAGE_MAX_DIMENSION', 2048)),
+        jpeg_quality=int(get_env_value('IMAGE_JPEG_QUALITY', 85)),
+    )
+    logging.info("Image host: %s", backend)
+    return ProcessingImageHost(host, downscaler)
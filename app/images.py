@@ -0,0 +1,139 @@
+import base64
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import CACHE_BACKEND, get_env_value
+from app.image_hosts import create_image_host
+from app.metrics import IMAGE_UPLOAD_CACHE_TOTAL, IMAGE_UPLOAD_SECONDS
+from app.singleflight import SingleFlight
+
+# 每次解码的 base64 字符数，必须是 4 的倍数
+BASE64_CHUNK_CHARS = 64 * 1024
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+)
+
+
+def sniff_image_type(header):
+    # 根据文件头识别图片类型（替代已废弃的 imghdr）
+    for signature, image_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_type
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def decode_base64_image(data_url):
+    # 分块解码 data URL：不对整个字符串做 split/strip 复制，摘要和图片类型在解码过程中顺带计算
+    start = data_url.find(',') + 1 if data_url.startswith('data:') else 0
+    digest = hashlib.sha256()
+    output = io.BytesIO()
+    image_type = None
+    leftover = ''
+    for offset in range(start, len(data_url), BASE64_CHUNK_CHARS):
+        # 去掉换行等空白后按 4 字符对齐，余下的字符留到下一块
+        chunk = leftover + ''.join(data_url[offset:offset + BASE64_CHUNK_CHARS].split())
+        aligned = len(chunk) - len(chunk) % 4
+        leftover = chunk[aligned:]
+        decoded = base64.b64decode(chunk[:aligned], validate=True)
+        if image_type is None and decoded:
+            image_type = sniff_image_type(decoded[:16])
+            if image_type is None:
+                raise ValueError("Invalid image data")
+        digest.update(decoded)
+        output.write(decoded)
+    if leftover:
+        raise ValueError("Invalid base64 image data")
+    if image_type is None:
+        raise ValueError("Invalid image data")
+    return digest.hexdigest(), image_type, output.getvalue()
+
+
+# 图片摘要 -> 已上传 URL 的缓存，按 LRU + TTL 淘汰
+class ImageUrlCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            url, expiry = entry
+            if expiry <= time.time():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return url
+
+    def set(self, digest, url):
+        with self._lock:
+            self._entries[digest] = (url, time.time() + self.ttl)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def create_image_url_cache():
+    ttl = int(get_env_value('IMAGE_CACHE_TTL', 86400))
+    if CACHE_BACKEND == 'redis':
+        from app.cache_backend import RedisImageUrlCache, get_redis_client, get_key_prefix
+        return RedisImageUrlCache(get_redis_client(), ttl, get_key_prefix())
+    return ImageUrlCache(ttl, int(get_env_value('IMAGE_CACHE_MAX_ENTRIES', 10000)))
+
+
+# 上传 base64 图片并按内容摘要缓存结果：客户端每轮都会重发完整历史，同一张图片只上传一次。
+# 同一请求中的多张图片并行上传，相同图片的并发上传合并为一次
+class ImageUploader:
+    def __init__(self, host, cache, executor):
+        self.host = host
+        self.cache = cache
+        self.executor = executor
+        self._flight = SingleFlight()
+
+    def upload_base64(self, data_url):
+        try:
+            digest, image_type, image_data = decode_base64_image(data_url)
+        except ValueError as e:
+            raise Exception(f"Failed to upload image. An error occurred: {e}")
+        url = self.cache.get(digest)
+        if url:
+            IMAGE_UPLOAD_CACHE_TOTAL.inc('hit')
+            return url
+        IMAGE_UPLOAD_CACHE_TOTAL.inc('miss')
+        return self._flight.do(digest, self._upload_and_cache, digest, image_type, image_data)
+
+    def _upload_and_cache(self, digest, image_type, image_data):
+        url = self.cache.get(digest)
+        if url:
+            return url
+        started_at = time.perf_counter()
+        url = self.host.upload(digest, image_type, image_data)
+        IMAGE_UPLOAD_SECONDS.observe(time.perf_counter() - started_at)
+        self.cache.set(digest, url)
+        return url
+
+    def upload_all(self, data_urls):
+        if len(data_urls) == 1:
+            return [self.upload_base64(data_urls[0])]
+        futures = [self.executor.submit(self.upload_base64, data_url) for data_url in data_urls]
+        return [future.result() for future in futures]
+
+
+def create_image_uploader(post):
+    executor = ThreadPoolExecutor(max_workers=int(get_env_value('IMAGE_UPLOAD_WORKERS', 4)),
+                                  thread_name_prefix='image-upload')
+    return ImageUploader(create_image_host(post), create_image_url_cache(), executor)
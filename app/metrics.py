@@ -0,0 +1,328 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlparse
+
+from app.config import get_env_value, proxy_pool
+
+# 轻量的 Prometheus 文本格式指标，不依赖 prometheus_client。
+# METRICS_ENABLED=false 时所有记录方法直接返回，请求热路径上不产生额外分配
+METRICS_ENABLED = get_env_value('METRICS_ENABLED', 'true').lower() == 'true'
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+REGISTRY = []
+
+# 多进程部署时 master 设置 METRICS_MULTIPROCESS_DIR：每个 worker 定期把自己的指标写入该目录，
+# 抓取 /metrics 时合并所有 worker 的数据，计数器和直方图跨进程累加，gauge 按 worker（pid）分别输出
+METRICS_DIR = get_env_value('METRICS_MULTIPROCESS_DIR')
+METRICS_FLUSH_INTERVAL = float(get_env_value('METRICS_FLUSH_INTERVAL', 5))
+
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return value
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def collect(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self, items=None, labelnames=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in (self.collect() if items is None else items):
+            lines.extend(self._render_value(labels, value, labelnames or self.labelnames))
+        return lines
+
+    def render_merged(self, snapshots):
+        # snapshots: [(pid, alive, [(labels, value), ...])]，同一组标签的值跨进程累加
+        merged = {}
+        for _, _, items in snapshots:
+            for labels, value in items:
+                merged[labels] = value if labels not in merged else self._add(merged[labels], value)
+        return self.render(list(merged.items()))
+
+    def _add(self, total, value):
+        return total + value
+
+    def _render_value(self, labels, value, labelnames):
+        return [f"{self.name}{_format_labels(labelnames, labels)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, *labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function):
+        # 抓取时才计算取值，返回 {labels: value}
+        self._function = function
+
+    def collect(self):
+        if self._function is not None:
+            try:
+                values = self._function()
+            except Exception:
+                values = {}
+            with self._lock:
+                self._values = dict(values)
+        return super().collect()
+
+    def render_merged(self, snapshots):
+        # 瞬时值不能累加，按 worker 分别输出；已退出的 worker 不再输出
+        items = [(labels + (str(pid),), value) for pid, alive, values in snapshots if alive
+                 for labels, value in values]
+        return self.render(items, self.labelnames + ('worker',))
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self):
+        with self._lock:
+            return [(labels, [list(counts), total, count]) for labels, (counts, total, count) in self._values.items()]
+
+    def _add(self, total, value):
+        return [[a + b for a, b in zip(total[0], value[0])], total[1] + value[1], total[2] + value[2]]
+
+    def _render_value(self, labels, value, labelnames):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(labelnames, labels, ('le', bound))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(labelnames, labels, ('le', '+Inf'))} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(labelnames, labels)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(labelnames, labels)} {count}")
+        return lines
+
+
+# 由其他进程提供的指标（多进程部署时 gtoken 相关指标只存在于 sidecar 中）：(指标列表, 返回指标文本的函数)
+_remote_metrics = ((), None)
+
+
+def set_remote_metrics(metrics, fetch):
+    global _remote_metrics
+    _remote_metrics = (tuple(metrics), fetch)
+
+
+def _local_metrics():
+    remote = _remote_metrics[0]
+    return [metric for metric in REGISTRY if metric not in remote]
+
+
+def write_snapshot(directory=None):
+    directory = directory or METRICS_DIR
+    snapshot = {metric.name: [[list(labels), value] for labels, value in metric.collect()]
+                for metric in _local_metrics()}
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(snapshot, file)
+    os.replace(tmp_path, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_snapshots(directory=None):
+    # 先写入本进程的最新数据，其他 worker 的数据最多落后 METRICS_FLUSH_INTERVAL 秒
+    directory = directory or METRICS_DIR
+    write_snapshot(directory)
+    snapshots = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        pid = int(name[:-len('.json')])
+        try:
+            with open(os.path.join(directory, name), encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            continue
+        snapshots.append((pid, _pid_alive(pid), data))
+    return snapshots
+
+
+def render_metrics(metrics=None):
+    lines = []
+    if metrics is not None:
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+    snapshots = read_snapshots() if METRICS_DIR else None
+    for metric in _local_metrics():
+        if snapshots is None:
+            lines.extend(metric.render())
+            continue
+        lines.extend(metric.render_merged(
+            [(pid, alive, [(tuple(labels), value) for labels, value in data.get(metric.name, ())])
+             for pid, alive, data in snapshots]))
+    metrics_text = '\n'.join(lines) + '\n'
+    fetch = _remote_metrics[1]
+    if fetch is not None:
+        metrics_text += fetch() or ''
+    return metrics_text
+
+
+def _snapshot_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            write_snapshot()
+        except Exception as e:
+            logging.warning(f"Failed to write metrics snapshot: {e}")
+
+
+def proxy_label(proxies):
+    # 指标标签中只保留代理的 host:port，去掉账号密码
+    if not proxies:
+        return 'direct'
+    parsed = urlparse(proxies.get('https') or proxies.get('http'))
+    return f"{parsed.hostname}:{parsed.port}" if parsed.port else str(parsed.hostname)
+
+
+UPSTREAM_CHANNEL_SECONDS = Histogram(
+    'popai_upstream_get_channel_seconds', 'Latency of upstream getChannel calls.')
+CHAT_FIRST_BYTE_SECONDS = Histogram(
+    'popai_chat_first_byte_seconds', 'Time from chat/send request to the first upstream SSE bytes.')
+CHAT_DURATION_SECONDS = Histogram(
+    'popai_chat_duration_seconds', 'Total duration of upstream chat/send responses.')
+CHAT_SSE_CHUNKS = Histogram(
+    'popai_chat_sse_chunks', 'Upstream SSE messages per chat/send response.', buckets=COUNT_BUCKETS)
+UPSTREAM_TIMEOUTS_TOTAL = Counter(
+    'popai_upstream_timeouts_total', 'Upstream calls and streams aborted by timeout by endpoint and kind.',
+    ('endpoint', 'kind'))
+PROMPT_TOKENS = Histogram(
+    'popai_prompt_tokens', 'Estimated tokens of the prompt sent to chat/send after history compaction.',
+    buckets=TOKEN_BUCKETS)
+CHAT_RETRIES_TOTAL = Counter(
+    'popai_chat_retries_total', 'chat/send retries by reason.', ('reason',))
+CHAT_HEDGES_TOTAL = Counter(
+    'popai_chat_hedged_attempts_total', 'Extra chat/send attempts started by hedging by trigger.', ('trigger',))
+GTOKEN_REJECTED_TOTAL = Counter(
+    'popai_gtoken_rejected_total', 'chat/send attempts rejected with error code 60001.')
+RESPONSE_CACHE_TOTAL = Counter(
+    'popai_response_cache_total', 'Completion response cache lookups and stores by result.', ('result',))
+RESPONSE_CACHE_STATE = Gauge(
+    'popai_response_cache_state', 'Completion response cache size (entries, bytes).', ('value',))
+CHANNEL_CACHE_TOTAL = Counter(
+    'popai_channel_cache_requests_total', 'Channel cache lookups in get_channel_id by result.', ('result',))
+IMAGE_UPLOAD_CACHE_TOTAL = Counter(
+    'popai_image_upload_cache_requests_total', 'Uploaded image URL cache lookups by result.', ('result',))
+IMAGE_UPLOAD_BYTES_TOTAL = Counter(
+    'popai_image_upload_bytes_total', 'Image bytes before (original) and after (uploaded) downscaling.', ('stage',))
+IMAGE_UPLOAD_SECONDS = Histogram(
+    'popai_image_upload_seconds', 'Latency of uploading one image to the image host.')
+TOKEN_POOL_SIZE = Gauge(
+    'popai_gtoken_pool_size', 'Number of gtokens currently in the pool.')
+TOKEN_FORECAST = Gauge(
+    'popai_gtoken_forecast', 'Token refill forecast (target pool size, seconds to empty, acquire rate).', ('value',))
+TOKEN_MINT_SECONDS = Histogram(
+    'popai_gtoken_mint_seconds', 'Latency of minting one gtoken by browser start type.', ('start',))
+TOKEN_MINT_FAILURES_TOTAL = Counter(
+    'popai_gtoken_mint_failures_total', 'Failed gtoken mint attempts.')
+# 只在生成 gtoken 的进程中有数据，多进程部署时由 worker 向 sidecar 获取
+TOKEN_MINTER_METRICS = (TOKEN_FORECAST, TOKEN_MINT_SECONDS, TOKEN_MINT_FAILURES_TOTAL)
+PROXY_REQUESTS_TOTAL = Counter(
+    'popai_proxy_requests_total', 'Upstream requests per proxy by outcome.', ('proxy', 'outcome'))
+ADMISSION_REJECTED_TOTAL = Counter(
+    'popai_admission_rejected_total', 'Completion requests rejected with 429 by reason.', ('reason',))
+ADMISSION_QUEUE_SECONDS = Histogram(
+    'popai_admission_queue_seconds', 'Time completion requests spent waiting in the admission queue.')
+ADMISSION_STATE = Gauge(
+    'popai_admission_state', 'Completion requests currently in flight and queued.', ('value',))
+ACCOUNT_REQUESTS_TOTAL = Counter(
+    'popai_account_requests_total', 'Requests scheduled per AUTHORIZATION account (by index).', ('account',))
+ACCOUNT_STATE = Gauge(
+    'popai_account_state', 'Per-account scheduler state (in-flight streams, cooling down).', ('account', 'value'))
+PROXY_HEALTH = Gauge(
+    'popai_proxy_health', 'Proxy scheduler state (latency EWMA, error rate, open connections, ejected).',
+    ('proxy', 'value'))
+
+
+def proxy_health_metrics():
+    values = {}
+    for url, latency, error_rate, open_connections, ejected in proxy_pool.snapshot():
+        label = proxy_label({'https': url})
+        if latency is not None:
+            values[(label, 'latency_seconds')] = latency
+        values[(label, 'error_rate')] = error_rate
+        values[(label, 'open_connections')] = open_connections
+        values[(label, 'ejected')] = int(ejected)
+    return values
+
+
+PROXY_HEALTH.set_function(proxy_health_metrics)
+
+if METRICS_DIR and METRICS_ENABLED:
+    threading.Thread(target=_snapshot_loop, name='metrics-snapshot', daemon=True).start()
+    # 退出前写入最终数据，已退出 worker 的计数仍计入合计
+    atexit.register(write_snapshot)
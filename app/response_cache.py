@@ -0,0 +1,90 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import get_env_value
+from app.metrics import RESPONSE_CACHE_STATE
+
+# 请求体中影响上游输出的字段，其余字段（stream、temperature 等）popai 不使用，不参与缓存键
+CACHE_KEY_FIELDS = ('model', 'messages', 'prompt')
+# 每个条目除内容外的固定开销估算（键、消息 ID、OrderedDict 节点）
+ENTRY_OVERHEAD_BYTES = 256
+
+
+def response_cache_key(body, api_key, topic):
+    # 规范化请求：按键排序、去掉空白后序列化再取摘要；不同 API key 之间不共享缓存
+    normalized = {field: body.get(field) for field in CACHE_KEY_FIELDS}
+    normalized['api_key'] = api_key
+    normalized['topic'] = topic
+    canonical = json.dumps(normalized, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def bypass_response_cache(headers):
+    # X-Cache-Bypass: 1 或 Cache-Control: no-cache 跳过查找，生成的新结果仍会写入缓存
+    if (headers.get('X-Cache-Bypass') or '').lower() in ('1', 'true'):
+        return True
+    return 'no-cache' in (headers.get('Cache-Control') or '').lower()
+
+
+# 完整补全结果的缓存，条目为 stream_2_json 拼接出的 (message_id, content)，按 TTL 过期，
+# 总字节数超过 max_bytes 时按 LRU 淘汰
+class ResponseCache:
+    def __init__(self, ttl, max_bytes, max_entry_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            message_id, content, size, expiry = entry
+            if expiry <= time.time():
+                del self._entries[key]
+                self.size -= size
+                return None
+            self._entries.move_to_end(key)
+            return message_id, content
+
+    def set(self, key, message_id, content):
+        size = len(content.encode('utf-8')) + ENTRY_OVERHEAD_BYTES
+        if size > self.max_entry_bytes:
+            return False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self._entries[key] = (message_id, content, size, time.time() + self.ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted[2]
+        return True
+
+    def state(self):
+        with self._lock:
+            return len(self._entries), self.size
+
+
+def create_response_cache():
+    ttl = int(get_env_value('RESPONSE_CACHE_TTL', 0))
+    if ttl <= 0:
+        return None
+    max_bytes = int(get_env_value('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    cache = ResponseCache(ttl, max_bytes, int(get_env_value('RESPONSE_CACHE_MAX_ENTRY_BYTES', max_bytes // 16)))
+    logging.info("Response cache: ttl %ds, %d bytes", ttl, max_bytes)
+
+    def response_cache_state_metrics():
+        entries, size = cache.state()
+        return {('entries',): entries, ('bytes',): size}
+
+    RESPONSE_CACHE_STATE.set_function(response_cache_state_metrics)
+    return cache
@@ -1,62 +1,24 @@
 import logging
-from datetime import datetime, timedelta
-import json
-from concurrent.futures import ThreadPoolExecutor
-from flask import request, Response, current_app as app
-
-from app.config import IGNORED_MODEL_NAMES, IMAGE_MODEL_NAMES, AUTH_TOKEN, HISTORY_MSG_LIMIT
-from app.config import configure_logging, get_env_value
-from app.utils import send_chat_message, fetch_channel_id, map_model_name, process_content, get_user_contents, \
-    generate_hash, get_next_auth_token, handle_error, get_request_parameters, get_topic_from_headers
+import os
+from datetime import datetime
+from flask import request, Response, send_from_directory, current_app as app
+
+from app.accounts import account_scheduler
+from app.admission import AdmissionController, AdmissionRejected, create_admission_controller, get_api_key
+from app.config import IGNORED_MODEL_NAMES, IMAGE_MODEL_NAMES
+from app.config import configure_logging
+from app.image_hosts import IMAGE_HOST, LOCAL_IMAGE_DIR
+from app.metrics import CHANNEL_CACHE_TOTAL, METRICS_ENABLED, render_metrics
+from app.singleflight import SingleFlight
+from app.storage import get_cached_channel_id, cache_channel_id
+from app.utils import send_chat_message, fetch_channel_id, generate_hash, handle_error, \
+    parse_chat_request, lookup_cached_response, cached_chat_response
 
 configure_logging()
+channel_flight = SingleFlight()
+admission = create_admission_controller(AdmissionController)
 
 
-# 从文件初始化 storage_map
-def load_storage_map():
-    try:
-        with open('storage_map.json', 'r') as file:
-            return json.load(file, object_hook=json_datetime_parser)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-# 辅助函数，将 JSON 对象转换为 datetime
-def json_datetime_parser(dct):
-    new_dct = {}
-    for key, value in dct.items():
-        if isinstance(value, list) and len(value) == 2:
-            channel_id, expiry_str = value
-            try:
-                expiry_time = datetime.strptime(expiry_str, '%Y-%m-%dT%H:%M:%S.%f')
-                new_dct[key] = (channel_id, expiry_time)
-            except ValueError as e:
-                logging.error(f"Error parsing date: {expiry_str} with error {e}")
-    return new_dct
-
-# 辅助函数，将 datetime 转换为 JSON 可序列化格式
-def json_datetime_converter(obj):
-    if isinstance(obj, datetime):
-        return obj.strftime('%Y-%m-%dT%H:%M:%S.%f')
-    raise TypeError("Type %s not serializable" % type(obj))
-
-# Function to perform the blocking file write operation
-def blocking_file_write(file_path, data):
-    try:
-        with open(file_path, 'w') as file:
-            json.dump(data, file, default=json_datetime_converter)
-    except Exception as e:
-        print(f"Failed to write to file: {e}")
-
-# ThreadPoolExecutor as a context manager to handle the thread pool
-executor = ThreadPoolExecutor(max_workers=2)  # You can adjust max_workers based on your needs
-
-# Function to save the storage map using the thread pool
-def save_storage_map(storage_map):
-    executor.submit(blocking_file_write, 'storage_map.json', storage_map)
-
-# 程序启动时加载 storage_map
-storage_map = load_storage_map()
-
 @app.route("/v1/chat/completions", methods=["GET", "POST", "OPTIONS"])
 def onRequest():
     try:
@@ -79,6 +41,13 @@ def list_models():
     }
 
 
+@app.route('/metrics')
+def metrics():
+    if not METRICS_ENABLED:
+        return Response(status=404)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/v1/images/generations', methods= ["post"])
 def image():
     try:
@@ -89,52 +58,80 @@ def image():
         return handle_error(e)
 
 
+if IMAGE_HOST == 'local':
+    @app.route('/images/<path:name>')
+    def hosted_image(name):
+        return send_from_directory(os.path.abspath(LOCAL_IMAGE_DIR), name)
+
+
 def get_channel_id(hash_value, token, model_name, content, template_id):
-    if hash_value in storage_map:
-        channel_id, expiry_time = storage_map[hash_value]
-        if expiry_time > datetime.now() and channel_id:
-            logging.info("Returning channel id from cache")
-            return channel_id
-    channel_id = fetch_channel_id(token, model_name, content, template_id)
-    expiry_time = datetime.now() + timedelta(days=int(get_env_value('EXPIRED_DAYS', '1')))
-    storage_map[hash_value] = (channel_id, expiry_time)
-    save_storage_map(storage_map)  # 保存更新到文件
+    channel_id = get_cached_channel_id(hash_value)
+    if channel_id:
+        logging.info("Returning channel id from cache")
+        CHANNEL_CACHE_TOTAL.inc('hit')
+        return channel_id
+    CHANNEL_CACHE_TOTAL.inc('miss')
+    # 同一会话的并发请求只向上游获取一次 channel，其余请求等待并复用结果
+    return channel_flight.do(hash_value, fetch_and_cache_channel_id, hash_value, token, model_name, content,
+                             template_id)
+
+
+def fetch_and_cache_channel_id(hash_value, token, model_name, content, template_id):
+    # 在等待期间可能已有其他请求写入缓存
+    channel_id = get_cached_channel_id(hash_value)
+    if channel_id:
+        return channel_id
+    channel_id = fetch_channel_id(token, model_name, content, template_id, affinity_key=hash_value)
+    cache_channel_id(hash_value, channel_id)
     return channel_id
 
 
 def fetch(req):
     if req.method == "OPTIONS":
         return handle_options_request()
-    token = get_next_auth_token(AUTH_TOKEN)
-    messages, model_name, prompt, user_stream = get_request_parameters(req.get_json())
-    model_to_use = map_model_name(model_name)
-    template_id = 2000000 if model_name in IMAGE_MODEL_NAMES else ''
-
-    if not messages and prompt:
-        final_user_content = prompt
-        first_argument = final_user_content
-        image_url = None
-    elif messages:
-        last_message = messages[-1]
-        first_user_message, end_user_message, concatenated_messages, user_messages_list = get_user_contents(messages, HISTORY_MSG_LIMIT)
-        final_user_content = user_messages_list[-1]
-        user_text, image_url = process_content(last_message.get('content'))
-        final_user_content = concatenated_messages + '\n' + final_user_content if concatenated_messages else final_user_content
-
-        topic = get_topic_from_headers(req.headers)
-        if topic is not None and len(topic) > 0:
-            first_argument = topic
-        else:
-            first_argument = first_user_message
-        # hash_value = generate_hash(first_argument, model_to_use, token)
+    # 缓存命中时直接返回，不经过准入控制，也不占用账号和 gtoken
+    cache_key, cached = lookup_cached_response(req.get_json(), req.headers)
+    if cached is not None:
+        resp = app.make_response(cached_chat_response(cached, req.get_json()))
+        resp.headers['X-Cache'] = 'HIT'
+        return resp
+    try:
+        admission.acquire(get_api_key(req.headers))
+    except AdmissionRejected as e:
+        logging.warning("Request rejected: %s", e)
+        return handle_error(e)
+    token = None
+    try:
+        token = account_scheduler.acquire()
+        resp = app.make_response(fetch_with_account(req, token, cache_key))
+    except BaseException:
+        release_request(token)
+        raise
+    if cache_key is not None:
+        resp.headers['X-Cache'] = 'MISS'
+    # 流式响应在发送完成后才释放准入名额和账号的在途计数
+    resp.call_on_close(lambda: release_request(token))
+    return resp
 
-    hash_value = generate_hash(first_argument, model_to_use, token)
-    channel_id = get_channel_id(hash_value, token, model_to_use, final_user_content, template_id)
+
+def release_request(token):
+    if token is not None:
+        account_scheduler.release(token)
+    admission.release()
+
+
+def fetch_with_account(req, token, cache_key=None):
+    model_name, model_to_use, template_id, final_user_content, first_argument, image_url, user_stream = \
+        parse_chat_request(req.get_json(), req.headers)
 
     if final_user_content is None:
         return Response("No user message found", status=400)
 
-    return send_chat_message(req, token, channel_id, final_user_content, model_to_use, user_stream, image_url, model_name)
+    hash_value = generate_hash(first_argument, model_to_use, token)
+    channel_id = get_channel_id(hash_value, token, model_to_use, final_user_content, template_id)
+
+    return send_chat_message(req, token, channel_id, final_user_content, model_to_use, user_stream, image_url, model_name,
+                             affinity_key=hash_value, cache_key=cache_key)
 
 
 def handle_options_request():
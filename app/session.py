@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.config import get_env_value
+
+
+# 按 (proxy, host) 维护长连接 Session，在 Flask 各工作线程间复用
+class SessionPool:
+    def __init__(self, pool_connections=10, pool_maxsize=50, idle_timeout=300, pool_block=False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self.pool_block = pool_block
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _create_session(self, proxy_url):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=self.pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if proxy_url:
+            session.proxies = {'http': proxy_url, 'https': proxy_url}
+        # 代理由连接池显式指定，不读取系统环境变量中的代理
+        session.trust_env = False
+        return session
+
+    def _checkout(self, url, proxies):
+        proxy_url = None
+        if proxies:
+            proxy_url = proxies.get('https') if url.startswith('https') else proxies.get('http')
+        key = (proxy_url, urlparse(url).netloc)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._sessions.get(key)
+            if entry is None:
+                # [session, 最后使用时间, 在途请求数]
+                entry = [self._create_session(proxy_url), now, 0]
+                self._sessions[key] = entry
+                logging.debug("Created pooled session for host %s", key[1])
+            entry[1] = now
+            entry[2] += 1
+            return entry
+
+    def _checkin(self, entry):
+        with self._lock:
+            entry[1] = time.monotonic()
+            entry[2] -= 1
+
+    def post(self, url, proxies=None, stream=False, **kwargs):
+        entry = self._checkout(url, proxies)
+        try:
+            response = entry[0].post(url, stream=stream, **kwargs)
+        except BaseException:
+            self._checkin(entry)
+            raise
+        if not stream:
+            self._checkin(entry)
+            return response
+        # 流式响应读完之前连接一直被占用，关闭时才归还，空闲回收不能关掉正在读的 Session
+        lease = [entry]
+        close = response.close
+
+        def close_and_checkin():
+            try:
+                return close()
+            finally:
+                if lease:
+                    self._checkin(lease.pop())
+
+        response.close = close_and_checkin
+        return response
+
+    def _evict_idle(self, now):
+        if not self.idle_timeout:
+            return
+        expired = [key for key, (_, last_used, in_flight) in self._sessions.items()
+                   if not in_flight and now - last_used > self.idle_timeout]
+        for key in expired:
+            session, _, _ = self._sessions.pop(key)
+            session.close()
+
+    def close(self):
+        with self._lock:
+            for session, _, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+session_pool = SessionPool(
+    pool_connections=int(get_env_value('HTTP_POOL_CONNECTIONS', 10)),
+    pool_maxsize=int(get_env_value('HTTP_POOL_MAXSIZE', 50)),
+    idle_timeout=float(get_env_value('HTTP_POOL_IDLE_TIMEOUT', 300)),
+    pool_block=str(get_env_value('HTTP_POOL_BLOCK', 'false')).lower() == 'true',
+)
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# 合并同一个 key 的并发调用：只有第一个调用者真正执行，其余调用者等待并共享其结果（或异常）
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except BaseException as e:
+            # 领头线程被中断（如 GeneratorExit）时等待者不能拿到 None 当作结果
+            call.error = e if isinstance(e, Exception) else Exception(f"Coalesced call was interrupted: {e!r}")
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+# SingleFlight 的协程版本，供 ASGI 模式使用（同一事件循环内无需加锁）
+class AsyncSingleFlight:
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args):
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # 等待者自身被取消
+                    raise
+                # 领头的请求被取消（客户端断开、对冲落败），由等待者重新发起
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn(*args)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # 没有等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        except BaseException:
+            # 包括 CancelledError：必须让 future 结束，否则等待者会一直挂起
+            future.cancel()
+            raise
+        finally:
+            del self._calls[key]
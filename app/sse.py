@@ -0,0 +1,52 @@
+import json
+import logging
+
+EVENT_DELIMITER = b"\n\n"
+DATA_PREFIX = b"data:"
+
+
+# 增量 SSE 解析器：在 bytearray 上按字节查找事件分隔符，并记录扫描位置，
+# 避免每来一个 chunk 就重新扫描、复制整个缓冲区。
+# 分隔符是 ASCII，在字节层面切分事件不会截断多字节 UTF-8 字符。
+class SSEParser:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scan_from = 0
+
+    def feed(self, chunk):
+        buffer = self._buffer
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(EVENT_DELIMITER, max(self._scan_from, start))
+            if end < 0:
+                break
+            if buffer.startswith(DATA_PREFIX, start, end):
+                yield bytes(buffer[start + len(DATA_PREFIX):end]).strip()
+            start = end + len(EVENT_DELIMITER)
+            self._scan_from = start
+        if start:
+            # 从头部删除 bytearray 是摊还 O(1) 的，不会复制剩余数据
+            del buffer[:start]
+        # 分隔符可能跨 chunk，下次从倒数第一个字节开始查找
+        self._scan_from = max(len(buffer) - len(EVENT_DELIMITER) + 1, 0)
+
+
+# 将 popai 的 SSE 流解码为消息：第一个 data 事件是元信息，跳过；之后每个事件是消息数组
+class PopaiMessageDecoder:
+    def __init__(self):
+        self.parser = SSEParser()
+        self.event_count = 0
+
+    def feed(self, chunk):
+        for payload in self.parser.feed(chunk):
+            self.event_count += 1
+            if self.event_count == 1:
+                continue
+            try:
+                # json.loads 直接接受 UTF-8 字节，无需先解码为 str
+                chunk_json = json.loads(payload)
+            except json.JSONDecodeError as e:
+                logging.error(f"Failed to parse JSON: {e}")
+                continue
+            yield from chunk_json
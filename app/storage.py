@@ -0,0 +1,197 @@
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from app.config import CACHE_BACKEND, get_env_value
+
+LEGACY_STORAGE_MAP_PATH = 'storage_map.json'
+
+
+# 会话 hash -> channel_id 缓存：内存中按 LRU + TTL 淘汰，变更累积后由后台线程批量写入 SQLite。
+# SQLite 使用 WAL 日志，每批写入是一个事务，进程崩溃也不会留下写了一半的文件。
+# shared=True（多 worker 进程共用同一个 SQLite 文件）时新 channel 立即写入，内存未命中时回读 SQLite，
+# 同一会话的后续请求落到其他 worker 上也能找到 channel
+class ChannelStore:
+    def __init__(self, path, ttl, max_entries, flush_interval, shared=False):
+        self.ttl = ttl
+        self.shared = shared
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._last_sweep = time.time()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS channels '
+                         '(hash TEXT PRIMARY KEY, channel_id TEXT NOT NULL, expiry REAL NOT NULL)')
+        self._db.commit()
+        self._load()
+
+        self._flusher = threading.Thread(target=self._flush_loop, name='channel-store-flusher', daemon=True)
+        self._flusher.start()
+
+    def _load(self):
+        now = time.time()
+        with self._flush_lock:
+            self._db.execute('DELETE FROM channels WHERE expiry <= ?', (now,))
+            self._db.commit()
+            rows = self._db.execute('SELECT hash, channel_id, expiry FROM channels ORDER BY expiry').fetchall()
+        if not rows:
+            rows = self._load_legacy_storage_map(now)
+        for hash_value, channel_id, expiry in rows[-self.max_entries:]:
+            self._entries[hash_value] = (channel_id, expiry)
+        logging.info("Loaded %d channel ids from cache", len(self._entries))
+
+    def _load_legacy_storage_map(self, now):
+        # 兼容旧版本的 storage_map.json，首次启动时导入仍有效的记录
+        try:
+            with open(LEGACY_STORAGE_MAP_PATH, 'r') as file:
+                legacy = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+        rows = []
+        for hash_value, value in legacy.items():
+            try:
+                channel_id, expiry_str = value
+                expiry = datetime.strptime(expiry_str, '%Y-%m-%dT%H:%M:%S.%f').timestamp()
+            except (TypeError, ValueError) as e:
+                logging.error(f"Error parsing storage_map entry {hash_value}: {e}")
+                continue
+            if channel_id and expiry > now:
+                rows.append((hash_value, channel_id, expiry))
+                self._dirty[hash_value] = (channel_id, expiry)
+        rows.sort(key=lambda row: row[2])
+        self._flush_event.set()
+        return rows
+
+    def get(self, hash_value):
+        with self._lock:
+            entry = self._entries.get(hash_value)
+            if entry is not None:
+                channel_id, expiry = entry
+                if expiry > time.time():
+                    self._entries.move_to_end(hash_value)
+                    return channel_id
+                del self._entries[hash_value]
+                self._forget(hash_value)
+        if self.shared:
+            return self._read_through(hash_value)
+        return None
+
+    def _forget(self, hash_value):
+        # 调用方持有锁。共享模式下其他 worker 可能刚刷新过这条记录，SQLite 中的过期记录改由 _sweep_expired 按时间删除
+        if not self.shared:
+            self._dirty[hash_value] = None
+
+    def _read_through(self, hash_value):
+        try:
+            with self._flush_lock:
+                row = self._db.execute('SELECT channel_id, expiry FROM channels WHERE hash = ?',
+                                       (hash_value,)).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to read channel store: {e}")
+            return None
+        if row is None or row[1] <= time.time():
+            return None
+        with self._lock:
+            # 期间本进程可能已写入更新的记录
+            channel_id, _ = self._entries.setdefault(hash_value, tuple(row))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return channel_id
+
+    def set(self, hash_value, channel_id):
+        expiry = time.time() + self.ttl
+        with self._lock:
+            self._entries[hash_value] = (channel_id, expiry)
+            self._entries.move_to_end(hash_value)
+            self._dirty[hash_value] = (channel_id, expiry)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._forget(evicted)
+        if self.shared:
+            self.flush()
+        self._flush_event.set()
+
+    def _sweep_expired(self, now):
+        with self._lock:
+            expired = [key for key, (_, expiry) in self._entries.items() if expiry <= now]
+            for key in expired:
+                del self._entries[key]
+                self._forget(key)
+        if self.shared:
+            try:
+                with self._flush_lock, self._db:
+                    self._db.execute('DELETE FROM channels WHERE expiry <= ?', (now,))
+            except sqlite3.Error as e:
+                logging.error(f"Failed to sweep channel store: {e}")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            upserts = [(key, value[0], value[1]) for key, value in dirty.items() if value is not None]
+            deletes = [(key,) for key, value in dirty.items() if value is None]
+            try:
+                with self._db:
+                    self._db.executemany('INSERT OR REPLACE INTO channels (hash, channel_id, expiry) VALUES (?, ?, ?)',
+                                         upserts)
+                    self._db.executemany('DELETE FROM channels WHERE hash = ?', deletes)
+            except sqlite3.Error as e:
+                logging.error(f"Failed to flush channel store: {e}")
+                # 写入失败时把变更放回去，等待下一次重试（不覆盖期间的新变更）
+                with self._lock:
+                    for key, value in dirty.items():
+                        self._dirty.setdefault(key, value)
+
+    def _flush_loop(self):
+        while True:
+            self._flush_event.wait()
+            # 防抖：等待一个周期，把这段时间内的变更合并为一次写入
+            time.sleep(self.flush_interval)
+            self._flush_event.clear()
+            now = time.time()
+            if now - self._last_sweep > 60:
+                self._sweep_expired(now)
+                self._last_sweep = now
+            self.flush()
+
+
+def create_channel_store():
+    ttl = int(get_env_value('EXPIRED_DAYS', '1')) * 86400
+    if CACHE_BACKEND == 'redis':
+        from app.cache_backend import RedisChannelStore, get_redis_client, get_key_prefix
+        return RedisChannelStore(get_redis_client(), ttl, get_key_prefix())
+    return ChannelStore(
+        get_env_value('STORAGE_DB_PATH', 'storage_map.db'),
+        ttl=ttl,
+        max_entries=int(get_env_value('CHANNEL_CACHE_MAX_ENTRIES', 100000)),
+        flush_interval=float(get_env_value('CHANNEL_CACHE_FLUSH_INTERVAL', 1.0)),
+        # gunicorn 多 worker 时各进程共用同一个 SQLite 文件
+        shared=int(get_env_value('WORKERS', 1)) > 1,
+    )
+
+
+channel_store = create_channel_store()
+atexit.register(channel_store.flush)
+
+
+def get_cached_channel_id(hash_value):
+    return channel_store.get(hash_value)
+
+
+def cache_channel_id(hash_value, channel_id):
+    if channel_id:
+        channel_store.set(hash_value, channel_id)
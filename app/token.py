@@ -1,124 +1,351 @@
+import json
+import os
 import time
 import threading
-import schedule
 import undetected_chromedriver as uc
 from pyvirtualdisplay import Display
 import logging
+import queue
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from app.config import POPAI_BASE_URL, get_env_value
+from app.config import POPAI_BASE_URL, CACHE_BACKEND, get_env_value
 from app.config import proxy_pool
+from app.metrics import TOKEN_FORECAST, TOKEN_MINT_FAILURES_TOTAL, TOKEN_MINT_SECONDS, TOKEN_MINTER_METRICS, \
+    TOKEN_POOL_SIZE, set_remote_metrics
+
+# 每个 gtoken 可用的次数
+USES_PER_TOKEN = 4
+
 
 class Token:
-    def __init__(self, value):
+    def __init__(self, value, created_at=None, use_count=0):
         self.value = value
-        self.created_at = datetime.now()
-        self.use_count = 0
+        self.created_at = created_at or datetime.now()
+        self.use_count = use_count
+        self.removed = False
 
     def is_valid(self):
-        return self.use_count <= 3 and (datetime.now() - self.created_at) < timedelta(hours=1)
+        return not self.removed and self.use_count < USES_PER_TOKEN \
+            and (datetime.now() - self.created_at) < timedelta(hours=1)
 
     def get_lifetime(self):
         return datetime.now() - self.created_at
 
+
+# 统计 gtoken 消耗速率（按秒分桶的滑动窗口），预测池子耗尽时间并给出目标池大小
+class ConsumptionForecaster:
+    def __init__(self, floor, ceiling, horizon, windows=(60, 300, 900)):
+        self.floor = floor
+        self.ceiling = max(ceiling, floor)
+        self.horizon = horizon
+        self.windows = windows
+        self.buckets = deque()
+        self.mint_latency = None
+        self.minted_total = 0
+        self.mint_failures = 0
+        self._lock = threading.Lock()
+
+    def record_acquire(self):
+        now = int(time.monotonic())
+        with self._lock:
+            if self.buckets and self.buckets[-1][0] == now:
+                self.buckets[-1][1] += 1
+            else:
+                self.buckets.append([now, 1])
+            while self.buckets and self.buckets[0][0] <= now - self.windows[-1]:
+                self.buckets.popleft()
+
+    def record_mint(self, minted, failed, seconds):
+        with self._lock:
+            self.minted_total += minted
+            self.mint_failures += failed
+            # 单轮生成耗时的 EWMA，用作补充的提前量
+            self.mint_latency = seconds if self.mint_latency is None else 0.8 * self.mint_latency + 0.2 * seconds
+
+    def rates(self):
+        now = int(time.monotonic())
+        with self._lock:
+            buckets = list(self.buckets)
+        return {window: sum(count for second, count in buckets if second > now - window) / window
+                for window in self.windows}
+
+    def demand_rate(self):
+        # 取各窗口中的最大速率：短窗口对突发敏感，长窗口让高峰后的目标缓慢回落
+        return max(self.rates().values())
+
+    def time_to_empty(self, valid_tokens):
+        rate = self.rates()[self.windows[0]]
+        if rate <= 0:
+            return float('inf')
+        return valid_tokens * USES_PER_TOKEN / rate
+
+    def target_pool_size(self, valid_tokens):
+        demand = self.demand_rate()
+        target = demand * self.horizon / USES_PER_TOKEN
+        # 预计在一轮生成完成前就会耗尽时，按生成耗时内的消耗量额外补充
+        if self.mint_latency and self.time_to_empty(valid_tokens) < self.mint_latency * 2:
+            target = max(target, valid_tokens + demand * self.mint_latency * 2 / USES_PER_TOKEN)
+        return int(min(max(target, self.floor), self.ceiling))
+
+    def stats(self, valid_tokens):
+        return {
+            "valid_tokens": valid_tokens,
+            "acquire_rate": self.rates(),
+            "target_pool_size": self.target_pool_size(valid_tokens),
+            "time_to_empty": self.time_to_empty(valid_tokens),
+            "mint_latency": self.mint_latency,
+            "minted_total": self.minted_total,
+            "mint_failures": self.mint_failures,
+        }
+
+
+# tokens 维护轮转顺序，_tokens_by_value 支持按值 O(1) 查找/删除；
+# 删除只打标记，队列中的失效 token 在轮转到时顺带丢弃
 class TokenManager:
-    def __init__(self, min_valid_tokens=50):
+    def __init__(self, min_valid_tokens=50, max_valid_tokens=200, forecast_horizon=300):
         self.tokens = deque()
+        self._tokens_by_value = {}
+        self._lock = threading.Lock()
         self.min_valid_tokens = min_valid_tokens
+        self.forecaster = ConsumptionForecaster(min_valid_tokens, max_valid_tokens, forecast_horizon)
+        # 池子不足时唤醒补充线程，请求线程本身从不等待 token
+        self.refill_event = threading.Event()
 
-    def add_token(self, token_value):
-        self.tokens.append(Token(token_value))
+    def __len__(self):
+        # 无锁读取：dict 长度读取是原子的，供监控与补充逻辑粗略判断
+        return len(self._tokens_by_value)
+
+    def add_token(self, token_value, created_at=None, use_count=0):
+        with self._lock:
+            if token_value in self._tokens_by_value:
+                return
+            token = Token(token_value, created_at, use_count)
+            self._tokens_by_value[token_value] = token
+            self.tokens.append(token)
+
+    def snapshot(self):
+        with self._lock:
+            return [(token.value, token.created_at.timestamp(), token.use_count)
+                    for token in self._tokens_by_value.values() if token.is_valid()]
 
     def get_token(self):
-        while self.tokens and not self.tokens[0].is_valid():
-            self.tokens.popleft()
-        
-        if not self.tokens:
+        token_value = self._acquire()
+        self.forecaster.record_acquire()
+        if token_value is None or len(self) < self.min_valid_tokens:
+            self.refill_event.set()
+        return token_value
+
+    def _acquire(self):
+        with self._lock:
+            while self.tokens:
+                token = self.tokens.popleft()
+                if not token.is_valid():
+                    self._discard(token)
+                    continue
+                token.use_count += 1
+                # 轮转：仍可用的 token 放回队尾，请求均匀分摊到各个 token 上
+                if token.is_valid():
+                    self.tokens.append(token)
+                else:
+                    self._discard(token)
+                return token.value
             return None
-        
-        token = self.tokens[0]
-        token.use_count += 1
-        return token.value
+
+    def _discard(self, token):
+        if self._tokens_by_value.get(token.value) is token:
+            del self._tokens_by_value[token.value]
 
     def count_valid_tokens(self):
-        return sum(1 for token in self.tokens if token.is_valid())
+        with self._lock:
+            return sum(1 for token in self._tokens_by_value.values() if token.is_valid())
 
     def remove_invalid_tokens(self):
-        invalid_tokens = [token for token in self.tokens if not token.is_valid()]
+        with self._lock:
+            invalid_tokens = [token for token in self._tokens_by_value.values() if not token.is_valid()]
+            for token in invalid_tokens:
+                del self._tokens_by_value[token.value]
+            # 顺带清理队列中已被标记删除的 token
+            self.tokens = deque(token for token in self.tokens if token.is_valid())
+
         for token in invalid_tokens:
             lifetime = token.get_lifetime()
             print(f"Removing token: value = {token.value}, use count = {token.use_count}, "
                   f"lifetime = {lifetime.total_seconds():.2f} seconds")
-        
-        self.tokens = deque(token for token in self.tokens if token.is_valid())
+
+    def try_acquire_minter(self):
+        # 进程内 token 池只有本进程生成 token
+        return True
 
     def remove_token(self, token_value):
-        original_length = len(self.tokens)
-        self.tokens = deque(token for token in self.tokens if token.value != token_value)
-        removed = len(self.tokens) < original_length
-        if removed:
+        with self._lock:
+            token = self._tokens_by_value.pop(token_value, None)
+            if token is not None:
+                token.removed = True
+        if token is not None:
             print(f"one token has been removed.")
         else:
             print(f"Token with value {token_value} was not found.")
-        return removed
+        return token is not None
 
-class TokenManagerThread(threading.Thread):
+# gtoken 本地持久化：每轮补充后整体写入临时文件再原子替换，重启时加载仍在有效期内的 token。
+# 只在补充线程中读写，不阻塞请求线程
+class TokenStore:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, token_manager):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to load token store {self.path}: {e}")
+            return 0
+        for value, created_at, use_count in entries:
+            token_manager.add_token(value, datetime.fromtimestamp(created_at), use_count)
+        # 加载后统一剔除已过期或用尽的 token
+        token_manager.remove_invalid_tokens()
+        return len(token_manager)
+
+    def save(self, token_manager):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(token_manager.snapshot(), f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Failed to save token store {self.path}: {e}")
+
+
+# 按冷启动（新开浏览器）/热启动（复用已有浏览器）分别统计单次生成 gtoken 的耗时
+class MintLatency:
     def __init__(self):
-        threading.Thread.__init__(self)
-        self.token_manager = TokenManager()
-        self.driver = None
-        self.display = None
-        self.running = True
+        self.samples = {'cold': [0, 0.0], 'warm': [0, 0.0]}
+        self._lock = threading.Lock()
 
-    def run(self):
-        # 启动后立即获取一次 gtoken
-        self.immediate_job()
+    def record(self, kind, seconds):
+        TOKEN_MINT_SECONDS.observe(seconds, kind)
+        with self._lock:
+            sample = self.samples[kind]
+            sample[0] += 1
+            sample[1] += seconds
 
-        def scheduled_job():
-            self.immediate_job()
+    def stats(self):
+        with self._lock:
+            return {kind: {"count": count, "avg_seconds": total / count if count else None}
+                    for kind, (count, total) in self.samples.items()}
 
-        schedule.every(10).seconds.do(scheduled_job)
 
-        while self.running:
-            schedule.run_pending()
-            time.sleep(1)
+def _process_tree_rss_mb(root_pid):
+    # 通过 /proc 汇总浏览器主进程及其所有子进程（渲染进程等）的常驻内存
+    children = {}
+    rss_kb = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/status') as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        pid = int(entry)
+        children.setdefault(int(status.get('PPid', '0').strip()), []).append(pid)
+        rss_kb[pid] = int(status.get('VmRSS', '0 kB').split()[0])
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += rss_kb.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total / 1024
 
-    def immediate_job(self):
-        self.token_manager.remove_invalid_tokens()
-        valid_tokens = self.token_manager.count_valid_tokens()
-        
-        if valid_tokens < self.token_manager.min_valid_tokens:
-            if self.driver is None:
-                self.driver, self.display = self.setup_browser()
-            gtoken = self.get_gtoken(self.driver)
-            if gtoken:
-                self.token_manager.add_token(gtoken)
-            else:
-                print("Failed to get token. Closing current window.")
-                self.close_browser()
-        
-        print(f"Current valid token count: {valid_tokens}")
-        
-        if valid_tokens >= self.token_manager.min_valid_tokens:
-            print("Valid token count is sufficient, closing browser to save memory")
+
+# 单个浏览器 worker：各自持有一个 Chrome 实例和代理，并发生成 gtoken。
+# 浏览器在两次生成之间保持热启动状态，定期换新标签页而不是重启整个进程
+class BrowserWorker:
+    # undetected_chromedriver 启动时会修补 chromedriver 文件，多个实例并发启动需要串行化
+    _launch_lock = threading.Lock()
+
+    def __init__(self, worker_id, latency, tab_recycle_mints=20):
+        self.worker_id = worker_id
+        self.latency = latency
+        self.tab_recycle_mints = tab_recycle_mints
+        self.driver = None
+        self.proxies = None
+        self.mints_on_tab = 0
+        self.consecutive_failures = 0
+        self.last_used = 0
+
+    def mint(self):
+        cold = self.driver is None
+        start = time.monotonic()
+        if cold:
+            self.driver = self.setup_browser()
+            self.mints_on_tab = 0
+        elif self.mints_on_tab >= self.tab_recycle_mints:
+            self.recycle_tab()
+        gtoken = self.get_gtoken(self.driver)
+        self.last_used = time.monotonic()
+        # 生成结果同样反馈给代理池的健康评分（生成耗时与请求延迟不可比，不计入延迟）
+        proxy_pool.record(self.proxies, bool(gtoken))
+
+        if gtoken:
+            self.mints_on_tab += 1
+            self.consecutive_failures = 0
+            self.latency.record('cold' if cold else 'warm', self.last_used - start)
+        elif cold or self.consecutive_failures >= 1:
+            logging.warning(f"[worker {self.worker_id}] Failed to get token. Closing current window.")
             self.close_browser()
+        else:
+            # 热浏览器首次失败先换一个新标签页重试，连续失败才重启进程
+            logging.warning(f"[worker {self.worker_id}] Failed to get token. Recycling tab.")
+            self.consecutive_failures += 1
+            self.mints_on_tab = self.tab_recycle_mints
+        return gtoken
 
-    def setup_browser(self):
-        display = Display(visible=0, size=(1280, 720), backend="xvfb")
-        display.start()
+    def recycle_tab(self):
+        old_handle = self.driver.current_window_handle
+        self.driver.switch_to.new_window('tab')
+        new_handle = self.driver.current_window_handle
+        self.driver.get(POPAI_BASE_URL)
+        self.driver.switch_to.window(old_handle)
+        self.driver.close()
+        self.driver.switch_to.window(new_handle)
+        self.mints_on_tab = 0
+
+    def memory_mb(self):
+        browser_pid = getattr(self.driver, 'browser_pid', None)
+        if not browser_pid:
+            return 0
+        try:
+            return _process_tree_rss_mb(browser_pid)
+        except OSError:
+            return 0
 
+    def setup_browser(self):
         options = uc.ChromeOptions()
         options.add_argument('--disable-gpu')
         options.add_argument('--no-sandbox')
         options.add_argument('--disable-dev-shm-usage')
-        
-        proxies = proxy_pool.get_random_proxy()
-        if 'https' in proxies and '@' not in proxies['https']:
-            options.add_argument(f"--proxy-server={proxies['https']}")
 
-        driver = uc.Chrome(options=options)
-        driver.get(POPAI_BASE_URL)
-        return driver, display
+        # 每个 worker 启动时各自从代理池按健康评分取一个代理，浏览器关闭时归还
+        self.proxies = proxy_pool.get_proxy()
+        if self.proxies and 'https' in self.proxies and '@' not in self.proxies['https']:
+            options.add_argument(f"--proxy-server={self.proxies['https']}")
+
+        driver = None
+        try:
+            with self._launch_lock:
+                driver = uc.Chrome(options=options)
+            driver.get(POPAI_BASE_URL)
+        except Exception:
+            # 启动失败同样计入代理健康状态，否则半开代理的探测标记永远不会清除
+            proxy_pool.record(self.proxies, False)
+            if driver is not None:
+                driver.quit()
+            raise
+        return driver
 
     def get_gtoken(self, driver):
         try:
@@ -129,20 +356,187 @@ class TokenManagerThread(threading.Thread):
             # print(f"Got new GToken: {gtoken}")
             return gtoken
         except Exception as e:
-            logging.error(f"An error occurred while getting GToken: {e}")
+            logging.error(f"[worker {self.worker_id}] An error occurred while getting GToken: {e}")
             return None
 
     def close_browser(self):
         if self.driver:
-            self.driver.quit()
+            try:
+                self.driver.quit()
+            except Exception as e:
+                logging.error(f"[worker {self.worker_id}] An error occurred while closing browser: {e}")
             self.driver = None
+        if self.proxies:
+            proxy_pool.release(self.proxies)
+            self.proxies = None
+        self.consecutive_failures = 0
+
+
+def create_token_manager():
+    options = dict(min_valid_tokens=int(get_env_value('MIN_VALID_TOKENS', 50)),
+                   max_valid_tokens=int(get_env_value('MAX_VALID_TOKENS', 200)),
+                   forecast_horizon=int(get_env_value('TOKEN_FORECAST_HORIZON', 300)))
+    if CACHE_BACKEND == 'redis':
+        from app.cache_backend import RedisTokenPool, get_redis_client, get_key_prefix
+        return RedisTokenPool(get_redis_client(), get_key_prefix(), **options)
+    return TokenManager(**options)
+
+
+def create_token_store():
+    # Redis 中的 token 池本身就是持久的，各副本不再各自把共享池快照到本地文件，
+    # 否则重启时会把已用尽或被拒的 token 重新加回共享池
+    if CACHE_BACKEND == 'redis':
+        return None
+    return TokenStore(get_env_value('GTOKEN_STORE_PATH', 'gtokens.json'))
+
+
+class TokenManagerThread(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.token_manager = create_token_manager()
+        self.worker_count = max(int(get_env_value('GTOKEN_WORKERS', 1)), 1)
+        self.warm_workers = int(get_env_value('BROWSER_WARM_WORKERS', 1))
+        self.browser_idle_ttl = float(get_env_value('BROWSER_IDLE_TTL', 600))
+        self.browser_max_memory_mb = float(get_env_value('BROWSER_MAX_MEMORY_MB', 1024))
+        self.mint_latency = MintLatency()
+        tab_recycle_mints = int(get_env_value('BROWSER_TAB_RECYCLE_MINTS', 20))
+        self.workers = [BrowserWorker(i, self.mint_latency, tab_recycle_mints) for i in range(self.worker_count)]
+        self.idle_workers = queue.Queue()
+        for worker in self.workers:
+            self.idle_workers.put(worker)
+        self.executor = ThreadPoolExecutor(max_workers=self.worker_count, thread_name_prefix='gtoken-worker')
+        self.display = None
+        self.token_store = create_token_store()
+        # 一轮生成一个 token 都没拿到时按指数退避，避免故障期间反复重启浏览器
+        self.mint_backoff = float(get_env_value('GTOKEN_MINT_BACKOFF', 10))
+        self.mint_backoff_max = float(get_env_value('GTOKEN_MINT_BACKOFF_MAX', 300))
+        self.failed_mint_rounds = 0
+        self.running = True
+
+    def run(self):
+        if self.token_store is not None:
+            loaded = self.token_store.load(self.token_manager)
+            logging.info(f"Loaded {loaded} valid tokens from {self.token_store.path}")
+        # 启动后立即获取一次 gtoken，之后按预测的耗尽时间自适应调整检查间隔，
+        # 池子不足时由 get_token 通过 refill_event 提前唤醒
+        refill_event = self.token_manager.refill_event
+        while self.running:
+            self.immediate_job()
+            if self.token_store is not None:
+                self.token_store.save(self.token_manager)
+            if self.failed_mint_rounds:
+                self.wait_backoff()
+                continue
+            refill_event.wait(self.next_check_interval())
+            refill_event.clear()
+
+    def wait_backoff(self):
+        # 退避期间忽略 get_token 的补充唤醒，只有 stop() 能提前结束等待
+        backoff = min(self.mint_backoff * 2 ** (self.failed_mint_rounds - 1), self.mint_backoff_max)
+        logging.warning("No gtoken minted in %d round(s), retrying in %.0f seconds", self.failed_mint_rounds, backoff)
+        refill_event = self.token_manager.refill_event
+        deadline = time.monotonic() + backoff
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            refill_event.wait(remaining)
+            refill_event.clear()
+
+    def next_check_interval(self):
+        time_to_empty = self.token_manager.forecaster.time_to_empty(len(self.token_manager))
+        return min(max(time_to_empty / 4, 1), 10)
+
+    def immediate_job(self):
+        if not self.token_manager.try_acquire_minter():
+            # 共享 token 池由其他副本负责生成，本副本不启动浏览器
+            self.release_idle_browsers()
+            return
+        self.token_manager.remove_invalid_tokens()
+        valid_tokens = self.token_manager.count_valid_tokens()
+        forecaster = self.token_manager.forecaster
+        target = forecaster.target_pool_size(valid_tokens)
+
+        while self.running and valid_tokens < target and self.token_manager.try_acquire_minter():
+            batch = min(self.worker_count, target - valid_tokens)
+            minted = self.mint_tokens(batch)
+            if not minted:
+                self.failed_mint_rounds += 1
+                break
+            self.failed_mint_rounds = 0
+            valid_tokens = self.token_manager.count_valid_tokens()
+            target = forecaster.target_pool_size(valid_tokens)
+
+        print(f"Current valid token count: {valid_tokens}")
+        logging.info("Token forecast: %s, mint latency: %s", forecaster.stats(valid_tokens), self.mint_latency.stats())
+
+        if valid_tokens >= target:
+            self.failed_mint_rounds = 0
+            logging.info("Valid token count is sufficient, releasing idle browsers to save memory")
+        self.release_idle_browsers()
+
+    def mint_tokens(self, batch):
+        if self.display is None:
+            # 所有 Chrome 实例共用一个虚拟显示器
+            self.display = Display(visible=0, size=(1280, 720), backend="xvfb")
+            self.display.start()
+        start = time.monotonic()
+        futures = [self.executor.submit(self.mint_with_idle_worker) for _ in range(batch)]
+        minted = 0
+        for future in futures:
+            gtoken = future.result()
+            if gtoken:
+                self.token_manager.add_token(gtoken)
+                minted += 1
+        self.token_manager.forecaster.record_mint(minted, batch - minted, time.monotonic() - start)
+        if minted < batch:
+            TOKEN_MINT_FAILURES_TOTAL.inc(amount=batch - minted)
+        return minted
+
+    def mint_with_idle_worker(self):
+        worker = self.idle_workers.get()
+        try:
+            return worker.mint()
+        except Exception as e:
+            logging.error(f"[worker {worker.worker_id}] Failed to mint GToken: {e}")
+            worker.close_browser()
+            return None
+        finally:
+            self.idle_workers.put(worker)
+
+    def release_idle_browsers(self):
+        # 保留最多 warm_workers 个热浏览器，空闲超时或超出内存上限的浏览器关闭
+        now = time.monotonic()
+        warm = 0
+        for worker in self.workers:
+            if worker.driver is None:
+                continue
+            if warm < self.warm_workers and now - worker.last_used < self.browser_idle_ttl \
+                    and worker.memory_mb() < self.browser_max_memory_mb:
+                warm += 1
+                continue
+            worker.close_browser()
+        if warm == 0 and self.display:
+            self.display.stop()
+            self.display = None
+
+    def close_browser(self):
+        for worker in self.workers:
+            worker.close_browser()
         if self.display:
             self.display.stop()
             self.display = None
 
     def stop(self):
         self.running = False
+        self.token_manager.refill_event.set()
+        self.executor.shutdown(wait=True)
         self.close_browser()
+        if self.token_store is not None:
+            self.token_store.save(self.token_manager)
+
+    def __len__(self):
+        return len(self.token_manager)
 
     def get_token(self):
         return self.token_manager.get_token()
@@ -150,4 +544,38 @@ class TokenManagerThread(threading.Thread):
     def remove_token(self, token_value):
         return self.token_manager.remove_token(token_value)
 
-token_manager_thread = TokenManagerThread()
\ No newline at end of file
+token_manager_thread = TokenManagerThread()
+
+
+def create_token_provider():
+    # 多进程部署时 worker 通过 TOKEN_SOCKET 向 sidecar 进程获取 token
+    socket_path = get_env_value('TOKEN_SOCKET')
+    if socket_path:
+        from app.token_ipc import TokenClient
+        return TokenClient(socket_path)
+    return token_manager_thread
+
+
+token_provider = create_token_provider()
+
+
+def token_forecast_metrics():
+    token_manager = token_manager_thread.token_manager
+    stats = token_manager.forecaster.stats(len(token_manager))
+    values = {
+        ('target_pool_size',): stats['target_pool_size'],
+        ('time_to_empty_seconds',): stats['time_to_empty'],
+        ('minted_total',): stats['minted_total'],
+    }
+    for window, rate in stats['acquire_rate'].items():
+        values[(f'acquire_rate_{window}s',)] = rate
+    return values
+
+
+TOKEN_POOL_SIZE.set_function(lambda: {(): len(token_provider)})
+if token_provider is token_manager_thread:
+    # 预测数据只存在于生成 token 的进程中
+    TOKEN_FORECAST.set_function(token_forecast_metrics)
+else:
+    # 多进程部署时生成延迟、失败次数和预测数据都在 sidecar 中，抓取时通过 socket 获取
+    set_remote_metrics(TOKEN_MINTER_METRICS, token_provider.metrics)
@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+from app.metrics import TOKEN_MINTER_METRICS, render_metrics
+
+# 多进程部署时由单独的 sidecar 进程生成 gtoken，worker 进程通过 Unix socket 获取。
+# 协议为按行的文本命令：
+#   GET           -> token（无可用 token 时返回空行）
+#   DEL <token>   -> 1 / 0
+#   LEN           -> 当前 token 数量
+#   METRICS       -> gtoken 生成相关指标的文本（JSON 字符串编码为一行）
+
+
+class _TokenRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        token_manager = self.server.token_manager
+        for line in self.rfile:
+            command, _, argument = line.decode('utf-8').rstrip('\n').partition(' ')
+            if command == 'GET':
+                response = token_manager.get_token() or ''
+            elif command == 'DEL':
+                response = '1' if token_manager.remove_token(argument) else '0'
+            elif command == 'LEN':
+                response = str(len(token_manager))
+            elif command == 'METRICS':
+                response = json.dumps(render_metrics(TOKEN_MINTER_METRICS))
+            else:
+                response = ''
+            self.wfile.write(f"{response}\n".encode('utf-8'))
+
+
+class TokenServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, token_manager):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.token_manager = token_manager
+        super().__init__(socket_path, _TokenRequestHandler)
+
+
+# worker 进程中的 token 客户端，接口与 TokenManagerThread 的 get_token/remove_token 一致。
+# 每个线程复用一条连接；sidecar 不可用时直接返回 None，不阻塞请求
+class TokenClient:
+    def __init__(self, socket_path, timeout=2.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+            self._local.conn = None
+
+    def _call(self, command):
+        # 连接可能被 sidecar 重启断开，重连一次
+        for attempt in range(2):
+            try:
+                sock, reader = self._connection()
+                sock.sendall(f"{command}\n".encode('utf-8'))
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError("token sidecar closed the connection")
+                return line.decode('utf-8').rstrip('\n')
+            except OSError as e:
+                self._close()
+                if attempt == 1:
+                    logging.error(f"Token sidecar request failed: {e}")
+        return None
+
+    def __len__(self):
+        return int(self._call('LEN') or 0)
+
+    def get_token(self):
+        return self._call('GET') or None
+
+    def remove_token(self, token_value):
+        return self._call(f"DEL {token_value}") == '1'
+
+    def metrics(self):
+        response = self._call('METRICS')
+        return json.loads(response) if response else None
+
+
+def run_token_sidecar(socket_path):
+    # sidecar 进程自身使用本地 token 池
+    os.environ.pop('TOKEN_SOCKET', None)
+    # sidecar 的指标通过 METRICS 命令由 worker 输出，不参与 worker 之间的合并
+    os.environ.pop('METRICS_MULTIPROCESS_DIR', None)
+    from app.config import configure_logging
+    from app.token import token_manager_thread
+
+    configure_logging()
+    token_manager_thread.start()
+    server = TokenServer(socket_path, token_manager_thread.token_manager)
+    # serve_forever 运行在主线程，shutdown 需要从其他线程调用
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logging.info("Token sidecar listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        token_manager_thread.stop()
+        token_manager_thread.join()
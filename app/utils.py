@@ -1,40 +1,74 @@
-import base64
 import hashlib
-import imghdr
 import json
 import logging
 import os
 import re
-from collections import deque
+import time
+from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 import copy
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import undetected_chromedriver as uc
 from flask import Response, jsonify
 from pyvirtualdisplay import Display
 from requests.exceptions import ProxyError
-
-from app.config import configure_logging, IMAGE_MODEL_NAMES, proxy_pool, get_env_value
-from app.token import token_manager_thread
+from urllib3.exceptions import ReadTimeoutError
+
+from app.accounts import account_scheduler
+from app.admission import AdmissionRejected, get_api_key
+from app.config import configure_logging, IMAGE_MODEL_NAMES, HISTORY_MSG_LIMIT, proxy_pool, get_env_value
+from app.deadline import CHANNEL_TIMEOUTS, CHAT_TIMEOUTS, IMAGE_UPLOAD_TIMEOUTS, Deadline, UpstreamTimeout, timed_out
+from app.hedge import HedgedCall
+from app.history import create_history_compactor
+from app.images import create_image_uploader
+from app.metrics import CHAT_DURATION_SECONDS, CHAT_FIRST_BYTE_SECONDS, CHAT_HEDGES_TOTAL, CHAT_RETRIES_TOTAL, \
+    CHAT_SSE_CHUNKS, GTOKEN_REJECTED_TOTAL, PROXY_REQUESTS_TOTAL, RESPONSE_CACHE_TOTAL, UPSTREAM_CHANNEL_SECONDS, \
+    UPSTREAM_TIMEOUTS_TOTAL, proxy_label
+from app.response_cache import bypass_response_cache, create_response_cache, response_cache_key
+from app.session import session_pool
+from app.sse import PopaiMessageDecoder
+from app.token import token_provider
+
+try:
+    import xxhash
+
+    def conversation_digest(text):
+        return xxhash.xxh3_128_hexdigest(text.encode('utf-8'))
+except ImportError:
+    # 未安装 xxhash 时退回 blake2b，同样比 md5 快
+    def conversation_digest(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
 
 configure_logging()
-current_token_index = 0
 
-def send_chat_message(req, auth_token, channel_id, final_user_content, model_name, user_stream, image_url,
-                      user_model_name):
-    logging.info("Channel ID: %s", channel_id)
-    # logging.info("Final User Content: %s", final_user_content)
-    logging.info("Model Name: %s", model_name)
-    logging.info("Image URL: %s", image_url)
-    logging.info("User stream: %s", user_stream)
-    url = "https://api.popai.pro/api/v1/chat/send"
+CHAT_SEND_URL = "https://api.popai.pro/api/v1/chat/send"
+CHAT_CHANNEL_URL = "https://api.popai.pro/api/v1/chat/getChannel"
+CHAT_MAX_ATTEMPTS = 3
+
+# 对冲模式：chat/send 在 CHAT_HEDGE_DELAY 秒内没有产出首条消息，或者 gtoken 被拒（60001）时，
+# 换一个 gtoken（和代理）并行再发一次，取最先产出有效事件的响应
+CHAT_HEDGE_ENABLED = get_env_value('CHAT_HEDGE_ENABLED', 'false').lower() == 'true'
+CHAT_HEDGE_DELAY = float(get_env_value('CHAT_HEDGE_DELAY', 3))
+chat_hedge = HedgedCall(
+    ThreadPoolExecutor(max_workers=int(get_env_value('CHAT_HEDGE_THREADS', 64)), thread_name_prefix='chat-hedge'),
+    delay=CHAT_HEDGE_DELAY,
+    max_attempts=CHAT_MAX_ATTEMPTS,
+    on_hedge=CHAT_HEDGES_TOTAL.inc,
+) if CHAT_HEDGE_ENABLED else None
+
+# RESPONSE_CACHE_TTL 大于 0 时缓存完全相同请求的补全结果，命中时不占用 gtoken 和账号
+response_cache = create_response_cache()
+
 
-    headers = {
+def build_chat_headers(auth_token):
+    return {
         "Accept": "text/event-stream",
         "Accept-Encoding": "gzip, deflate, br, zstd",
         "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-        "App-Name": "popai-web",        
+        "App-Name": "popai-web",
         "Authorization": auth_token,
         "Content-Type": "application/json",
         "Device-Info": '{"web_id":"Tu2oHIR427H5g7_CCOKAE","baidu_id":"18f2e8b7b429216e54da83"}',
@@ -51,7 +85,9 @@ def send_chat_message(req, auth_token, channel_id, final_user_content, model_nam
         "Cache-Control": "no-cache"
     }
 
-    data = {
+
+def build_chat_data(channel_id, final_user_content, model_name, image_url):
+    return {
         "isGetJson": True,
         "version": "1.3.6",
         "language": "zh-CN",
@@ -72,137 +108,321 @@ def send_chat_message(req, auth_token, channel_id, final_user_content, model_nam
         "docPromptTemplateId": None
     }
 
-    max_retries = 3
-    for attempt in range(max_retries):
-        gtoken = token_manager_thread.get_token()
-        if not gtoken:
-            return Exception(f"No valid token available.")
-        
-        headers["Gtoken"] = gtoken
+
+def build_channel_headers(auth_token):
+    return {
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate, br, zstd",
+        "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+        "App-Name": "popai-web",
+        "Authorization": auth_token,
+        "Content-Type": "application/json",
+        "Device-Info": '{"web_id":"Tu2oHIR427H5g7_CCOKAE","baidu_id":"18f2e8b7b429216e54da83"}',
+        "Language": "en",
+        "Origin": "https://www.popai.pro",
+        "Referer": "https://www.popai.pro/",
+        "Pop-Url": "https://www.popai.pro/creation/All/Image",
+        "Sec-Ch-Ua": '"Not/A)Brand";v="8", "Chromium";v="126", "Google Chrome";v="126"',
+        "Sec-Ch-Ua-Mobile": "?0",
+        "Sec-Ch-Ua-Platform": "macOS",
+        "Sec-Fetch-Dest": "empty",
+        "Sec-Fetch-Mode": "cors",
+        "Sec-Fetch-Site": "same-site",
+        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
+    }
+
+
+def build_channel_data(model_name, content, template_id):
+    return {
+        "model": model_name,
+        "templateId": template_id,
+        "message": content,
+        "language": "English",
+        "fileType": None
+    }
+
+
+def wrap_stream_chunk(message, model_name):
+    return {
+        "id": message.get("messageId", ""),
+        "object": "chat.completion",
+        "created": 0,
+        "model": model_name,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {
+                    "role": "assistant",
+                    "content": message.get("content", "")
+                },
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": 13,
+            "completion_tokens": 7,
+            "total_tokens": 20
+        },
+        "system_fingerprint": None
+    }
+
+
+def wrap_completion(message_id, merged_content, model_name, user_model_name):
+    if user_model_name in IMAGE_MODEL_NAMES:
+        # 如果 model_name 在 IMAGE_MODEL_NAMES 内，转换为包含 URL 的格式
+        return {
+            "created": 0,
+            "data": [
+                {"url": extract_url_from_content(merged_content)}
+            ]
+        }
+    return {
+        "id": message_id,
+        "object": "chat.completion",
+        "created": 0,
+        "model": model_name,
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": merged_content
+                },
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": 13,
+            "completion_tokens": 7,
+            "total_tokens": 20
+        },
+        "system_fingerprint": None
+    }
+
+
+def parse_chat_request(body, headers):
+    messages, model_name, prompt, user_stream = get_request_parameters(body)
+    model_to_use = map_model_name(model_name)
+    template_id = 2000000 if model_name in IMAGE_MODEL_NAMES else ''
+    final_user_content = None
+    first_argument = None
+    image_url = None
+
+    if not messages and prompt:
+        final_user_content = prompt
+        first_argument = final_user_content
+    elif messages:
+        last_message = messages[-1]
+        first_user_message, final_user_content = build_user_prompt(messages, HISTORY_MSG_LIMIT)
+        user_text, image_url = process_content(last_message.get('content'))
+
+        topic = get_topic_from_headers(headers)
+        if topic is not None and len(topic) > 0:
+            first_argument = topic
+        else:
+            first_argument = first_user_message
+
+    return model_name, model_to_use, template_id, final_user_content, first_argument, image_url, user_stream
+
+
+def send_chat_message(req, auth_token, channel_id, final_user_content, model_name, user_stream, image_url,
+                      user_model_name, affinity_key=None, cache_key=None):
+    logging.info("Channel ID: %s", channel_id)
+    # logging.info("Final User Content: %s", final_user_content)
+    logging.info("Model Name: %s", model_name)
+    logging.info("Image URL: %s", image_url)
+    logging.info("User stream: %s", user_stream)
+    url = CHAT_SEND_URL
+    headers = build_chat_headers(auth_token)
+    data = build_chat_data(channel_id, final_user_content, model_name, image_url)
+    # 总时长上限覆盖所有重试、对冲尝试以及整个流式输出
+    deadline = Deadline()
+
+    if chat_hedge is not None:
+        def hedged_attempt(index):
+            # 第一个尝试沿用会话绑定的代理；对冲尝试避开它，否则所有尝试都会落在同一个慢代理或故障代理上
+            if index == 0:
+                return open_chat_stream(url, headers, data, token_provider.get_token(), auth_token, affinity_key,
+                                        deadline)
+            return open_chat_stream(url, headers, data, token_provider.get_token(), auth_token, deadline=deadline,
+                                    avoid_affinity=affinity_key)
+
         try:
-            # logging.info("Using G_TOKEN: %s", headers["Gtoken"])
-            response = request_with_proxy_chat(url, headers, data, True)
+            response, messages = chat_hedge.run(hedged_attempt, close_chat_stream)
+            return build_chat_response(response, messages, model_name, user_stream, user_model_name, cache_key)
+        except Exception as e:
+            logging.error("send_chat_message error: %s", e)
+            return handle_error(e)
 
-            # logging.info("Response headers: %s", response.headers)
+    for attempt in range(CHAT_MAX_ATTEMPTS):
+        gtoken = token_provider.get_token()
+        if not gtoken:
+            return handle_error(Exception(f"No valid token available."))
 
-            # 检查响应头中的错误码
-            if response.headers.get('YJ-X-Content'):
-                raise Exception(f"Popai response error. Error: {response.headers.get('YJ-X-Content')}")
+        try:
+            response, messages = open_chat_stream(url, headers, data, gtoken, auth_token, affinity_key, deadline)
+            return build_chat_response(response, messages, model_name, user_stream, user_model_name, cache_key)
 
-            # 如果响应的内容类型是 'text/event-stream;charset=UTF-8'
-            if response.headers.get('Content-Type') == 'text/event-stream;charset=UTF-8':
-                if not user_stream:
-                    return stream_2_json(response, model_name, user_model_name)
-                return stream_response(response, model_name)
-            else:
-                return stream_2_json(response, model_name, user_model_name)
+        except UpstreamTimeout as e:
+            logging.error("send_chat_message error: %s", e)
+            if e.kind == 'deadline' or attempt == CHAT_MAX_ATTEMPTS - 1:
+                return handle_error(e)
+            CHAT_RETRIES_TOTAL.inc('timeout')
 
         except requests.exceptions.RequestException as e:
             logging.error("send_chat_message error: %s", e)
-            if attempt == max_retries - 1:
+            if attempt == CHAT_MAX_ATTEMPTS - 1:
                 return handle_error(e)
+            CHAT_RETRIES_TOTAL.inc('request_error')
 
         except Exception as e:
             logging.error("send_chat_message error: %s", e)
-            try:
-                if "60001" in str(e):
-                    logging.warning(f"Received 60001 error code on attempt {attempt + 1}. Retrying...")
-                    token_manager_thread.remove_token(gtoken)
-                    continue
-                if attempt == max_retries - 1:
-                    return handle_error(e)
-            except Exception as e:
-                logging.error("Update_gtoken error: %s", e)
+            if "60001" in str(e):
+                logging.warning(f"Received 60001 error code on attempt {attempt + 1}. Retrying...")
+                CHAT_RETRIES_TOTAL.inc('60001')
+                continue
+            if attempt == CHAT_MAX_ATTEMPTS - 1:
                 return handle_error(e)
-    return Exception(f"All attempts to send chat message failed.")
+            CHAT_RETRIES_TOTAL.inc('error')
+    return handle_error(Exception(f"All attempts to send chat message failed."))
+
+
+def open_chat_stream(url, headers, data, gtoken, auth_token, affinity_key=None, deadline=None, avoid_affinity=None):
+    # 发起一次 chat/send 并读到第一条有效消息为止，返回 (response, 从第一条开始的消息迭代器)
+    if not gtoken:
+        raise Exception("No valid token available.")
+    # 对冲模式下多个尝试并行，各自使用独立的请求头
+    headers = dict(headers, Gtoken=gtoken)
+    # logging.info("Using G_TOKEN: %s", headers["Gtoken"])
+    response = request_with_proxy(url, headers, data, True, None, affinity_key, CHAT_TIMEOUTS, deadline,
+                                  avoid_affinity)
+    try:
+        # logging.info("Response headers: %s", response.headers)
+        if response.status_code == 429:
+            account_scheduler.report_failure(auth_token, rate_limited=True)
+            raise Exception("Popai response error. Account rate limited")
+
+        # 检查响应头中的错误码
+        error_code = response.headers.get('YJ-X-Content')
+        if error_code:
+            if "60001" in error_code:
+                GTOKEN_REJECTED_TOTAL.inc()
+                token_provider.remove_token(gtoken)
+            else:
+                account_scheduler.report_failure(auth_token)
+            raise Exception(f"Popai response error. Error: {error_code}")
+
+        messages = handle_http_response(response, CHAT_TIMEOUTS, deadline)
+        first_message = next(messages, None)
+        if first_message is None:
+            account_scheduler.report_failure(auth_token)
+            raise Exception("No data available")
+    except BaseException:
+        response.close()
+        raise
+    account_scheduler.report_success(auth_token)
+    return response, itertools.chain((first_message,), messages)
+
+
+def close_chat_stream(result):
+    response, _ = result
+    response.close()
+
 
+def build_chat_response(response, messages, model_name, user_stream, user_model_name, cache_key=None):
+    # 如果响应的内容类型是 'text/event-stream;charset=UTF-8'
+    if response.headers.get('Content-Type') == 'text/event-stream;charset=UTF-8' and user_stream:
+        return stream_response(messages, model_name, cache_key, response)
+    return stream_2_json(messages, model_name, user_model_name, cache_key, response)
 
-def stream_response(resp, model_name):
+
+def stream_response(messages, model_name, cache_key=None, upstream=None):
     logging.info("Entering stream_response function")
 
     def generate():
-        for message in handle_http_response(resp):
-            message_id = message.get("messageId", "")
-            objectid = message.get("chunkId", "")
-            content = message.get("content", "")
-            wrapped_chunk = {
-                "id": message_id,
-                "object": "chat.completion",
-                "created": 0,
-                "model": model_name,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "role": "assistant",
-                            "content": content
-                        },
-                        "finish_reason": "stop",
-                    }
-                ],
-                "usage": {
-                    "prompt_tokens": 13,
-                    "completion_tokens": 7,
-                    "total_tokens": 20
-                },
-                "system_fingerprint": None
-            }
-            event_data = f"data: {json.dumps(wrapped_chunk, ensure_ascii=False)}\n\n"
-            yield event_data.encode('utf-8')
+        # 需要缓存时顺带收集内容片段，流完整结束后写入缓存
+        parts = [] if cache_key else None
+        message_id = None
+        try:
+            for message in messages:
+                wrapped_chunk = wrap_stream_chunk(message, model_name)
+                event_data = f"data: {json.dumps(wrapped_chunk, ensure_ascii=False)}\n\n"
+                if parts is not None:
+                    message_id = message.get("messageId", "")
+                    parts.append(message.get("content", ""))
+                yield event_data.encode('utf-8')
+            if parts is not None:
+                cache_response(cache_key, message_id, ''.join(parts))
+        except UpstreamTimeout as e:
+            # 响应头已经发出，只能以一个错误事件结束流
+            logging.error("stream_response error: %s", e)
+            yield f"data: {json.dumps(wrap_error(str(e), 'timeout_error', e.kind))}\n\n".encode('utf-8')
+        except requests.exceptions.RequestException as e:
+            # 上游在流中途断开时同样以一个错误事件结束流
+            logging.error("stream_response error: %s", e)
+            yield f"data: {json.dumps(wrap_error(str(e)))}\n\n".encode('utf-8')
+        finally:
+            # 关闭上游响应时才归还代理的在途连接计数
+            if upstream is not None:
+                upstream.close()
 
     logging.info("Exiting stream_response function")
     return Response(generate(), mimetype='text/event-stream; charset=UTF-8')
 
 
-def stream_2_json(resp, model_name, user_model_name):
+def stream_2_json(messages, model_name, user_model_name, cache_key=None, upstream=None):
     logging.info("Entering stream_2_json function")
 
-    chunks = []
-    merged_content = ""
-    append_to_chunks = chunks.append
-    for message in handle_http_response(resp):
-        message_id = message.get("messageId", "")
-        objectid = message.get("chunkId", "")
-        content = message.get("content", "")
-        merged_content += content
-        if user_model_name in IMAGE_MODEL_NAMES:
-            # 如果 model_name 在 IMAGE_MODEL_NAMES 内，转换为包含 URL 的格式
-            wrapped_chunk = {
-                "created": 0,
-                "data": [
-                    {"url": extract_url_from_content(merged_content)}
-                ]
-            }
-        else:
-            wrapped_chunk = {
-                "id": message_id,
-                "object": "chat.completion",
-                "created": 0,
-                "model": model_name,
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": merged_content
-                        },
-                        "finish_reason": "stop",
-                    }
-                ],
-                "usage": {
-                    "prompt_tokens": 13,
-                    "completion_tokens": 7,
-                    "total_tokens": 20
-                },
-                "system_fingerprint": None
-            }
-        append_to_chunks(wrapped_chunk)
+    # 只收集内容片段，结束后一次性拼接并构造响应，避免每个 chunk 都复制全文
+    parts = []
+    append_part = parts.append
+    message_id = None
+    try:
+        for message in messages:
+            message_id = message.get("messageId", "")
+            append_part(message.get("content", ""))
+    finally:
+        if upstream is not None:
+            upstream.close()
 
     logging.info("Exiting stream_2_json function")
-    if chunks:
-        return jsonify(chunks[-1])
-    else:
+    if message_id is None:
         raise Exception("No data available")
+    content = ''.join(parts)
+    cache_response(cache_key, message_id, content)
+    return jsonify(wrap_completion(message_id, content, model_name, user_model_name))
+
+
+def lookup_cached_response(body, headers):
+    # 返回 (cache_key, 命中的 (message_id, content))；未启用缓存或是图片生成请求时 cache_key 为 None
+    if response_cache is None or body.get("model") in IMAGE_MODEL_NAMES:
+        return None, None
+    cache_key = response_cache_key(body, get_api_key(headers), get_topic_from_headers(headers))
+    if bypass_response_cache(headers):
+        RESPONSE_CACHE_TOTAL.inc('bypass')
+        return cache_key, None
+    cached = response_cache.get(cache_key)
+    RESPONSE_CACHE_TOTAL.inc('hit' if cached is not None else 'miss')
+    return cache_key, cached
+
+
+def cache_response(cache_key, message_id, content):
+    if cache_key is None or message_id is None:
+        return
+    RESPONSE_CACHE_TOTAL.inc('stored' if response_cache.set(cache_key, message_id, content) else 'too_large')
+
+
+def cached_message(cached):
+    # 缓存的完整结果作为一条 popai 消息重放
+    message_id, content = cached
+    return {"messageId": message_id, "content": content}
+
+
+def cached_chat_response(cached, body):
+    _, model_name, _, user_stream = get_request_parameters(body)
+    if user_stream:
+        return stream_response(iter((cached_message(cached),)), map_model_name(model_name))
+    return stream_2_json(iter((cached_message(cached),)), map_model_name(model_name), model_name)
 
 
 def process_content(message):
@@ -213,6 +433,8 @@ def process_content(message):
         return message, image_url_array
 
     if isinstance(message, list):
+        # base64 图片先记下位置，最后统一（并行）上传后回填
+        base64_images = []
         for msg in message:
             content_type = msg.get("type")
             if content_type == "text":
@@ -220,38 +442,16 @@ def process_content(message):
             elif content_type == "image_url":
                 url = msg.get("image_url", {}).get("url", "")
                 if is_base64_image(url):
-                    url = upload_image_to_telegraph(url)
+                    base64_images.append((len(image_url_array), url))
                 image_url_array.append(url)
+        if base64_images:
+            uploaded = image_uploader.upload_all([url for _, url in base64_images])
+            for (index, _), url in zip(base64_images, uploaded):
+                image_url_array[index] = url
 
     return '\n'.join(text_array), image_url_array
 
 
-def upload_image_to_telegraph(base64_string):
-    try:
-        if base64_string.startswith('data:image'):
-            base64_string = base64_string.split(',')[1]
-        image_data = base64.b64decode(base64_string)
-
-        image_type = imghdr.what(None, image_data)
-        if image_type is None:
-            raise ValueError("Invalid image data")
-
-        mime_type = f"image/{image_type}"
-        files = {'file': (f'image.{image_type}', image_data, mime_type)}
-        response = request_with_proxy_image('https://telegra.ph/upload', files=files)
-        response.raise_for_status()
-        json_response = response.json()
-        if isinstance(json_response, list) and 'src' in json_response[0]:
-            return 'https://telegra.ph' + json_response[0]['src']
-        else:
-            raise ValueError(f"Unexpected response format: {json_response}")
-
-    except requests.exceptions.RequestException as e:
-        raise Exception(f"Failed to upload image. Error: {e}")
-    except Exception as e:
-        raise Exception(f"Failed to upload image. An error occurred: {e}")
-
-
 def is_base64_image(base64_string):
     return base64_string.startswith('data:image')
 
@@ -264,82 +464,80 @@ def process_msg_content(content):
     return None
 
 
-def get_user_contents(messages, limit):
-    limit = int(limit)
-    selected_messages = deque(maxlen=limit)
+def format_first_user_message(system_content, content):
+    if system_content is None:
+        return content
+    return f"Your role setting: {system_content}\n\nUser's input: {content}"
+
+
+def build_user_prompt(messages, limit):
+    # 返回 (first_user_message, final_user_content)。
+    # 正向只扫描到第一条用户消息（会话 key），历史部分从末尾反向取最近 limit 条用户消息，
+    # 中间的消息不做任何处理，最后一次性拼接
+    limit = max(int(limit), 1)
     system_content = None
     first_user_message = None
-    user_messages_list = []
-
-    # 过滤并处理用户消息
-    # logging.info("get_user_contents messages: %s", messages)
-    for message in messages:
-        if message['role'] == 'system' and system_content is None:
+    first_index = None
+    for index, message in enumerate(messages):
+        role = message.get('role')
+        if role == 'system' and system_content is None:
             system_content = message['content']
-        elif message.get("role") == "user":
-            content = process_msg_content(message.get("content"))
+        elif role == 'user':
+            content = process_msg_content(message.get('content'))
             if content:
-                if first_user_message is None:
-                    if system_content is None:
-                        first_user_message = content
-                    else:
-                        first_user_message = f"Your role setting: {system_content}\n\nUser's input: {content}"
-                    selected_messages.append(first_user_message)
-                    user_messages_list.append(first_user_message)
-                else:
-                    selected_messages.append(content)
-                    user_messages_list.append(content)
-    
-    # 检查是否有足够的消息
-    if selected_messages:
-        end_user_message = selected_messages[-1]
-    else:
-        end_user_message = None
-
-    # 拼接消息内容
-    if selected_messages:
-        selected_messages.pop()  # 移除最后一条数据
-
-    concatenated_messages = ' \n'.join(selected_messages)
-
-    return first_user_message, end_user_message, concatenated_messages, user_messages_list
-
-def fetch_channel_id(auth_token, model_name, content, template_id):
-    url = "https://api.popai.pro/api/v1/chat/getChannel"
-    headers = {
-        "Accept": "application/json",
-        "Accept-Encoding": "gzip, deflate, br, zstd",
-        "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-        "App-Name": "popai-web",
-        "Authorization": auth_token,
-        "Content-Type": "application/json",
-        "Device-Info": '{"web_id":"Tu2oHIR427H5g7_CCOKAE","baidu_id":"18f2e8b7b429216e54da83"}',
-        "Language": "en",
-        "Origin": "https://www.popai.pro",
-        "Referer": "https://www.popai.pro/",
-        "Pop-Url": "https://www.popai.pro/creation/All/Image",
-        "Sec-Ch-Ua": '"Not/A)Brand";v="8", "Chromium";v="126", "Google Chrome";v="126"',
-        "Sec-Ch-Ua-Mobile": "?0",
-        "Sec-Ch-Ua-Platform": "macOS",
-        "Sec-Fetch-Dest": "empty",
-        "Sec-Fetch-Mode": "cors",
-        "Sec-Fetch-Site": "same-site",
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
-    }
-    data = {
-        "model": model_name,
-        "templateId": template_id,
-        "message": content,
-        "language": "English",
-        "fileType": None
-    }
+                first_user_message = format_first_user_message(system_content, content)
+                first_index = index
+                break
+    if first_user_message is None:
+        return None, None
+    if history_compactor is not None:
+        return first_user_message, history_compactor.build(messages, first_index, first_user_message,
+                                                           conversation_digest(first_user_message))
+
+    recent = []
+    for index in range(len(messages) - 1, first_index - 1, -1):
+        if index == first_index:
+            recent.append(first_user_message)
+            break
+        message = messages[index]
+        if message.get('role') == 'user':
+            content = process_msg_content(message.get('content'))
+            if content:
+                recent.append(content)
+                if len(recent) == limit:
+                    break
+
+    # 历史消息之间用 ' \n' 分隔，最后一条用户消息前用 '\n'
+    final_content = recent[0]
+    if len(recent) == 1:
+        return first_user_message, final_content
+    parts = []
+    for content in reversed(recent[1:]):
+        parts.append(content)
+        parts.append(' \n')
+    parts[-1] = '\n'
+    parts.append(final_content)
+    return first_user_message, ''.join(parts)
+
+
+def fetch_channel_id(auth_token, model_name, content, template_id, affinity_key=None):
+    url = CHAT_CHANNEL_URL
+    headers = build_channel_headers(auth_token)
+    data = build_channel_data(model_name, content, template_id)
 
     try:
-        response = request_with_proxy_chat(url, headers, data, False)
+        started_at = time.perf_counter()
+        response = request_with_proxy_chat(url, headers, data, False, affinity_key, CHANNEL_TIMEOUTS)
+        UPSTREAM_CHANNEL_SECONDS.observe(time.perf_counter() - started_at)
         response.raise_for_status()
         response_data = response.json()
+        account_scheduler.report_success(auth_token)
         return response_data.get('data', {}).get('channelId')
 
+    except requests.exceptions.HTTPError as e:
+        logging.error("fetch_channel_id error: %s", e)
+        account_scheduler.report_failure(auth_token, rate_limited=e.response.status_code == 429)
+        raise Exception(f"Failed to fetch channel_id. Error: {e}") from e
     except requests.exceptions.RequestException as e:
         logging.error("fetch_channel_id error: %s", e)
         raise Exception(f"Failed to fetch channel_id. Error: {e}") from e
@@ -364,50 +562,65 @@ def map_model_name(model_name):
 
 
 def generate_hash(contents, model_name, token):
-    concatenated = ''.join(contents)
-    return token + model_name + hashlib.md5(concatenated.encode('utf-8')).hexdigest()
-
-
-def handle_http_response(resp):
-    buffer = ""
-    json_object_counter = 0
-    for chunk in resp.iter_content(chunk_size=None):
-        buffer += chunk.decode('utf-8')
-        while "\n\n" in buffer:
-            json_object, buffer = buffer.split("\n\n", 1)
-            if json_object.startswith("data:"):
-                json_object = json_object[len("data:"):].strip()
-                json_object_counter += 1
-                if json_object_counter == 1:
-                    continue
-                try:
-                    chunk_json = json.loads(json_object)
-                except json.JSONDecodeError as e:
-                    logging.error(f"Failed to parse JSON: {e}")
-                    continue
-                for message in chunk_json:
-                    yield message
-
-
-def get_next_auth_token(tokens):
-    if not tokens:
-        raise ValueError("No tokens provided.")
-    auth_tokens = tokens.split(',')
-    global current_token_index
-    token = auth_tokens[current_token_index]
-    current_token_index = (current_token_index + 1) % len(auth_tokens)
-    logging.info("Using token: %s", token)
-    return token
+    return token + model_name + conversation_digest(contents)
+
+
+def handle_http_response(resp, timeouts=CHAT_TIMEOUTS, deadline=None):
+    decoder = PopaiMessageDecoder()
+    # resp.elapsed 是发送请求到收到响应头的耗时，据此推算请求开始时间
+    started_at = time.perf_counter() - resp.elapsed.total_seconds()
+    message_count = 0
+    first_byte = True
+    # 每次读取前按首字节/空闲间隔/剩余总时长调整 socket 超时，上游卡住时读取会及时超时返回
+    sock = getattr(getattr(resp.raw, 'connection', None), 'sock', None)
+    chunks = resp.iter_content(chunk_size=None)
+    try:
+        while True:
+            kind, wait = ('first_byte', timeouts.first_byte) if first_byte else ('idle', timeouts.idle)
+            if deadline is not None:
+                deadline.check(timeouts.endpoint)
+                kind, wait = deadline.limit(kind, wait)
+            if sock is not None:
+                sock.settimeout(wait)
+            try:
+                chunk = next(chunks, None)
+            except requests.exceptions.ConnectionError as e:
+                if not (e.args and isinstance(e.args[0], ReadTimeoutError)):
+                    raise
+                raise timed_out(timeouts.endpoint, kind, deadline.seconds if kind == 'deadline' else wait) from e
+            if chunk is None:
+                break
+            if first_byte:
+                CHAT_FIRST_BYTE_SECONDS.observe(time.perf_counter() - started_at)
+                first_byte = False
+            for message in decoder.feed(chunk):
+                message_count += 1
+                yield message
+    except UpstreamTimeout:
+        # 超时的连接状态不确定，不能放回连接池复用
+        resp.close()
+        raise
+    finally:
+        CHAT_SSE_CHUNKS.observe(message_count)
+        CHAT_DURATION_SECONDS.observe(time.perf_counter() - started_at)
+
+
+def wrap_error(message, error_type="popai_2_api_error", code=None):
+    error = {
+        "message": message,
+        "type": error_type
+    }
+    if code is not None:
+        error["code"] = code
+    return {"error": error}
 
 
 def handle_error(e):
-    error_response = {
-        "error": {
-            "message": str(e),
-            "type": "popai_2_api_error"
-        }
-    }
-    return jsonify(error_response), 500
+    if isinstance(e, AdmissionRejected):
+        return jsonify(wrap_error(str(e), 'rate_limit_error', e.reason)), 429, {'Retry-After': str(e.retry_after)}
+    if isinstance(e, UpstreamTimeout):
+        return jsonify(wrap_error(str(e), 'timeout_error', e.kind)), 504
+    return jsonify(wrap_error(str(e))), 500
 
 
 def get_request_parameters(body):
@@ -446,23 +659,46 @@ def extract_url_from_content(content):
 
 
 def request_with_proxy_image(url, files):
-    return request_with_proxy(url, None, None, False, files)
+    return request_with_proxy(url, None, None, False, files, timeouts=IMAGE_UPLOAD_TIMEOUTS)
 
 
-def request_with_proxy_chat(url, headers, data, stream):
-    return request_with_proxy(url, headers, data, stream, None)
+def request_with_proxy_chat(url, headers, data, stream, affinity_key=None, timeouts=CHAT_TIMEOUTS):
+    return request_with_proxy(url, headers, data, stream, None, affinity_key, timeouts)
 
 
-def request_with_proxy(url, headers, data, stream, files):
+def request_with_proxy(url, headers, data, stream, files, affinity_key=None, timeouts=CHAT_TIMEOUTS, deadline=None,
+                       avoid_affinity=None):
+    timeout = timeouts.requests_timeout
+    if deadline is not None:
+        deadline.check(timeouts.endpoint)
+        timeout = (timeouts.connect, deadline.limit('read', timeouts.read)[1])
+    proxies = proxy_pool.get_proxy(affinity_key, avoid_affinity)
+    # logging.info("Use proxy url %s", proxies)
+    started_at = time.perf_counter()
+    ok = False
     try:
-        proxies = proxy_pool.get_random_proxy()
-        # logging.info("Use proxy url %s", proxies)
-
-        if proxies:
-            response = requests.post(url, headers=headers, json=data, stream=stream, files=files, proxies=proxies)
-        else:
-            response = requests.post(url, headers=headers, json=data, stream=stream, files=files)
+        response = session_pool.post(url, proxies, stream, headers=headers, json=data, files=files, timeout=timeout)
+        ok = True
+        if stream:
+            proxy_pool.release_on_close(response, proxies)
     except ProxyError as e:
         logging.error(f"Proxy error occurred: {e}")
         raise Exception("Proxy error occurred")
+    except requests.exceptions.ConnectTimeout:
+        UPSTREAM_TIMEOUTS_TOTAL.inc(timeouts.endpoint, 'connect')
+        raise
+    except requests.exceptions.ReadTimeout:
+        UPSTREAM_TIMEOUTS_TOTAL.inc(timeouts.endpoint, 'read')
+        raise
+    finally:
+        # 无论成功失败都要回报给代理池，熔断半开状态的探测请求依赖这里恢复
+        if not (ok and stream):
+            proxy_pool.release(proxies)
+        proxy_pool.record(proxies, ok, time.perf_counter() - started_at if ok else None)
+        PROXY_REQUESTS_TOTAL.inc(proxy_label(proxies), 'ok' if ok else 'error')
     return response
+
+
+image_uploader = create_image_uploader(request_with_proxy_image)
+# 设置 HISTORY_TOKEN_BUDGET 后按 token 预算压缩历史，否则沿用 HISTORY_MSG_LIMIT 按条数截取
+history_compactor = create_history_compactor(process_msg_content)
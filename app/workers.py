@@ -0,0 +1,124 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from gunicorn.app.base import BaseApplication
+
+from app.config import get_env_value
+
+
+# 多进程部署：gunicorn 预先 fork 出多个 worker 处理请求，gtoken 由单独的 sidecar 进程统一生成，
+# 避免每个 worker 各自启动 Chrome
+class WorkerApplication(BaseApplication):
+    def __init__(self, options, server_mode):
+        self.options = options
+        self.server_mode = server_mode
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # worker 进程 fork 之后再导入应用，后台线程和连接都在各自进程内创建
+        if self.server_mode == 'asgi':
+            from app.asgi import create_asgi_app
+            return create_asgi_app()
+        from app import create_app
+        return create_app()
+
+
+# 在 gunicorn master 进程中运行 sidecar 并监控：sidecar 意外退出时记录日志并自动重启，连续崩溃时重启间隔翻倍，
+# 直到 TOKEN_SIDECAR_MAX_RESTART_DELAY。worker 的 TokenClient 断线后会自动重连到新的 sidecar
+class TokenSidecar:
+    def __init__(self, socket_path, restart_delay=1, max_restart_delay=60, target=None):
+        self.socket_path = socket_path
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.target = target
+        self.process = None
+        self.restarts = 0
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._supervise, name='token-sidecar-supervisor', daemon=True)
+
+    def _spawn(self):
+        target = self.target
+        if target is None:
+            from app.token_ipc import run_token_sidecar
+            target = run_token_sidecar
+        # spawn 启动全新的解释器，不继承 master 进程的任何状态
+        context = multiprocessing.get_context('spawn')
+        process = context.Process(target=target, args=(self.socket_path,), name='token-sidecar', daemon=True)
+        process.start()
+        logging.info("Started token sidecar (pid %s) on %s", process.pid, self.socket_path)
+        return process
+
+    def start(self):
+        self.process = self._spawn()
+        self._thread.start()
+        return self
+
+    def _supervise(self):
+        delay = self.restart_delay
+        while True:
+            process = self.process
+            started_at = time.monotonic()
+            process.join()
+            if self._stopping.is_set():
+                return
+            # 稳定运行过一段时间后的退出不算连续崩溃，重置重启间隔
+            if time.monotonic() - started_at > self.max_restart_delay:
+                delay = self.restart_delay
+            logging.error("Token sidecar (pid %s) exited with code %s, restarting in %.1f seconds",
+                          process.pid, process.exitcode, delay)
+            if self._stopping.wait(delay):
+                return
+            with self._lock:
+                if self._stopping.is_set():
+                    return
+                self.process = self._spawn()
+                self.restarts += 1
+            delay = min(delay * 2, self.max_restart_delay)
+
+    def stop(self, timeout=30):
+        with self._lock:
+            self._stopping.set()
+            process = self.process
+        if process is not None:
+            process.terminate()
+            process.join(timeout=timeout)
+
+
+def serve(port, server_mode, workers):
+    socket_path = get_env_value('TOKEN_SOCKET_PATH', '/tmp/popai2api-token.sock')
+    sidecar = TokenSidecar(
+        socket_path,
+        restart_delay=float(get_env_value('TOKEN_SIDECAR_RESTART_DELAY', 1)),
+        max_restart_delay=float(get_env_value('TOKEN_SIDECAR_MAX_RESTART_DELAY', 60)),
+    ).start()
+    # worker 进程继承该环境变量，改为通过 sidecar 获取 token
+    os.environ['TOKEN_SOCKET'] = socket_path
+    # 各 worker 的指标写入同一目录，/metrics 合并所有 worker 的数据
+    os.environ['METRICS_MULTIPROCESS_DIR'] = tempfile.mkdtemp(prefix='popai2api-metrics-')
+
+    options = {
+        'bind': f'0.0.0.0:{port}',
+        'workers': workers,
+        'timeout': int(get_env_value('WORKER_TIMEOUT', 0)),
+        'graceful_timeout': 30,
+    }
+    if server_mode == 'asgi':
+        options['worker_class'] = 'uvicorn.workers.UvicornWorker'
+    else:
+        # 流式响应会长时间占用线程，使用多线程 worker
+        options['worker_class'] = 'gthread'
+        options['threads'] = int(get_env_value('WORKER_THREADS', 32))
+
+    try:
+        WorkerApplication(options, server_mode).run()
+    finally:
+        sidecar.stop()
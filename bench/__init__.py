@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+import time
+
+# 基准脚本：在仓库根目录执行 python -m bench.<name>。
+# 运行期间的 SQLite / gtoken 文件放到临时目录，不污染仓库
+_scratch = tempfile.mkdtemp(prefix='popai2api-bench-')
+os.environ.setdefault('STORAGE_DB_PATH', os.path.join(_scratch, 'storage_map.db'))
+os.environ.setdefault('GTOKEN_STORE_PATH', os.path.join(_scratch, 'gtokens.json'))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+
+def best_of(fn, repeat=3):
+    # 取多次运行中最快的一次，减少调度抖动的影响
+    best = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report_scaling(label, sizes, timings, unit, tolerance=2.5):
+    # 打印每单位耗时；最大规模的单位耗时超过最小规模的 tolerance 倍视为非线性
+    base = timings[0] / sizes[0]
+    print(f"{label}")
+    for size, elapsed in zip(sizes, timings):
+        per_unit = elapsed / size
+        print(f"  {size:>8g} {unit:<8} {elapsed * 1000:10.2f} ms  {per_unit * 1e6:10.3f} us/{unit}  "
+              f"x{per_unit / base:.2f}")
+    linear = timings[-1] / sizes[-1] <= base * tolerance
+    if not linear:
+        print(f"  NOT LINEAR: cost per {unit} grew more than {tolerance}x")
+    return linear
+
+
+def exit_status(*results):
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,86 @@
+import hashlib
+from collections import deque
+
+from bench import best_of, exit_status, report_scaling
+import app.utils
+from app.utils import build_user_prompt, generate_hash, process_msg_content
+
+# 长会话的 prompt 构建和会话 key 哈希：最大 1 MB 的对话记录，对比旧实现
+# （get_user_contents 全量处理每条消息 + 按字符 ''.join 后 md5）
+SIZES_KB = (256, 512, 1024)
+MESSAGE_BYTES = 4096
+HISTORY_LIMIT = 8
+
+
+def build_transcript(size_kb):
+    text = ('这是一段很长的对话内容 long conversation. ' * (MESSAGE_BYTES // 40 + 1))[:MESSAGE_BYTES // 2]
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    total = 0
+    while total < size_kb * 1024:
+        messages.append({"role": "user", "content": text})
+        messages.append({"role": "assistant", "content": text})
+        total += 2 * len(text.encode('utf-8'))
+    return messages
+
+
+def legacy_get_user_contents(messages, limit):
+    selected_messages = deque(maxlen=int(limit))
+    system_content = None
+    first_user_message = None
+    user_messages_list = []
+    for message in messages:
+        if message['role'] == 'system' and system_content is None:
+            system_content = message['content']
+        elif message.get("role") == "user":
+            content = process_msg_content(message.get("content"))
+            if content:
+                if first_user_message is None:
+                    if system_content is None:
+                        first_user_message = content
+                    else:
+                        first_user_message = f"Your role setting: {system_content}\n\nUser's input: {content}"
+                    selected_messages.append(first_user_message)
+                    user_messages_list.append(first_user_message)
+                else:
+                    selected_messages.append(content)
+                    user_messages_list.append(content)
+    if selected_messages:
+        selected_messages.pop()
+    return first_user_message, None, ' \n'.join(selected_messages), user_messages_list
+
+
+def legacy_prompt(messages):
+    first, _, concatenated, user_list = legacy_get_user_contents(messages, HISTORY_LIMIT)
+    final = concatenated + '\n' + user_list[-1] if concatenated else user_list[-1]
+    return first, final
+
+
+def legacy_hash(contents, model_name, token):
+    return token + model_name + hashlib.md5(''.join(contents).encode('utf-8')).hexdigest()
+
+
+def run(label, fn, build_input):
+    timings = []
+    for size_kb in SIZES_KB:
+        value = build_input(size_kb)
+        timings.append(best_of(lambda: fn(value)))
+    return report_scaling(label, SIZES_KB, timings, 'KB')
+
+
+def first_message(size_kb):
+    return 'x' * (size_kb * 1024)
+
+
+if __name__ == '__main__':
+    # 历史压缩单独测试，这里只看 build_user_prompt 本身
+    app.utils.history_compactor = None
+    transcript = build_transcript(1024)
+    assert build_user_prompt(transcript, HISTORY_LIMIT) == legacy_prompt(transcript)
+    results = [
+        run('build_user_prompt', lambda messages: build_user_prompt(messages, HISTORY_LIMIT), build_transcript),
+        run('generate_hash, first message', lambda text: generate_hash(text, 'gpt-4', 'token'), first_message),
+    ]
+    # 旧实现只做对比，不参与线性判断
+    run('legacy get_user_contents', legacy_prompt, build_transcript)
+    run('legacy md5 hash, first message', lambda text: legacy_hash(text, 'gpt-4', 'token'), first_message)
+    exit_status(*results)
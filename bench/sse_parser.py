@@ -0,0 +1,46 @@
+import json
+
+from bench import best_of, exit_status, report_scaling
+from app.sse import PopaiMessageDecoder
+
+# 增量 SSE 解析的线性度：多 MB 响应按网络包大小切块（会切断多字节 UTF-8 字符），
+# 分别测试大量小事件和单个超大事件两种情况
+SIZES_MB = (1, 2, 4, 8)
+NETWORK_CHUNK = 1500
+
+
+def build_stream(size_mb, event_bytes):
+    content = ('popai 流式输出 ' * (event_bytes // 20 + 1))[:event_bytes // 2]
+    event = b'data: ' + json.dumps([{"messageId": "m", "content": content}], ensure_ascii=False).encode('utf-8') \
+        + b'\n\n'
+    count = max(size_mb * 1024 * 1024 // len(event), 1)
+    body = b'data: {"meta": true}\n\n' + event * count
+    return [body[i:i + NETWORK_CHUNK] for i in range(0, len(body), NETWORK_CHUNK)], count
+
+
+def decode_all(chunks):
+    decoder = PopaiMessageDecoder()
+    count = 0
+    for chunk in chunks:
+        for _ in decoder.feed(chunk):
+            count += 1
+    return count
+
+
+def run(label, event_bytes):
+    sizes = []
+    timings = []
+    for size_mb in SIZES_MB:
+        chunks, expected = build_stream(size_mb, event_bytes)
+        assert decode_all(chunks) == expected
+        sizes.append(round(sum(map(len, chunks)) / (1024 * 1024), 2))
+        timings.append(best_of(lambda: decode_all(chunks)))
+    return report_scaling(label, sizes, timings, 'MB')
+
+
+if __name__ == '__main__':
+    exit_status(
+        run('many small events (~200 B each)', 200),
+        # 单个事件就有整个响应那么大：旧实现每个网络包都重新扫描整个缓冲区
+        run('one event per ~MB', 700 * 1024),
+    )
@@ -0,0 +1,53 @@
+from flask import Flask
+
+from bench import best_of, exit_status, report_scaling
+from app.config import IMAGE_MODEL_NAMES
+from app.utils import extract_url_from_content, stream_2_json
+
+# 非流式响应的聚合：10k 个 chunk 的回答，对比旧实现（每个 chunk 拼接全文并构造完整响应）
+CHUNK_COUNTS = (2500, 5000, 10000)
+CHUNK_TEXT = '这是一段流式输出的内容 streaming content. '
+
+
+def build_messages(count, image=False):
+    messages = [{"messageId": "m", "chunkId": str(i), "content": CHUNK_TEXT} for i in range(count)]
+    if image:
+        messages.append({"messageId": "m", "chunkId": "url", "content": "![image](https://example.com/a.png)"})
+    return messages
+
+
+def legacy_stream_2_json(messages, model_name, user_model_name):
+    chunks = []
+    merged_content = ""
+    for message in messages:
+        merged_content += message.get("content", "")
+        if user_model_name in IMAGE_MODEL_NAMES:
+            chunks.append({"created": 0, "data": [{"url": extract_url_from_content(merged_content)}]})
+        else:
+            chunks.append({"id": message.get("messageId", ""), "object": "chat.completion", "model": model_name,
+                           "choices": [{"index": 0, "message": {"role": "assistant", "content": merged_content},
+                                        "finish_reason": "stop"}]})
+    return chunks[-1]
+
+
+def run(label, aggregate, user_model_name):
+    timings = []
+    for count in CHUNK_COUNTS:
+        messages = build_messages(count, image=user_model_name in IMAGE_MODEL_NAMES)
+        timings.append(best_of(lambda: aggregate(iter(messages), 'gpt-4', user_model_name)))
+    return report_scaling(label, CHUNK_COUNTS, timings, 'chunk')
+
+
+if __name__ == '__main__':
+    app = Flask(__name__)
+    with app.app_context():
+        response = stream_2_json(iter(build_messages(10000)), 'gpt-4', 'gpt-4').get_json()
+        assert response['choices'][0]['message']['content'] == CHUNK_TEXT * 10000
+        results = [
+            run('stream_2_json, chat model', stream_2_json, 'gpt-4'),
+            run('stream_2_json, image model', stream_2_json, IMAGE_MODEL_NAMES[0]),
+        ]
+    # 旧实现只做对比，不参与线性判断
+    run('legacy aggregation, chat model', legacy_stream_2_json, 'gpt-4')
+    run('legacy aggregation, image model', legacy_stream_2_json, IMAGE_MODEL_NAMES[0])
+    exit_status(*results)
@@ -0,0 +1,55 @@
+import contextlib
+import io
+import threading
+import time
+from collections import Counter
+
+from bench import exit_status
+from app.token import USES_PER_TOKEN, TokenManager
+
+# TokenManager 在大量并发调用者下的吞吐：每个线程循环 get_token，并模拟 60001 按值删除部分 token。
+# 同时校验没有 token 被发放超过 USES_PER_TOKEN 次
+THREAD_COUNTS = (1, 16, 64, 128)
+ACQUIRES_PER_THREAD = 5000
+REMOVE_EVERY = 50
+
+
+def run(thread_count):
+    total = thread_count * ACQUIRES_PER_THREAD
+    manager = TokenManager(min_valid_tokens=0)
+    for i in range(total // USES_PER_TOKEN + 1):
+        manager.add_token(f"token-{i}")
+    barrier = threading.Barrier(thread_count + 1)
+    handed_out = [None] * thread_count
+
+    def worker(index):
+        values = []
+        barrier.wait()
+        for i in range(ACQUIRES_PER_THREAD):
+            value = manager.get_token()
+            values.append(value)
+            if i % REMOVE_EVERY == 0 and value is not None:
+                manager.remove_token(value)
+        handed_out[index] = values
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    # remove_token 每次都会打印，计时期间丢弃输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        barrier.wait()
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started_at
+
+    counts = Counter(value for values in handed_out for value in values if value is not None)
+    overused = sum(1 for count in counts.values() if count > USES_PER_TOKEN)
+    print(f"  {thread_count:>4} threads  {total:>7} acquires  {elapsed * 1000:9.1f} ms  "
+          f"{total / elapsed / 1000:8.1f} k ops/s  overused tokens: {overused}")
+    return overused == 0
+
+
+if __name__ == '__main__':
+    print("TokenManager.get_token under contention")
+    exit_status(*[run(thread_count) for thread_count in THREAD_COUNTS])
@@ -1,19 +1,35 @@
-from app import create_app
 from app.config import get_env_value
-import time
-import schedule
-from app.token import token_manager_thread
 
-app = create_app()
 
-if __name__ == '__main__':
-    port = int(get_env_value('SERVER_PORT', 3000))
+def run_single_process(port, server_mode):
+    from app import create_app
+    from app.token import token_manager_thread
+
      # 启动 Token 管理器线程
     token_manager_thread.start()
     
     try:
-        app.run(host='0.0.0.0', port=port)
+        if server_mode == 'asgi':
+            # 异步模式：单进程内以协程承载大量长连接流式请求
+            import uvicorn
+            from app.asgi import create_asgi_app
+            uvicorn.run(create_asgi_app(), host='0.0.0.0', port=port)
+        else:
+            create_app().run(host='0.0.0.0', port=port)
     finally:
         # 确保在应用关闭时停止 Token 管理器线程
         token_manager_thread.stop()
         token_manager_thread.join()
+
+
+if __name__ == '__main__':
+    port = int(get_env_value('SERVER_PORT', 3000))
+    server_mode = get_env_value('SERVER_MODE', 'flask').lower()
+    workers = int(get_env_value('WORKERS', 1))
+
+    if workers > 1:
+        # 多进程模式：gunicorn 多 worker + 单个 gtoken sidecar 进程
+        from app.workers import serve
+        serve(port, server_mode, workers)
+    else:
+        run_single_process(port, server_mode)
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+import tempfile
+import uuid
+from collections import namedtuple
+
+import httpx
+import pytest
+
+# 测试运行期间的 SQLite / gtoken 文件放到临时目录，必须在导入 app 之前设置
+_scratch = tempfile.mkdtemp(prefix='popai2api-test-')
+os.environ.setdefault('STORAGE_DB_PATH', os.path.join(_scratch, 'storage_map.db'))
+os.environ.setdefault('GTOKEN_STORE_PATH', os.path.join(_scratch, 'gtokens.json'))
+os.environ.setdefault('AUTHORIZATION', 'test-account')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.upstream_stub import StubUpstream  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def flask_app():
+    from app import create_app
+    return create_app()
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    # 把 chat/send 与 getChannel 指向本地模拟上游，并在 token 池中放入足够的 gtoken
+    from app import asgi, utils
+    from app.token import token_manager_thread
+
+    stub = StubUpstream().start()
+    for module in (utils, asgi):
+        monkeypatch.setattr(module, 'CHAT_SEND_URL', f"{stub.base_url}/api/v1/chat/send")
+        monkeypatch.setattr(module, 'CHAT_CHANNEL_URL', f"{stub.base_url}/api/v1/chat/getChannel")
+    for _ in range(200):
+        token_manager_thread.token_manager.add_token(f"gtoken-{uuid.uuid4().hex}")
+    yield stub
+    stub.stop()
+
+
+ChatResponse = namedtuple('ChatResponse', ('status_code', 'headers', 'text'))
+
+
+@pytest.fixture(params=['flask', 'asgi'])
+def post_chat(request, flask_app):
+    # 分别通过 Flask 和 ASGI 应用发送补全请求，返回 ChatResponse；响应读完后关闭
+    if request.param == 'flask':
+        def post(body, headers=None):
+            response = flask_app.test_client().post('/v1/chat/completions', json=body, headers=headers)
+            text = response.get_data(as_text=True)
+            response.close()
+            return ChatResponse(response.status_code, response.headers, text)
+        return post
+
+    from app.asgi import close_async_clients, create_asgi_app
+
+    def post(body, headers=None):
+        async def scenario():
+            transport = httpx.ASGITransport(app=create_asgi_app())
+            async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+                try:
+                    return await client.post('/v1/chat/completions', json=body, headers=headers)
+                finally:
+                    await close_async_clients()
+
+        response = asyncio.run(scenario())
+        return ChatResponse(response.status_code, response.headers, response.text)
+    return post
+
+
+def chat_body(content=None, stream=False):
+    # 每个测试使用不同的首条消息，避免命中其他测试写入的 channel 缓存
+    return {
+        "model": "gpt-4",
+        "messages": [{"role": "user", "content": content or f"hello {uuid.uuid4().hex}"}],
+        "stream": stream,
+    }
@@ -0,0 +1,24 @@
+import asyncio
+
+import app.asgi
+from app.asgi import async_request_with_proxy, close_async_clients
+
+CONCURRENT_STREAMS = 150
+
+
+def test_concurrent_streams_beyond_httpx_default_pool_size(upstream, monkeypatch):
+    # httpx 默认每个连接池 100 个连接，未读完的流一直占用连接，第 101 个会等到连接池超时
+    monkeypatch.setattr(app.asgi, 'ASYNC_POOL_TIMEOUT', 2)
+    url = f"{upstream.base_url}/api/v1/chat/send"
+
+    async def scenario():
+        try:
+            responses = await asyncio.gather(*[async_request_with_proxy(url, {}, {"channelId": "c"}, True)
+                                               for _ in range(CONCURRENT_STREAMS)])
+            for response in responses:
+                await response.aclose()
+            return [response.status_code for response in responses]
+        finally:
+            await close_async_clients()
+
+    assert asyncio.run(scenario()) == [200] * CONCURRENT_STREAMS
@@ -0,0 +1,76 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app.asgi
+import app.utils
+from app.config import ProxyPool
+from app.hedge import AsyncHedgedCall, HedgedCall
+from app.metrics import CHAT_HEDGES_TOTAL, GTOKEN_REJECTED_TOTAL
+from tests.conftest import chat_body
+from tests.upstream_stub import StubUpstream
+
+HEDGE_DELAY = 0.2
+
+
+@pytest.fixture(autouse=True)
+def hedged(monkeypatch):
+    monkeypatch.setattr(app.utils, 'chat_hedge', HedgedCall(ThreadPoolExecutor(max_workers=4), HEDGE_DELAY, 3,
+                                                            on_hedge=CHAT_HEDGES_TOTAL.inc))
+    monkeypatch.setattr(app.asgi, 'chat_hedge', AsyncHedgedCall(HEDGE_DELAY, 3, on_hedge=CHAT_HEDGES_TOTAL.inc))
+
+
+def counter(metric, *labels):
+    return metric._values.get(labels, 0)
+
+
+def test_slow_first_attempt_is_hedged_after_delay(upstream, post_chat):
+    upstream.script = ['slow']
+    hedges = counter(CHAT_HEDGES_TOTAL, 'delay')
+    started_at = time.perf_counter()
+
+    response = post_chat(chat_body())
+
+    assert response.status_code == 200
+    assert json.loads(response.text)['choices'][0]['message']['content'] == upstream.reply
+    assert time.perf_counter() - started_at < upstream.slow_delay
+    assert upstream.calls['send'] == 2
+    assert counter(CHAT_HEDGES_TOTAL, 'delay') == hedges + 1
+
+
+def test_rejected_gtoken_starts_next_attempt_immediately(upstream, post_chat):
+    upstream.script = ['60001']
+    hedges = counter(CHAT_HEDGES_TOTAL, 'error')
+    rejected = counter(GTOKEN_REJECTED_TOTAL)
+
+    assert post_chat(chat_body()).status_code == 200
+    assert upstream.calls['send'] == 2
+    assert counter(CHAT_HEDGES_TOTAL, 'error') == hedges + 1
+    assert counter(GTOKEN_REJECTED_TOTAL) == rejected + 1
+
+
+@pytest.fixture
+def proxies(upstream, monkeypatch):
+    # 两个模拟服务充当代理（按绝对 URI 处理请求），两者的第一个 chat/send 都很慢
+    stubs = [StubUpstream().start(), StubUpstream().start()]
+    for stub in stubs:
+        stub.script = ['slow']
+    monkeypatch.setenv('HTTPS_PROXY', ','.join(stub.base_url for stub in stubs))
+    monkeypatch.delenv('HTTP_PROXY', raising=False)
+    pool = ProxyPool()
+    monkeypatch.setattr(app.utils, 'proxy_pool', pool)
+    monkeypatch.setattr(app.asgi, 'proxy_pool', pool)
+    yield stubs
+    for stub in stubs:
+        stub.stop()
+
+
+def test_hedged_attempts_avoid_the_pinned_proxy(proxies, post_chat):
+    assert post_chat(chat_body()).status_code == 200
+    # getChannel 所走的代理即会话绑定的代理：只有第一个尝试走它，对冲尝试都走另一个代理
+    pinned, other = sorted(proxies, key=lambda stub: stub.calls['getChannel'], reverse=True)
+    assert pinned.calls['getChannel'] == 1
+    assert pinned.calls['send'] == 1
+    assert other.calls['send'] >= 1
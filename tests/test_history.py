@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from app.history import HistoryCompactor, estimate_tokens
+from app.utils import process_msg_content
+
+TURN = 'x' * 396
+
+
+# 逐字符按类别计数的参照实现
+def reference_tokens(text):
+    units = 0
+    for char in text:
+        size = len(char.encode('utf-8'))
+        units += {1: 1, 2: 2, 3: 4, 4: 8}[size]
+    return units // 4 + 1
+
+
+@pytest.mark.parametrize('text, tokens', [
+    ('abcd' * 100, 101),
+    ('привет' * 100, 301),
+    ('αβγδ' * 50, 101),
+    ('你好' * 100, 201),
+    ('🙂' * 10, 21),
+    ('abcd' * 10 + 'αβ' * 10 + '你' * 10 + '🙂' * 5, 41),
+], ids=['ascii', 'cyrillic', 'greek', 'cjk', 'emoji', 'mixed'])
+def test_estimate_tokens_per_character_class(text, tokens):
+    assert estimate_tokens(text) == tokens
+
+
+def test_estimate_tokens_matches_reference_on_mixed_script():
+    rng = random.Random(20261018)
+    alphabet = 'ab cd\n' + 'éßж' + 'Ωπ' + '中文かな' + '🙂🚀'
+    for _ in range(2000):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 50)))
+        assert estimate_tokens(text) == reference_tokens(text), text
+
+
+def conversation(turns, final='final question'):
+    return [{"role": "system", "content": "be brief"},
+            {"role": "user", "content": "first"}] + \
+        [{"role": "user", "content": f"turn {index} {TURN}"} for index in range(turns)] + \
+        [{"role": "user", "content": final}]
+
+
+def build(compactor, messages, key='conversation'):
+    return compactor.build(messages, 1, "Your role setting: be brief\n\nUser's input: first", key)
+
+
+def test_recent_turns_fill_the_budget():
+    compactor = HistoryCompactor(350, process_msg_content)
+
+    prompt = build(compactor, conversation(10))
+
+    assert estimate_tokens(prompt) <= 350
+    assert prompt.startswith("Your role setting: be brief")
+    assert prompt.endswith('\nfinal question')
+    assert 'turn 9 ' in prompt and 'turn 8 ' in prompt and 'turn 7 ' in prompt
+    assert 'turn 6 ' not in prompt
+
+
+def test_oversized_first_message_is_truncated_to_the_budget():
+    compactor = HistoryCompactor(100, process_msg_content)
+    messages = conversation(3)
+
+    prompt = compactor.build(messages, 1, 'role setting ' + 'y' * 4000, 'conversation')
+
+    assert estimate_tokens(prompt) <= 100
+    assert prompt.startswith('role setting yyy')
+    assert prompt.endswith('…\nfinal question')
+    assert 'turn ' not in prompt
+
+
+def test_oversized_final_message_is_kept_whole():
+    compactor = HistoryCompactor(100, process_msg_content)
+    final = '最后的问题' * 100
+
+    assert build(compactor, conversation(3, final)) == final
+
+
+def test_summary_respects_its_budget_and_is_cached_per_conversation():
+    compactor = HistoryCompactor(300, process_msg_content, summary_budget=60, summary_turn_chars=10)
+    messages = conversation(12)
+
+    prompt = build(compactor, messages)
+
+    assert estimate_tokens(prompt) <= 300
+    start = prompt.index('Earlier conversation')
+    summary = prompt[start:prompt.index(' \nturn ', start)]
+    assert estimate_tokens(summary) <= 60
+    assert summary.endswith('User: turn 9 xxx…')
+
+    # 已折叠的消息从缓存中取，之后对它们的修改不会重新处理；换一个会话则重新生成
+    edited = conversation(14)
+    edited[10]['content'] = 'edited'
+    assert 'User: edited' not in build(compactor, edited)
+    assert 'User: edited' in build(compactor, edited, key='another conversation')
@@ -0,0 +1,80 @@
+import base64
+import io
+import json
+import os
+
+import pytest
+
+import app.image_hosts
+import app.utils
+from app.image_hosts import LocalImageHost, create_image_host
+from app.images import create_image_uploader
+from tests.conftest import chat_body
+
+
+def data_url(image_type, image_data):
+    return f"data:image/{image_type};base64,{base64.b64encode(image_data).decode('ascii')}"
+
+
+def png_bytes(size=(4, 4)):
+    Image = pytest.importorskip('PIL.Image')
+    output = io.BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(output, format='PNG')
+    return output.getvalue()
+
+
+@pytest.fixture
+def telegraph_uploader(upstream, monkeypatch):
+    # 默认的 telegraph 后端指向本地模拟服务，走真实的 request_with_proxy_image 上传链路
+    monkeypatch.setattr(app.image_hosts, 'IMAGE_HOST', 'telegraph')
+    monkeypatch.setenv('IMAGE_TELEGRAPH_UPLOAD_URL', f"{upstream.base_url}/upload")
+    uploader = create_image_uploader(app.utils.request_with_proxy_image)
+    monkeypatch.setattr(app.utils, 'image_uploader', uploader)
+    return uploader
+
+
+def test_base64_image_is_uploaded_once_and_sent_upstream(flask_app, upstream, telegraph_uploader):
+    image = data_url('png', png_bytes())
+    body = chat_body()
+    body['messages'][-1]['content'] = [{"type": "text", "text": body['messages'][-1]['content']},
+                                       {"type": "image_url", "image_url": {"url": image}},
+                                       {"type": "image_url", "image_url": {"url": image}}]
+
+    response = flask_app.test_client().post('/v1/chat/completions', json=body)
+    response.close()
+
+    assert response.status_code == 200
+    # 相同图片按内容摘要去重，只上传一次
+    assert upstream.calls['upload'] == 1
+    sent = json.loads(upstream.bodies['send'][-1])
+    assert sent['imageUrls'] == [f"{upstream.base_url}/file/upload-1.png"] * 2
+
+
+def test_large_image_is_downscaled_before_upload(upstream, telegraph_uploader, monkeypatch):
+    monkeypatch.setenv('IMAGE_DOWNSCALE_THRESHOLD', '1024')
+    monkeypatch.setenv('IMAGE_MAX_DIMENSION', '64')
+    uploader = create_image_uploader(app.utils.request_with_proxy_image)
+    original = png_bytes((512, 512))
+
+    url = uploader.upload_base64(data_url('png', original))
+
+    assert url == f"{upstream.base_url}/file/upload-1.jpeg"
+    assert len(upstream.bodies['upload'][0]) < len(original)
+
+
+def test_local_image_host_writes_each_digest_once(tmp_path):
+    host = LocalImageHost(str(tmp_path), 'http://127.0.0.1:3000/images/')
+    assert host.upload('abc', 'png', b'first') == 'http://127.0.0.1:3000/images/abc.png'
+    assert host.upload('abc', 'png', b'second') == 'http://127.0.0.1:3000/images/abc.png'
+    with open(os.path.join(str(tmp_path), 'abc.png'), 'rb') as file:
+        assert file.read() == b'first'
+
+
+@pytest.mark.parametrize('missing', ['IMAGE_PUBLIC_BASE_URL', 'IMAGE_S3_BUCKET'])
+def test_s3_host_requires_bucket_and_public_url(monkeypatch, missing):
+    monkeypatch.setattr(app.image_hosts, 'IMAGE_HOST', 's3')
+    monkeypatch.setenv('IMAGE_S3_BUCKET', 'bucket')
+    monkeypatch.setenv('IMAGE_PUBLIC_BASE_URL', 'https://cdn.example.com')
+    monkeypatch.delenv(missing)
+    with pytest.raises(ValueError, match=missing):
+        create_image_host(None)
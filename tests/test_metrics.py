@@ -0,0 +1,74 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+import app.metrics
+from app.metrics import CHAT_FIRST_BYTE_SECONDS, CHAT_RETRIES_TOTAL, TOKEN_MINT_FAILURES_TOTAL, TOKEN_MINTER_METRICS, \
+    TOKEN_POOL_SIZE, render_metrics, set_remote_metrics
+from app.token import TokenManager
+from app.token_ipc import TokenClient, TokenServer
+
+
+def metric_lines(text, name):
+    return [line for line in text.splitlines() if line.startswith(name)]
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_worker_snapshot(directory, pid, snapshot):
+    with open(os.path.join(directory, f"{pid}.json"), 'w', encoding='utf-8') as file:
+        json.dump(snapshot, file)
+
+
+def test_workers_metrics_are_merged(tmp_path, monkeypatch):
+    monkeypatch.setattr(app.metrics, 'METRICS_DIR', str(tmp_path))
+    CHAT_RETRIES_TOTAL.inc('merge-test')
+    CHAT_FIRST_BYTE_SECONDS.observe(0.01)
+    local_count = CHAT_FIRST_BYTE_SECONDS.collect()[0][1][2]
+    buckets = len(CHAT_FIRST_BYTE_SECONDS.buckets) + 1
+    other_worker, exited_worker = os.getppid(), exited_pid()
+    for pid, retries in ((other_worker, 3), (exited_worker, 4)):
+        write_worker_snapshot(str(tmp_path), pid, {
+            CHAT_RETRIES_TOTAL.name: [[['merge-test'], retries]],
+            CHAT_FIRST_BYTE_SECONDS.name: [[[], [[1] + [0] * (buckets - 1), 0.01, 1]]],
+            TOKEN_POOL_SIZE.name: [[[], 7]],
+        })
+
+    text = render_metrics()
+
+    # 计数器和直方图累加所有 worker（包括已退出的）
+    assert f'{CHAT_RETRIES_TOTAL.name}{{reason="merge-test"}} 8' in metric_lines(text, CHAT_RETRIES_TOTAL.name)
+    assert f'{CHAT_FIRST_BYTE_SECONDS.name}_count {local_count + 2}' in text
+    # gauge 按存活的 worker 分别输出
+    pool_size = metric_lines(text, TOKEN_POOL_SIZE.name)
+    assert f'{TOKEN_POOL_SIZE.name}{{worker="{other_worker}"}} 7' in pool_size
+    assert not [line for line in pool_size if f'worker="{exited_worker}"' in line]
+    assert [line for line in pool_size if f'worker="{os.getpid()}"' in line]
+    assert os.path.exists(os.path.join(str(tmp_path), f"{os.getpid()}.json"))
+
+
+def test_sidecar_metrics_are_served_through_the_worker(monkeypatch):
+    socket_path = os.path.join(tempfile.mkdtemp(), 'token.sock')
+    server = TokenServer(socket_path, TokenManager(min_valid_tokens=0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        TOKEN_MINT_FAILURES_TOTAL.inc()
+        client = TokenClient(socket_path)
+        monkeypatch.setattr(app.metrics, '_remote_metrics', ((), None))
+        set_remote_metrics(TOKEN_MINTER_METRICS, client.metrics)
+
+        text = render_metrics()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # 每个指标只输出一次，数据来自 sidecar
+    assert text.count(f'# TYPE {TOKEN_MINT_FAILURES_TOTAL.name} counter') == 1
+    assert metric_lines(text, TOKEN_MINT_FAILURES_TOTAL.name)
@@ -0,0 +1,92 @@
+import random
+from collections import deque
+
+import pytest
+
+import app.utils
+from app.utils import build_user_prompt, process_msg_content
+
+CASES = 100000
+WORDS = ['hello', '你好', 'popai', '', ' ', 'line\nbreak', 'emoji 🙂', 'x' * 40]
+
+
+# 旧实现（get_user_contents + 调用方拼接），作为 build_user_prompt 的参照
+def legacy_get_user_contents(messages, limit):
+    limit = int(limit)
+    selected_messages = deque(maxlen=limit)
+    system_content = None
+    first_user_message = None
+    user_messages_list = []
+
+    for message in messages:
+        if message['role'] == 'system' and system_content is None:
+            system_content = message['content']
+        elif message.get("role") == "user":
+            content = process_msg_content(message.get("content"))
+            if content:
+                if first_user_message is None:
+                    if system_content is None:
+                        first_user_message = content
+                    else:
+                        first_user_message = f"Your role setting: {system_content}\n\nUser's input: {content}"
+                    selected_messages.append(first_user_message)
+                    user_messages_list.append(first_user_message)
+                else:
+                    selected_messages.append(content)
+                    user_messages_list.append(content)
+
+    if selected_messages:
+        end_user_message = selected_messages[-1]
+    else:
+        end_user_message = None
+
+    if selected_messages:
+        selected_messages.pop()
+
+    concatenated_messages = ' \n'.join(selected_messages)
+
+    return first_user_message, end_user_message, concatenated_messages, user_messages_list
+
+
+def legacy_user_prompt(messages, limit):
+    first_user_message, _, concatenated_messages, user_messages_list = legacy_get_user_contents(messages, limit)
+    if not user_messages_list:
+        return None, None
+    final_user_content = user_messages_list[-1]
+    if concatenated_messages:
+        final_user_content = concatenated_messages + '\n' + final_user_content
+    return first_user_message, final_user_content
+
+
+def random_text(rng):
+    return ''.join(rng.choice(WORDS) for _ in range(rng.randint(0, 3)))
+
+
+def random_content(rng):
+    kind = rng.random()
+    if kind < 0.6:
+        return random_text(rng)
+    if kind < 0.9:
+        # OpenAI 多模态格式：文本和图片混排
+        return [{"type": "text", "text": random_text(rng)} if rng.random() < 0.7 else
+                {"type": "image_url", "image_url": {"url": "https://example.com/a.png"}}
+                for _ in range(rng.randint(0, 3))]
+    return None
+
+
+def random_messages(rng):
+    roles = ['system', 'user', 'assistant']
+    return [{"role": rng.choice(roles), "content": random_content(rng)} for _ in range(rng.randint(0, 12))]
+
+
+@pytest.fixture(autouse=True)
+def without_history_compaction(monkeypatch):
+    monkeypatch.setattr(app.utils, 'history_compactor', None)
+
+
+def test_build_user_prompt_matches_legacy_implementation():
+    rng = random.Random(20261018)
+    for case in range(CASES):
+        messages = random_messages(rng)
+        limit = rng.randint(0, 8)
+        assert build_user_prompt(messages, limit) == legacy_user_prompt(messages, limit), (case, limit, messages)
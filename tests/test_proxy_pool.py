@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+import app.token
+from app.config import ProxyPool
+from app.token import BrowserWorker, MintLatency
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setenv('HTTPS_PROXY', 'http://proxy-a:8080,http://proxy-b:8080')
+    monkeypatch.delenv('HTTP_PROXY', raising=False)
+    return ProxyPool()
+
+
+class FakeResponse:
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+
+class FakeAsyncResponse(FakeResponse):
+    async def aclose(self):
+        self.closed += 1
+
+
+def test_browser_launch_failure_clears_half_open_probe(pool, monkeypatch):
+    half_open, ejected = pool.states['http://proxy-a:8080'], pool.states['http://proxy-b:8080']
+    half_open.ejected_until = time.monotonic() - 1
+    half_open.eject_seconds = pool.min_eject_seconds
+    ejected.ejected_until = time.monotonic() + 600
+
+    def failing_chrome(**kwargs):
+        raise RuntimeError('chrome failed to start')
+
+    monkeypatch.setattr(app.token, 'proxy_pool', pool)
+    monkeypatch.setattr(app.token.uc, 'Chrome', failing_chrome)
+    worker = BrowserWorker(0, MintLatency())
+    with pytest.raises(RuntimeError):
+        worker.setup_browser()
+    worker.close_browser()
+
+    # 探测失败：重新熔断并清除探测标记，到期后可以再次探测
+    assert not half_open.probing
+    assert half_open.ejected_until > time.monotonic()
+    half_open.ejected_until = time.monotonic() - 1
+    assert pool._is_admitted(half_open, time.monotonic())
+
+
+def test_streamed_response_holds_proxy_until_close(pool):
+    proxies = pool.get_proxy()
+    state = pool._state_for(proxies)
+    response = FakeResponse()
+    pool.release_on_close(response, proxies)
+    assert state.open_connections == 1
+
+    response.close()
+    assert response.closed == 1
+    assert state.open_connections == 0
+    # 重复 close 不会多归还其他请求占用的连接
+    state.open_connections = 1
+    response.close()
+    assert state.open_connections == 1
+
+
+def test_async_streamed_response_holds_proxy_until_aclose(pool):
+    proxies = pool.get_proxy()
+    state = pool._state_for(proxies)
+    response = FakeAsyncResponse()
+    pool.release_on_close(response, proxies)
+    assert state.open_connections == 1
+
+    asyncio.run(response.aclose())
+    assert state.open_connections == 0
+    response.close()
+    assert response.closed == 2
+    assert state.open_connections == 0
@@ -0,0 +1,95 @@
+import os
+import uuid
+
+import pytest
+
+from app.cache_backend import RedisChannelStore, RedisImageUrlCache, RedisTokenPool
+from app.token import USES_PER_TOKEN
+
+# 需要本地 Redis：REDIS_TEST_URL（默认 redis://127.0.0.1:6379/15），连接不上时跳过
+REDIS_TEST_URL = os.getenv('REDIS_TEST_URL', 'redis://127.0.0.1:6379/15')
+
+
+@pytest.fixture
+def redis_client():
+    redis = pytest.importorskip('redis')
+    client = redis.Redis.from_url(REDIS_TEST_URL, decode_responses=True)
+    try:
+        client.ping()
+    except redis.exceptions.ConnectionError:
+        pytest.skip(f"no Redis server at {REDIS_TEST_URL}")
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def prefix(redis_client):
+    prefix = f"popai2api-test:{uuid.uuid4().hex}:"
+    yield prefix
+    keys = list(redis_client.scan_iter(f"{prefix}*"))
+    if keys:
+        redis_client.delete(*keys)
+
+
+def test_replicas_share_one_token_pool(redis_client, prefix):
+    minter = RedisTokenPool(redis_client, prefix, min_valid_tokens=0)
+    replica = RedisTokenPool(redis_client, prefix, min_valid_tokens=0)
+    minter.add_token('token-a')
+    minter.add_token('token-b')
+
+    handed_out = [replica.get_token() for _ in range(2 * USES_PER_TOKEN)]
+    assert sorted(handed_out) == ['token-a'] * USES_PER_TOKEN + ['token-b'] * USES_PER_TOKEN
+    assert replica.get_token() is None
+    assert len(minter) == 0
+
+
+def test_removed_token_is_never_added_back(redis_client, prefix):
+    pool = RedisTokenPool(redis_client, prefix, min_valid_tokens=0)
+    pool.add_token('rejected')
+    assert pool.remove_token('rejected')
+    # 例如另一个副本从旧的本地快照中恢复
+    pool.add_token('rejected', use_count=0)
+    assert pool.get_token() is None
+
+
+def test_exhausted_token_is_never_added_back(redis_client, prefix):
+    pool = RedisTokenPool(redis_client, prefix, min_valid_tokens=0)
+    pool.add_token('exhausted')
+    for _ in range(USES_PER_TOKEN):
+        assert pool.get_token() == 'exhausted'
+    pool.add_token('exhausted', use_count=1)
+    assert pool.get_token() is None
+
+
+def test_add_token_keeps_existing_use_count(redis_client, prefix):
+    pool = RedisTokenPool(redis_client, prefix, min_valid_tokens=0)
+    pool.add_token('token')
+    pool.get_token()
+    pool.add_token('token', use_count=0)
+    assert len(pool) == 1
+    assert pool.snapshot()[0][2] == 1
+
+
+def test_only_one_replica_holds_the_minter_lease(redis_client, prefix):
+    first = RedisTokenPool(redis_client, prefix)
+    second = RedisTokenPool(redis_client, prefix)
+    second.minter_id = 'other-replica'
+    assert first.try_acquire_minter()
+    assert not second.try_acquire_minter()
+    # 续约
+    assert first.try_acquire_minter()
+
+
+def test_replicas_share_channels_and_image_urls(redis_client, prefix):
+    RedisChannelStore(redis_client, 60, prefix).set('hash', 'channel-1')
+    assert RedisChannelStore(redis_client, 60, prefix).get('hash') == 'channel-1'
+    RedisImageUrlCache(redis_client, 60, prefix).set('digest', 'https://example.com/a.png')
+    assert RedisImageUrlCache(redis_client, 60, prefix).get('digest') == 'https://example.com/a.png'
+
+
+def test_redis_backend_skips_local_token_store(monkeypatch):
+    import app.token
+    monkeypatch.setattr(app.token, 'CACHE_BACKEND', 'redis')
+    assert app.token.create_token_store() is None
+    monkeypatch.setattr(app.token, 'CACHE_BACKEND', 'local')
+    assert app.token.create_token_store() is not None
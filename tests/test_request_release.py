@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+
+import app.asgi
+from app.accounts import account_scheduler
+from app.asgi import close_async_clients, create_asgi_app
+from tests.conftest import chat_body
+
+
+def post_chat(body):
+    async def scenario():
+        transport = httpx.ASGITransport(app=create_asgi_app())
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            try:
+                return await client.post('/v1/chat/completions', json=body)
+            finally:
+                await close_async_clients()
+
+    return asyncio.run(scenario())
+
+
+def in_flight(admission):
+    # 准入名额和各账号的在途计数，每个请求结束后都必须回到 0
+    return admission.in_flight, [account.in_flight for account in account_scheduler.accounts]
+
+
+def test_stream_cut_mid_way_releases_admission_and_account(upstream):
+    upstream.truncate = True
+    response = post_chat(chat_body(stream=True))
+
+    assert response.status_code == 200
+    events = [line for line in response.text.split('\n\n') if line]
+    assert '"error"' in events[-1]
+    assert in_flight(app.asgi.admission) == (0, [0])
+
+
+def test_completed_requests_release_admission_and_account(upstream):
+    assert post_chat(chat_body(stream=True)).status_code == 200
+    assert post_chat(chat_body()).status_code == 200
+    assert in_flight(app.asgi.admission) == (0, [0])
+
+
+def test_flask_stream_cut_mid_way_ends_with_error_event(flask_app, upstream):
+    import app.routes
+    upstream.truncate = True
+    response = flask_app.test_client().post('/v1/chat/completions', json=chat_body(stream=True))
+
+    assert response.status_code == 200
+    events = [line for line in response.get_data(as_text=True).split('\n\n') if line]
+    assert '"error"' in events[-1]
+    response.close()
+    assert in_flight(app.routes.admission) == (0, [0])
@@ -0,0 +1,95 @@
+import json
+import time
+
+import pytest
+
+import app.utils
+from app.response_cache import ENTRY_OVERHEAD_BYTES, ResponseCache
+from tests.conftest import chat_body
+
+
+@pytest.fixture
+def response_cache(monkeypatch):
+    cache = ResponseCache(ttl=60, max_bytes=1024 * 1024, max_entry_bytes=64 * 1024)
+    monkeypatch.setattr(app.utils, 'response_cache', cache)
+    return cache
+
+
+def completion_content(response):
+    return json.loads(response.text)['choices'][0]['message']['content']
+
+
+def test_identical_request_is_served_from_cache(upstream, response_cache, post_chat):
+    body = chat_body()
+
+    miss = post_chat(body)
+    hit = post_chat(body)
+
+    assert miss.headers['X-Cache'] == 'MISS'
+    assert hit.headers['X-Cache'] == 'HIT'
+    assert completion_content(hit) == completion_content(miss) == upstream.reply
+    assert upstream.calls['send'] == 1
+
+
+def test_cached_answer_is_replayed_as_sse(upstream, response_cache, post_chat):
+    body = chat_body()
+    post_chat(body)
+
+    # stream 不参与缓存键，非流式请求缓存的结果可以作为 SSE 重放
+    replay = post_chat(dict(body, stream=True))
+
+    assert replay.headers['X-Cache'] == 'HIT'
+    assert replay.headers['Content-Type'].startswith('text/event-stream')
+    events = [json.loads(line[len('data: '):]) for line in replay.text.split('\n\n') if line]
+    assert ''.join(event['choices'][0]['delta'].get('content', '') for event in events) == upstream.reply
+    assert upstream.calls['send'] == 1
+
+
+def test_bypass_header_skips_lookup_but_refreshes_cache(upstream, response_cache, post_chat):
+    body = chat_body()
+    post_chat(body)
+
+    bypassed = post_chat(body, headers={'X-Cache-Bypass': '1'})
+    cached_reply, upstream.reply = upstream.reply, 'a different answer'
+    hit = post_chat(body)
+
+    assert bypassed.headers['X-Cache'] == 'MISS'
+    assert upstream.calls['send'] == 2
+    assert hit.headers['X-Cache'] == 'HIT'
+    assert completion_content(hit) == cached_reply
+
+
+def test_entry_expires_after_ttl(upstream, response_cache, post_chat):
+    response_cache.ttl = 0.2
+    body = chat_body()
+    post_chat(body)
+    time.sleep(0.3)
+
+    assert post_chat(body).headers['X-Cache'] == 'MISS'
+    assert upstream.calls['send'] == 2
+
+
+def test_least_recently_used_entry_is_evicted_by_size(upstream, response_cache, post_chat):
+    entry_bytes = len(upstream.reply.encode('utf-8')) + ENTRY_OVERHEAD_BYTES
+    response_cache.max_bytes = 2 * entry_bytes
+    first, second, third = chat_body(), chat_body(), chat_body()
+    post_chat(first)
+    post_chat(second)
+    # 访问 first 后 second 成为最久未使用的条目
+    assert post_chat(first).headers['X-Cache'] == 'HIT'
+
+    post_chat(third)
+
+    assert response_cache.state() == (2, 2 * entry_bytes)
+    assert post_chat(first).headers['X-Cache'] == 'HIT'
+    assert post_chat(third).headers['X-Cache'] == 'HIT'
+    assert post_chat(second).headers['X-Cache'] == 'MISS'
+
+
+def test_oversized_answer_is_not_cached(upstream, response_cache, post_chat):
+    response_cache.max_entry_bytes = ENTRY_OVERHEAD_BYTES
+    body = chat_body()
+    post_chat(body)
+
+    assert post_chat(body).headers['X-Cache'] == 'MISS'
+    assert response_cache.state() == (0, 0)
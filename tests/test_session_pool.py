@@ -0,0 +1,41 @@
+import time
+from urllib.parse import urlparse
+
+import pytest
+
+from app.session import SessionPool
+from tests.upstream_stub import StubUpstream
+
+IDLE_TIMEOUT = 0.1
+
+
+@pytest.fixture
+def other_upstream():
+    stub = StubUpstream().start()
+    yield stub
+    stub.stop()
+
+
+def test_idle_eviction_skips_sessions_with_open_streams(upstream, other_upstream):
+    pool = SessionPool(idle_timeout=IDLE_TIMEOUT)
+    url = upstream.base_url + '/api/v1/chat/send'
+    key = (None, urlparse(url).netloc)
+    response = pool.post(url, stream=True, json={}, timeout=5)
+    session = pool._sessions[key][0]
+    time.sleep(IDLE_TIMEOUT * 2)
+
+    # 请求另一个 host 触发空闲回收：流式响应还没读完，Session 不能被关闭
+    pool.post(other_upstream.base_url + '/api/v1/chat/getChannel', json={}, timeout=5)
+    assert pool._sessions[key][0] is session
+    assert upstream.reply[:5] in response.text
+    response.close()
+    response.close()
+    assert pool._sessions[key][2] == 0
+
+    # 关闭时刷新最后使用时间，之后空闲超时才回收
+    pool.post(other_upstream.base_url + '/api/v1/chat/getChannel', json={}, timeout=5)
+    assert key in pool._sessions
+    time.sleep(IDLE_TIMEOUT * 2)
+    pool.post(other_upstream.base_url + '/api/v1/chat/getChannel', json={}, timeout=5)
+    assert key not in pool._sessions
+    pool.close()
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+import time
+
+import httpx
+
+from app.singleflight import AsyncSingleFlight, SingleFlight
+from tests.conftest import chat_body
+
+CONCURRENT_REQUESTS = 8
+
+
+def test_concurrent_flask_requests_share_one_get_channel(flask_app, upstream):
+    upstream.delay = 0.3
+    body = chat_body()
+    responses = [None] * CONCURRENT_REQUESTS
+    barrier = threading.Barrier(CONCURRENT_REQUESTS)
+
+    def send(index):
+        client = flask_app.test_client()
+        barrier.wait()
+        responses[index] = client.post('/v1/chat/completions', json=body)
+        # 关闭响应才会触发 call_on_close，归还准入名额和账号的在途计数
+        responses[index].close()
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(CONCURRENT_REQUESTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [response.status_code for response in responses] == [200] * CONCURRENT_REQUESTS
+    assert upstream.calls['getChannel'] == 1
+    assert upstream.calls['send'] == CONCURRENT_REQUESTS
+    # 所有请求都落在同一个 channel 上
+    assert len({response.get_json()['id'] for response in responses}) == 1
+
+
+def test_concurrent_asgi_requests_share_one_get_channel(upstream):
+    from app.asgi import close_async_clients, create_asgi_app
+    upstream.delay = 0.3
+    body = chat_body()
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=create_asgi_app())
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            try:
+                return await asyncio.gather(*[client.post('/v1/chat/completions', json=body)
+                                              for _ in range(CONCURRENT_REQUESTS)])
+            finally:
+                await close_async_clients()
+
+    responses = asyncio.run(scenario())
+    assert [response.status_code for response in responses] == [200] * CONCURRENT_REQUESTS
+    assert upstream.calls['getChannel'] == 1
+    assert len({response.json()['id'] for response in responses}) == 1
+
+
+def test_async_follower_retries_when_leader_is_cancelled():
+    async def scenario():
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return 'channel'
+
+        leader = asyncio.ensure_future(flight.do('key', fetch))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(flight.do('key', fetch))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        result = await asyncio.wait_for(follower, 1)
+        return result, len(calls), leader.cancelled()
+
+    assert asyncio.run(scenario()) == ('channel', 2, True)
+
+
+def test_async_follower_cancellation_does_not_affect_leader():
+    async def scenario():
+        flight = AsyncSingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.1)
+            return 'channel'
+
+        leader = asyncio.ensure_future(flight.do('key', fetch))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(flight.do('key', fetch))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        return await asyncio.wait_for(leader, 1)
+
+    assert asyncio.run(scenario()) == 'channel'
+
+
+def test_sync_followers_see_interrupted_leader_as_error():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def interrupted():
+        started.set()
+        release.wait()
+        raise KeyboardInterrupt
+
+    def leader():
+        try:
+            flight.do('key', interrupted)
+        except KeyboardInterrupt:
+            pass
+
+    def follower():
+        try:
+            flight.do('key', lambda: 'unused')
+        except Exception as e:
+            errors.append(e)
+
+    leader_thread = threading.Thread(target=leader)
+    leader_thread.start()
+    started.wait()
+    follower_thread = threading.Thread(target=follower)
+    follower_thread.start()
+    # 等待者进入等待后再让领头线程被中断
+    time.sleep(0.1)
+    release.set()
+    leader_thread.join()
+    follower_thread.join()
+    assert len(errors) == 1
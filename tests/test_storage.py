@@ -0,0 +1,42 @@
+import os
+
+from app.storage import ChannelStore
+
+
+def create_store(path, shared, max_entries=100):
+    return ChannelStore(path, ttl=60, max_entries=max_entries, flush_interval=0.01, shared=shared)
+
+
+def test_shared_store_sees_channels_written_by_other_workers(tmp_path):
+    path = os.path.join(tmp_path, 'channels.db')
+    first_worker = create_store(path, shared=True)
+    second_worker = create_store(path, shared=True)
+
+    first_worker.set('conversation', 'channel-1')
+    # 第二个 worker 启动时还没有这条记录，未命中内存后回读 SQLite
+    assert second_worker.get('conversation') == 'channel-1'
+
+
+def test_shared_store_eviction_keeps_rows_for_other_workers(tmp_path):
+    path = os.path.join(tmp_path, 'channels.db')
+    first_worker = create_store(path, shared=True, max_entries=1)
+    second_worker = create_store(path, shared=True)
+
+    first_worker.set('old', 'channel-1')
+    first_worker.set('new', 'channel-2')
+    first_worker.flush()
+    assert second_worker.get('old') == 'channel-1'
+    # 被本进程 LRU 淘汰的记录仍能从 SQLite 找回
+    assert first_worker.get('old') == 'channel-1'
+
+
+def test_private_store_does_not_read_through(tmp_path):
+    path = os.path.join(tmp_path, 'channels.db')
+    first_worker = create_store(path, shared=False)
+    second_worker = create_store(path, shared=False)
+
+    first_worker.set('conversation', 'channel-1')
+    first_worker.flush()
+    assert second_worker.get('conversation') is None
+    # 单进程模式下重启时从 SQLite 加载
+    assert create_store(path, shared=False).get('conversation') == 'channel-1'
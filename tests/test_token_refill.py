@@ -0,0 +1,61 @@
+import threading
+import time
+
+import app.token
+from app.token import Token, TokenManagerThread
+
+
+def test_failed_mint_rounds_back_off_exponentially():
+    thread = TokenManagerThread()
+    thread.mint_backoff = 0.2
+    thread.mint_backoff_max = 1
+    rounds = []
+
+    def failing_mint(batch):
+        rounds.append(time.monotonic())
+        return 0
+
+    thread.mint_tokens = failing_mint
+    thread.start()
+    # 池子为空时每次 get_token 都会唤醒补充线程
+    stop = threading.Event()
+
+    def hammer():
+        while not stop.is_set():
+            thread.get_token()
+            time.sleep(0.001)
+
+    client = threading.Thread(target=hammer)
+    client.start()
+    time.sleep(1.6)
+    stop.set()
+    client.join()
+    thread.stop()
+    thread.join(5)
+
+    # 0.2 + 0.4 + 0.8 秒的退避：1.6 秒内最多 4 轮，而不是被唤醒后立即重试
+    assert 2 <= len(rounds) <= 4
+    gaps = [b - a for a, b in zip(rounds, rounds[1:])]
+    assert all(later > earlier for earlier, later in zip(gaps, gaps[1:]))
+
+
+def test_successful_round_resets_backoff():
+    thread = TokenManagerThread()
+    thread.failed_mint_rounds = 3
+    thread.token_manager.min_valid_tokens = 1
+    thread.token_manager.forecaster.floor = 1
+
+    def mint(batch):
+        for i in range(batch):
+            thread.token_manager.add_token(f"token-{i}")
+        return batch
+
+    thread.mint_tokens = mint
+    thread.immediate_job()
+    assert thread.failed_mint_rounds == 0
+
+
+def test_token_validity_follows_uses_per_token(monkeypatch):
+    monkeypatch.setattr(app.token, 'USES_PER_TOKEN', 2)
+    assert Token('t', use_count=1).is_valid()
+    assert not Token('t', use_count=2).is_valid()
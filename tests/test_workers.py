@@ -0,0 +1,45 @@
+import logging
+import os
+import signal
+import tempfile
+import time
+
+from app.token_ipc import TokenClient, TokenServer
+from app.workers import TokenSidecar
+
+
+def serve_tokens(socket_path):
+    # 代替真正的 sidecar：不启动浏览器，只提供一个固定的 token
+    from app.token import TokenManager
+    manager = TokenManager(min_valid_tokens=0)
+    manager.add_token('sidecar-token')
+    TokenServer(socket_path, manager).serve_forever()
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_crashed_sidecar_is_restarted_and_clients_reconnect(caplog):
+    socket_path = os.path.join(tempfile.mkdtemp(), 'token.sock')
+    sidecar = TokenSidecar(socket_path, restart_delay=0.1, target=serve_tokens).start()
+    client = TokenClient(socket_path, timeout=1)
+    try:
+        assert wait_for(lambda: client.get_token() == 'sidecar-token')
+        crashed_pid = sidecar.process.pid
+        with caplog.at_level(logging.ERROR):
+            os.kill(crashed_pid, signal.SIGKILL)
+            assert wait_for(lambda: sidecar.restarts == 1)
+        assert sidecar.process.pid != crashed_pid
+        assert f"Token sidecar (pid {crashed_pid}) exited" in caplog.text
+        # 同一个客户端的旧连接已断开，重连到新的 sidecar
+        assert wait_for(lambda: client.get_token() == 'sidecar-token')
+    finally:
+        sidecar.stop()
+    assert not sidecar.process.is_alive()
+    assert sidecar.restarts == 1
@@ -0,0 +1,118 @@
+import json
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 本地模拟的 popai 上游：getChannel 返回 channelId，chat/send 按 popai 格式返回 SSE，
+# upload 按 telegra.ph 格式返回图片路径。bodies 按路径记录收到的请求体。
+# delay 控制每个请求的响应延迟，用于构造并发窗口；truncate 为真时 chat/send 发出第一条消息后就断开连接。
+# script 依次指定后续 chat/send 的行为：'slow' 延迟 slow_delay 秒，'60001' 返回 gtoken 被拒的响应头。
+# 请求以绝对 URI 发来时同样按路径处理，因此也可以充当 HTTP 代理
+
+
+class _Server(ThreadingHTTPServer):
+    # 并发测试会同时发起上百个连接
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class StubUpstream:
+    def __init__(self, delay=0.0, reply='hello from stub', truncate=False):
+        self.delay = delay
+        self.reply = reply
+        self.truncate = truncate
+        self.script = []
+        self.slow_delay = 2.0
+        self.calls = Counter()
+        self.bodies = defaultdict(list)
+        self._lock = threading.Lock()
+        self._channel_sequence = 0
+        self.server = _Server(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def next_channel_id(self):
+        with self._lock:
+            self._channel_sequence += 1
+            return f"channel-{self._channel_sequence}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                path = self.path.rsplit('/', 1)[-1]
+                with stub._lock:
+                    stub.calls[path] += 1
+                    stub.bodies[path].append(body)
+                if stub.delay:
+                    time.sleep(stub.delay)
+                if path == 'getChannel':
+                    self._send(200, 'application/json',
+                               json.dumps({"data": {"channelId": stub.next_channel_id()}}).encode('utf-8'))
+                elif path == 'send':
+                    with stub._lock:
+                        action = stub.script.pop(0) if stub.script else None
+                    if action == 'slow':
+                        time.sleep(stub.slow_delay)
+                    elif action == '60001':
+                        self.send_response(200)
+                        self.send_header('YJ-X-Content', '60001')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    data = json.loads(body or b'{}')
+                    events = [b'data: {"meta": true}\n\n']
+                    for part in (stub.reply[:5], stub.reply[5:]):
+                        message = [{"messageId": f"msg-{data.get('channelId')}", "content": part}]
+                        events.append(b'data: ' + json.dumps(message).encode('utf-8') + b'\n\n')
+                    if stub.truncate:
+                        self._send_truncated(events[:2])
+                    else:
+                        self._send(200, 'text/event-stream;charset=UTF-8', b''.join(events))
+                elif path == 'upload':
+                    extension = re.search(rb'filename="image\.(\w+)"', body).group(1).decode('ascii')
+                    src = f"/file/upload-{stub.calls[path]}.{extension}"
+                    self._send(200, 'application/json', json.dumps([{"src": src}]).encode('utf-8'))
+                else:
+                    self._send(404, 'text/plain', b'not found')
+
+            def _send(self, status, content_type, payload):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_truncated(self, events):
+                # 分块发送，不发结束块就关闭连接
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream;charset=UTF-8')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for event in events:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+                    self.wfile.flush()
+                    time.sleep(0.05)
+                self.close_connection = True
+
+        return Handler